@@ -1,14 +1,21 @@
-import tempfile
 import zipfile
 import logging
-from typing import Any
+from datetime import datetime
+from typing import Any, Iterable
 from pydantic import BaseModel, ValidationError
 
-from flask import Blueprint, g, make_response, request
+from flask import (
+    Blueprint, Response, g, json, make_response, request, send_file,
+    stream_with_context, url_for,
+)
 
 from . import config
-from .db import Changelog, Project
-from .tasks import queue, update_project, update_user_project
+from .auth import get_authenticated_user
+from .db import Changelog, Project, UserProject, db
+from .tasks import (
+    enqueue_update_user_project, is_update_job_lost, queue, update_project,
+)
+from .utils import files, http_cache, live_log
 from .utils.user_project import start_user_project
 
 
@@ -45,6 +52,69 @@ def Conflict(message="Conflict"):
     return make_response(({"message": message}, 409))
 
 
+# Pagination
+
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+
+
+class InvalidPageArgs(Exception):
+    pass
+
+
+def get_page_args() -> tuple[int | None, int]:
+    """Returns (cursor, limit) from the query string.
+
+    The cursor is the id of the last item on the previous page.
+    """
+    try:
+        cursor = int(request.args["cursor"]) if "cursor" in request.args else None
+        limit = int(request.args.get("limit", DEFAULT_PAGE_LIMIT))
+    except ValueError:
+        raise InvalidPageArgs("cursor and limit must be integers")
+
+    if not 1 <= limit <= MAX_PAGE_LIMIT:
+        raise InvalidPageArgs(f"limit must be between 1 and {MAX_PAGE_LIMIT}")
+    return cursor, limit
+
+
+def Paginated(items: list[dict[str, Any]], last_id: int | None, limit: int) -> Response:
+    """Response with a JSON array of items, and a `Link` header pointing to
+    the next page when there could be more items.
+    """
+    response = make_response(json.dumps(items))
+    response.headers["Content-Type"] = "application/json"
+    if len(items) == limit and last_id is not None:
+        next_url = url_for(
+            request.endpoint,  # type: ignore
+            **(request.view_args or {}),
+            cursor=last_id,
+            limit=limit,
+            _external=True,
+        )
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    return response
+
+
+def wants_ndjson() -> bool:
+    return (
+        request.args.get("format") == "ndjson" or
+        request.accept_mimetypes.best == "application/x-ndjson"
+    )
+
+
+def NDJSONStream(items: Iterable[dict[str, Any]]) -> Response:
+    """Streams items as newline delimited JSON, one item per line.
+    """
+    def generate():
+        for item in items:
+            yield json.dumps(item) + "\n"
+
+    return Response(
+        stream_with_context(generate()), mimetype="application/x-ndjson",
+    )
+
+
 class CheckInputModel(BaseModel):
     name: str
     title: str
@@ -69,19 +139,46 @@ class ProjectUpsertModel(BaseModel):
 
 # Resource: project
 
+def get_projects_validators():
+    validators, last_modified = http_cache.get_projects_validators(g.site)
+    return validators + [wants_ndjson()], last_modified
+
+
+def get_project_validators(name):
+    if not is_authorized(request):
+        return None
+    return http_cache.get_project_validators(g.site, name)
+
+
 @api.route("/projects", methods=["GET"])
+@http_cache.conditional(get_projects_validators, vary=("Accept",))
 def list_projects():
     """List all projects
 
+    Paginated with `cursor` and `limit`, or streamed as NDJSON
+    with `format=ndjson`.
+
     Returns: array[project_teaser]
     """
-    projects = g.site.get_projects()
-    return [
-        project.get_teaser() for project in projects
-    ]
+    if wants_ndjson():
+        projects = Project.iter_all(site_id=g.site.id)
+        return NDJSONStream(project.get_teaser() for project in projects)
+
+    try:
+        cursor, limit = get_page_args()
+    except InvalidPageArgs as e:
+        return ValidationFailed(str(e))
+
+    projects = Project.find_page(site_id=g.site.id, after=cursor, limit=limit)
+    return Paginated(
+        [project.get_teaser() for project in projects],
+        last_id=projects[-1].id if projects else None,
+        limit=limit,
+    )
 
 
 @api.route("/projects/<name>", methods=["GET", "PUT"])
+@http_cache.conditional(get_project_validators, public=False)
 def get_or_upsert_project(name):
     """Get or update or create project
 
@@ -132,27 +229,55 @@ def get_or_upsert_repo_zip(project_name):
     if not is_authorized(request):
         return Unauthorized()
 
+    key = f"projects/{project_name}/repo.zip"
+
     if request.method == "GET":
-        gen = g.site.get_private_file(f"projects/{project_name}/repo.zip")
-        response = make_response(gen)
-        response.headers["Content-Type"] = "application/zip"
-        return response
+        return send_private_file(key, mimetype="application/zip")
 
     elif request.method == "PUT":
-        with tempfile.TemporaryDirectory() as tempdir:
-            repo_zip = f"{tempdir}/repo.zip"
+        # the upload is streamed into place, without a copy in memory or in
+        # another temporary file
+        try:
+            saved = g.site.save_private_file(key, request.stream, check=check_zipfile)
+        except files.InvalidFile as e:
+            return {"message": str(e)}, 400
 
-            with open(repo_zip, "wb") as f:
-                for data in request.stream:
-                    f.write(data)
+        return {"size": saved.size, "sha256": saved.sha256}, 201
 
-            if not zipfile.is_zipfile(repo_zip):
-                return {"message": "Not a valid zipfile"}, 400
 
-            with open(repo_zip, "rb") as f:
-                g.site.save_private_file(f"projects/{project_name}/repo.zip", f)
+def check_zipfile(path):
+    if not zipfile.is_zipfile(path):
+        raise files.InvalidFile("Not a valid zipfile")
 
-        return {}, 201
+
+def send_private_file(key, mimetype):
+    """Sends a private file of the site, with support for conditional and
+    range requests.
+
+    With `config.private_files_accel_prefix`, nginx sends the file instead.
+    Otherwise, it is sent with `send_file`, which uses sendfile when the
+    server supports it.
+    """
+    try:
+        etag = g.site.get_private_file_etag(key)
+    except files.FileNotFound:
+        return NotFound("File not found")
+
+    if config.private_files_accel_prefix:
+        response = make_response("")
+        response.headers["Content-Type"] = mimetype
+        response.headers["X-Accel-Redirect"] = (
+            f"{config.private_files_accel_prefix}/{g.site.id}/{key}"
+        )
+        return response
+
+    response = send_file(
+        g.site.get_private_file_path(key), mimetype=mimetype, etag=etag,
+        conditional=True,
+    )
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 
 # Resource: User
@@ -177,15 +302,57 @@ def get_user(username):
 
 @api.route("/activity")
 def list_user_projects():
-    """List all user projects
+    """List all user projects, along with the progress of each.
 
     Authenticated endpoint
 
-    Returns: array[user_project_teaser]
+    Paginated with `cursor` and `limit`, or streamed as NDJSON
+    with `format=ndjson`.
+
+    Returns: array[activity_teaser]
     """
-    # TODO: add pagination
-    user_project = g.site.get_user_projects()
-    return [up.get_teaser() for up in user_project]
+    if wants_ndjson():
+        return NDJSONStream(
+            get_activity_teaser(progress)
+            for progress in g.site.iter_progress_matrix()
+        )
+
+    try:
+        cursor, limit = get_page_args()
+    except InvalidPageArgs as e:
+        return ValidationFailed(str(e))
+
+    matrix = g.site.get_progress_matrix(after=cursor, limit=limit)
+    return Paginated(
+        [get_activity_teaser(progress) for progress in matrix],
+        last_id=matrix[-1]["user_project_id"] if matrix else None,
+        limit=limit,
+    )
+
+
+def get_activity_teaser(progress: dict[str, Any]) -> dict[str, Any]:
+    """Activity teaser from a row of `Site.get_progress_matrix`.
+
+    Keeps the keys of the user_project teaser, and adds user, project,
+    and progress information.
+    """
+    return {
+        "git_url": progress["git_url"],
+        "project_name": progress["project_name"],
+        "username": progress["username"],
+        "app_url": progress["app_url"],
+        "user": {"username": progress["username"]},
+        "project": {
+            "name": progress["project_name"],
+            "title": progress["project_title"],
+        },
+        "progress": {
+            "total_tasks": progress["total_tasks"],
+            "completed_tasks": progress["completed_tasks"],
+            "percentage": progress["percentage"],
+            "status": progress["status"],
+        },
+    }
 
 
 @api.route("/users/<username>/projects")
@@ -194,6 +361,9 @@ def list_user_projects_by_user(username):
 
     Authenticated endpoint.
 
+    Paginated with `cursor` and `limit`, or streamed as NDJSON
+    with `format=ndjson`.
+
     Returns: array[user_project_teaser]
     """
     if not is_authorized(request):
@@ -203,8 +373,21 @@ def list_user_projects_by_user(username):
     if user is None:
         return NotFound("User not found")
 
-    user_projects = user.get_user_projects()
-    return [up.get_teaser() for up in user_projects]
+    if wants_ndjson():
+        user_projects = UserProject.iter_all(user_id=user.id)
+        return NDJSONStream(up.get_teaser() for up in user_projects)
+
+    try:
+        cursor, limit = get_page_args()
+    except InvalidPageArgs as e:
+        return ValidationFailed(str(e))
+
+    user_projects = UserProject.find_page(user_id=user.id, after=cursor, limit=limit)
+    return Paginated(
+        [up.get_teaser() for up in user_projects],
+        last_id=user_projects[-1].id if user_projects else None,
+        limit=limit,
+    )
 
 
 @api.route("/users/<username>/projects/<project_name>", methods=["GET", "PUT"])
@@ -240,6 +423,90 @@ def get_or_create_user_project(username, project_name):
         return user_project.get_detail()
 
 
+@api.route("/users/<username>/projects/<project_name>/changelog/<int:changelog_id>/log")
+def stream_user_project_log(username, project_name, changelog_id):
+    """Follows the live log of an update of a user project, as Server-Sent
+    Events. Each line of the log is a message, with the id of its entry, so
+    that a client that reconnects with Last-Event-ID gets the lines after it.
+    An `end` event, with the final status of the update, ends the stream.
+
+    Authenticated endpoint, also open to the user, when logged in.
+    """
+    user = g.site.get_user(username=username)
+    if user is None:
+        return NotFound("User not found")
+
+    authenticated_user = get_authenticated_user()
+    if not is_authorized(request) and (
+        authenticated_user is None or authenticated_user.id != user.id
+    ):
+        return Unauthorized()
+
+    project = g.site.get_project(name=project_name)
+    if project is None:
+        return NotFound("Project not found")
+
+    changelog = Changelog.find(
+        site_id=g.site.id, project_id=project.id, user_id=user.id,
+        action="update_user_project", id=changelog_id,
+    )
+    if changelog is None:
+        return NotFound("Changelog not found")
+
+    last_id = request.headers.get("Last-Event-ID") or "0"
+    return Response(
+        stream_with_context(generate_log_events(changelog, last_id)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# seconds between keep-alive comments, while no lines are written
+LOG_KEEPALIVE_INTERVAL = 15
+
+
+def generate_log_events(changelog: Changelog, last_id: str) -> Iterable[str]:
+    assert changelog.id is not None
+    changelog_id = changelog.id
+    while True:
+        entries = live_log.read(
+            changelog_id, last_id, block=LOG_KEEPALIVE_INTERVAL * 1000,
+        )
+        for entry_id, fields in entries:
+            if "end" in fields:
+                yield f"event: end\ndata: {fields['end']}\n\n"
+                return
+            line = fields["line"].replace("\r", "")
+            yield f"id: {entry_id}\ndata: {line}\n\n"
+            last_id = entry_id
+
+        if not entries:
+            # the live log has expired, or the update never started. Read
+            # the status from the database, not from the session.
+            row = db.where(
+                "changelog", what="details->>'status' AS status", id=changelog_id,
+            ).first()
+            status = row and row.status
+            if status not in ("pending", "running"):
+                yield f"event: end\ndata: {status}\n\n"
+                return
+            yield ": keep-alive\n\n"
+
+
+# Stats
+
+@api.route("/stats/db-pool")
+def get_db_pool_stats():
+    """Stats of the database connection pool of the process that serves
+    this request.
+
+    Authenticated endpoint.
+    """
+    if not is_authorized(request):
+        return Unauthorized()
+    return db.pool.get_stats()
+
+
 # Webhooks
 
 @api.route("/projects/<name>/hook/<repo_id>", methods=["POST"])
@@ -292,22 +559,26 @@ def update_user_project_webhook(username, project_name, repo_id):
     if user_project.repo_id != repo_id:
         return Unauthorized("Repo ID mismatch")
 
-    changelog = Changelog(
-        site_id=g.site.id,
-        user_id=user.id,
-        project_id=project.id,
-        action="update_user_project",
-        details={
-            "status": "pending",
-            "user_project_id": user_project.id,
-        }
-    ).save()
-
-    queue.enqueue(
-        update_user_project,
-        site_id=g.site.id,
-        user_project_id=user_project.id,
-        changelog_id=changelog.id,
+    payload = request.get_json(silent=True) or {}
+    push = {
+        "timestamp": datetime.utcnow().isoformat(),
+        "commit": payload.get("after"),
+    }
+    changelog, is_new = user_project.request_update(push=push)
+    assert changelog.id is not None
+
+    if not is_new:
+        if not is_update_job_lost(changelog.id):
+            return {
+                "message": "Push has been added to the pending update of user project "
+                           f"(Project: {project_name}, Username: {username})",
+                "changelog_id": changelog.id,  # debug info
+            }
+        # otherwise the pending update, and this push, would never be applied
+        logger.warning(f"Job of pending update {changelog.id} is lost, enqueueing it again")
+
+    enqueue_update_user_project(
+        site_id=g.site.id, user_project_id=user_project.id, changelog=changelog,
     )
 
     return {
@@ -1,28 +1,31 @@
-from functools import wraps
+import hashlib
+from collections import defaultdict
+from functools import lru_cache, wraps
 
 from flask import (
     Flask,
-    abort, flash, g, redirect, request,
+    abort, flash, g, make_response, redirect, request, session,
     send_from_directory, url_for,
     render_template
 )
 import jinja2
-import markdown
-from kutty import html, Markdown, Optional
+from kutty import html, Optional
 from kutty.html import HTML
 from kutty.bootstrap.hero import Hero, HeroContainer, HeroTitle, HeroSeparator, HeroSubtitle
 from markupsafe import Markup
+from werkzeug.wsgi import wrap_file
 
-from . import config
+from . import config, db
 from .api import api
 from .auth import auth_bp, get_authenticated_user
-from .db import Site
 from .components import (
     AbsoluteCenter, Accordion, AuthNavEntry, Breadcrumb, Card, Form, HiddenInput,
     Layout, LinkWithoutDecoration, LoginButton, LoginCard, Page,
     ProjectHero, ProjectCard, ProjectGrid, ProgressBar, TaskCard, LinkButton,
     SubmitButton
 )
+from .utils import course as course_utils, http_cache, site_cache
+from .utils.markdown_cache import render_markdown
 from .utils.user_project import delete_user_project, start_user_project
 
 app = Flask(__name__)
@@ -30,11 +33,9 @@ app.secret_key = "hello, world!"  # TODO: change this
 app.register_blueprint(api, url_prefix="/api")
 app.register_blueprint(auth_bp, url_prefix="/auth")
 
-md = markdown.Markdown()
-
 @app.template_filter("markdown")
 def markdown_filter(text):
-    return Markup(md.convert(text))
+    return Markup(render_markdown(text))
 
 @app.context_processor
 def template_components():
@@ -42,7 +43,11 @@ def template_components():
         "ProjectTeaser": ProjectTeaser
     }
 
-layout = Layout("Capstone")
+layout = Layout(
+    "Capstone",
+    # the navbar is rendered once per site and logged in state
+    get_navbar_key=lambda: (g.site.id if "site" in g else None, is_authenticated()),
+)
 layout.navbar.add_link("Projects", url="/projects")
 layout.navbar.add_link("Courses", url="/courses")
 layout.navbar.right_entries.add(
@@ -70,10 +75,22 @@ def authenticated(handler):
     return wrapper
 
 
+@app.before_request
+def start_db_session():
+    g.db_session_token = db.start_session()
+
+
+@app.teardown_request
+def end_db_session(exc):
+    token = g.pop("db_session_token", None)
+    if token is not None:
+        db.end_session(token)
+
+
 @app.before_request
 def set_site():
     domain = config.default_site or request.host.split(":")[0]
-    site = Site.find(domain=domain)
+    site = site_cache.get_site(domain)
     if not site:
         page = Page(title="Site not found")
         page << f"The site <em>{domain}</em> is not found."
@@ -100,6 +117,7 @@ def home():
     return layout.render_page(page)
 
 @app.route("/projects")
+@http_cache.conditional(lambda: http_cache.get_projects_validators(g.site, is_published=True))
 def projects():
     projects = g.site.get_projects(is_published=True)
     page = HTML(render_template("projects/index.html", projects=projects))
@@ -149,11 +167,13 @@ def dashboard(user):
 
 
 @app.route("/projects/<name>", methods=["GET"])
+@http_cache.conditional(lambda name: http_cache.get_project_validators(g.site, name))
 def project(name):
     project = g.site.get_project(name=name)
     if project is None:
         abort(404)
 
+    project.prefetch("tasks")
     user = get_authenticated_user()
     user_project = project.get_user_project(user.id) if user else None
 
@@ -201,7 +221,7 @@ def project_task(name, task_num):
     if not user_project:
         return redirect(url_for("project", name=name))
 
-    tasks = project.get_tasks()
+    tasks = project.prefetch("tasks").get_tasks()
     index = task_num-1
     if 0 <= index < len(tasks):
         task = tasks[index]
@@ -221,25 +241,36 @@ def project_history(name, user):
 
     page = Page(title="Project History")
 
-    updates = project.get_history()
+    updates = project.get_history(include_log=False)
     if not updates:
         page << html.em("No updates have been made to this project.")
     else:
-        accordion = Accordion()
-        page << accordion
-
-        for update in updates:
-            accordion.add_card(
-                header=html.div(class_="d-flex justify-content-between").add(
-                    html.div(update["timestamp"].strftime("%a, %B %d %Y, %I:%M %p UTC")),
-                    html.div(update["status"]),
-                ),
-                body=html.pre(update["log"]) if update["log"] else html.em("No logs"),
-            )
+        page << UpdateHistory(
+            updates,
+            get_log_url=lambda update: url_for(
+                "project_history_log", name=name, changelog_id=update["id"],
+            ),
+        )
 
     return layout.render_page(page)
 
 
+@app.route("/projects/<name>/history/<int:changelog_id>/log")
+@authenticated
+def project_history_log(name, changelog_id, user):
+    project = g.site.get_project(name=name)
+    if not project:
+        abort(404)
+
+    changelog = db.Changelog.find(
+        site_id=g.site.id, project_id=project.id, action="update_project",
+        id=changelog_id,
+    )
+    if not changelog:
+        abort(404)
+    return send_changelog_log(changelog)
+
+
 @app.route("/projects/<name>/user/history")
 @authenticated
 def user_project_history(name, user):
@@ -250,37 +281,119 @@ def user_project_history(name, user):
 
     page = Page(title="Project History")
 
-    updates = user_project.get_history()
+    updates = user_project.get_history(include_log=False)
     if not updates:
         page << html.em("No updates have been made to this project.")
     else:
-        accordion = Accordion()
-        page << accordion
-
-        for update in updates:
-            accordion.add_card(
-                header=html.div(class_="d-flex justify-content-between").add(
-                    html.div(update["timestamp"].strftime("%a, %B %d %Y, %I:%M %p UTC")),
-                    html.div(update["status"]),
-                ),
-                body=html.pre(update["log"]) if update["log"] else html.em("No logs"),
-            )
+        page << UpdateHistory(
+            updates,
+            get_log_url=lambda update: url_for(
+                "user_project_history_log", name=name, changelog_id=update["id"],
+            ),
+            get_live_log_url=lambda update: url_for(
+                "api.stream_user_project_log", username=user.username,
+                project_name=name, changelog_id=update["id"],
+            ),
+        )
 
     return layout.render_page(page)
 
 
+@app.route("/projects/<name>/user/history/<int:changelog_id>/log")
+@authenticated
+def user_project_history_log(name, changelog_id, user):
+    project = g.site.get_project(name=name)
+    if not project:
+        abort(404)
+
+    changelog = db.Changelog.find(
+        site_id=g.site.id, project_id=project.id, user_id=user.id,
+        action="update_user_project", id=changelog_id,
+    )
+    if not changelog:
+        abort(404)
+    return send_changelog_log(changelog)
+
+
+def UpdateHistory(updates, get_log_url, get_live_log_url=None):
+    """Accordion of updates. Logs are fetched when a card is opened, and
+    followed while the update runs, see static/history.js.
+    """
+    accordion = Accordion()
+    for update in updates:
+        attrs = {"data_log_url": get_log_url(update)}
+        if get_live_log_url and update["status"] in ("pending", "running"):
+            attrs["data_live_log_url"] = get_live_log_url(update)
+
+        if update["log_size"] or "data_live_log_url" in attrs:
+            body = html.pre("Loading...", class_="update-log", **attrs)
+        else:
+            body = html.em("No logs")
+        accordion.add_card(
+            header=html.div(class_="d-flex justify-content-between").add(
+                html.div(update["timestamp"].strftime("%a, %B %d %Y, %I:%M %p UTC")),
+                html.div(update["status"]),
+            ),
+            body=body,
+        )
+    return html.div(
+        accordion,
+        html.script(src="/static/history.js"),
+    )
+
+
+def send_changelog_log(changelog):
+    """Sends the log of a changelog as text, with support for conditional
+    and range requests.
+    """
+    opened = changelog.open_log()
+    if opened is None:
+        abort(404)
+    f, size = opened
+
+    response = app.response_class(
+        wrap_file(request.environ, f),
+        mimetype="text/plain",
+        direct_passthrough=True,
+    )
+    # a log is saved once, when the update is finished
+    response.set_etag(f"{changelog.id}-{size}")
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request, accept_ranges=True, complete_length=size)
+
+
+def get_courses_validators():
+    count, last_modified = db.find_last_modified("course", site_id=g.site.id)
+    return (
+        ["courses", g.site.id, g.site.last_modified, count, last_modified],
+        http_cache.latest(g.site.last_modified, last_modified),
+    )
+
+
+def get_course_validators(name):
+    # the manifest changes whenever the course is loaded
+    manifest = course_utils.get_manifest(g.site, name)
+    if manifest is None:
+        return None
+    return ["course", g.site.id, g.site.last_modified, name, manifest["version"]], None
+
+
 @app.route("/courses")
+@http_cache.conditional(get_courses_validators)
 def courses():
     courses = g.site.get_courses()
     page = HTML(render_template("courses/index.html", courses=courses))
     return layout.render_page(page)
 
 @app.route("/courses/<name>")
+@http_cache.conditional(get_course_validators)
 def course(name):
     course = g.site.get_course(name)
     if not course:
         abort(404)
 
+    course.prefetch("modules.lessons")
     page = HTML(render_template("courses/course.html", course=course))
     return layout.render_page(page)
 
@@ -295,18 +408,48 @@ def course_media(name, filename):
 
 @app.route("/courses/<name>/lessons/<module_name>/<lesson_name>")
 def course_lesson(name, module_name, lesson_name):
-    course = g.site.get_course(name)
-    if not course:
-        abort(404)
-    module = course.get_module(module_name)
-    if not module:
-        abort(404)
-    lesson = module.get_lesson(lesson_name)
-    if not lesson:
+    manifest = course_utils.get_manifest(g.site, name)
+    if manifest is None:
+        course = g.site.get_course(name)
+        if not course:
+            abort(404)
+        # course loaded before manifests were added
+        manifest = course_utils.write_manifest(course)
+
+    if not course_utils.find_lesson(manifest, module_name, lesson_name):
         abort(404)
 
-    page = HTML(render_template("courses/lesson.html", lesson=lesson, module=module, course=course))
-    return layout.render_page(page)
+    # the page only differs by user in the navbar
+    key = f"{manifest['version']}:{module_name}:{lesson_name}:{session.get('user_id')}"
+    etag = hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+    if etag in request.if_none_match:
+        response = make_response("", 304)
+    else:
+        body = render_lesson(g.site.name, name, manifest["version"], module_name, lesson_name)
+        response = make_response(layout.render_page(HTML(body)))
+
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Cookie")
+    return response
+
+
+@lru_cache(maxsize=256)
+def render_lesson(site_name, course_name, version, module_name, lesson_name):
+    """Renders the body of a lesson page. The version of the course manifest
+    is part of the cache key, so that reloading the course invalidates it.
+    """
+    assert g.site.name == site_name
+    manifest = course_utils.get_manifest(g.site, course_name)
+    module, lesson = course_utils.find_lesson(manifest, module_name, lesson_name)
+    lessons_dir = course_utils.get_site_courses_dir(g.site) / course_name / "lessons"
+    return render_template(
+        "courses/lesson.html",
+        course=manifest,
+        module=module,
+        lesson=lesson,
+        lesson_html=(lessons_dir / lesson["path"]).read_text(),
+    )
 
 
 @app.route("/activity")
@@ -316,24 +459,31 @@ def all_activity(user):
 
     project_section_empty_state = html.div(html.em("No participants have started this project."))
 
+    # participants of each project by name, the matrix is ordered for paging
+    matrix = sorted(
+        g.site.get_progress_matrix(is_published=True),
+        key=lambda progress: (progress["full_name"], progress["user_id"]),
+    )
+    progress_by_project = defaultdict(list)
+    for progress in matrix:
+        progress_by_project[progress["project_id"]].append(progress)
+
     for project in g.site.get_projects(is_published=True):
         project_section = html.div(
             html.h3(project.title), id=project.name, class_="my-3")
         project_activities = html.div(class_="m-3")
 
-        for activity in Activity.find_all(project_id=project.id):
-            user = activity.get_user()
-            progress = activity.get_progress()
+        for progress in progress_by_project[project.id]:
             project_activities << html.div(class_="row").add(
                 html.div(
                     html.a(
-                        user.full_name,
+                        progress["full_name"],
                         " - ",
                         f"{progress['completed_tasks']}/{progress['total_tasks']}",
                         href=url_for(
                             "individual_activity",
-                            username=activity.username,
-                            project_name=activity.project_name),
+                            username=progress["username"],
+                            project_name=progress["project_name"]),
                     ),
                     class_="col-12 col-sm-3 my-auto",
                 ),
@@ -373,7 +523,7 @@ def individual_activity(user, username, project_name):
         html.div(breadcrumbs, class_="container"),
         title=project.title,
         subtitle=project.short_description,
-        text=Markdown(project.description),
+        text=HTML(render_markdown(project.description)),
         app_url=activity.vars.get("app_url"),
     )
     main = html.div(class_="container")
@@ -381,7 +531,7 @@ def individual_activity(user, username, project_name):
     page << hero
     page << main
 
-    for task in project.get_tasks():
+    for task in project.prefetch("tasks.checks").get_tasks():
         task_activity = activity and activity.get_task_activity(task.id)
         main << TaskDetails(
             task,
@@ -395,23 +545,36 @@ def individual_activity(user, username, project_name):
 # Component makers
 
 def ProjectTeaser(project, is_started):
+    return HTML(
+        render_project_teaser(
+            project.name, project.title, project.short_description,
+            tuple(project.tags), is_started,
+        )
+    )
+
+
+@lru_cache(maxsize=1024)
+def render_project_teaser(name, title, short_description, tags, is_started):
+    """Renders a project teaser. Everything shown is part of the cache key,
+    so a changed project gets a new entry.
+    """
     return LinkWithoutDecoration(
         ProjectCard(
-            title=project.title,
-            short_description=project.short_description,
-            tags=project.tags,
+            title=title,
+            short_description=short_description,
+            tags=tags,
             is_started=is_started,
             class_="teaser-card"
         ),
-        href=f"/projects/{project.name}"
-    )
+        href=f"/projects/{name}"
+    ).render()
 
 
 def TaskDetails(task, status, check_statuses=(), description_vars=None):
     card = TaskCard(
         position=task.position,
         title=task.title,
-        text=Markdown(task.render_description(description_vars)),
+        text=HTML(render_markdown(task.render_description(description_vars))),
         status=status,
         collapsible_id=task.name,
         collapsed=False if status == "In Progress" else True,
@@ -111,18 +111,24 @@ def get_fallback_username(user: User) -> str:
 # authentication helpers
 
 def get_authenticated_user():
-    if "user_id" in session:
-        return User.find(id=session["user_id"])
-    else:
-        return None
+    """Returns the logged in user, looked up once per request.
+    """
+    if "authenticated_user" not in g:
+        if "user_id" in session:
+            g.authenticated_user = User.find(id=session["user_id"])
+        else:
+            g.authenticated_user = None
+    return g.authenticated_user
 
 
 def login_user(user_id):
     session["user_id"] = user_id
+    g.pop("authenticated_user", None)
 
 
 def logout_user():
     session.pop("user_id", None)
+    g.pop("authenticated_user", None)
 
 
 # google oauth helpers
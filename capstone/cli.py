@@ -2,8 +2,13 @@ import click
 import sys
 import yaml
 
-from capstone import db, deployment
+from toolkit.db import Schema
+
+from capstone import db, deployment, schema as schema_utils
+from capstone.deployment.watcher import DeploymentWatcher
+from capstone.utils import site_cache
 from capstone.utils.project_maker import create_project
+from capstone.utils.changelog_archive import archive_changelogs
 from capstone.utils.course import load_from_package as load_course_from_package
 
 
@@ -126,6 +131,7 @@ def sites_new(title, name, domain):
     """Create a new site."""
     print("New site", title, name, domain)
     db_site = db.Site(title=title, name=name, domain=domain).save()
+    site_cache.notify_site_changed(domain)
     print(prettify(db_site.get_dict()))
 
 ## PROJECTS
@@ -378,6 +384,12 @@ def deploys_new(site, username, project_name):
     print("Deployment created")
 
 
+@deploys.command("watch")
+def deploys_watch():
+    """Watch deployments in progress and finish their updates."""
+    DeploymentWatcher().run()
+
+
 ## COURSES
 
 @cli.group()
@@ -429,5 +441,41 @@ def courses_delete(site, course_name):
     print(f"Deleted course {course_name}")
 
 
+## CHANGELOG
+
+@cli.group()
+def changelog():
+    """manage the changelog"""
+    pass
+
+
+@changelog.command("archive")
+@click.option("--before", type=click.DateTime(formats=["%Y-%m-%d"]), required=True,
+              help="Archive changelogs older than this date")
+def changelog_archive(before):
+    """Archive and delete old changelogs."""
+    print("Archive changelogs before", before.date())
+    path, count = archive_changelogs(before=before)
+    if path:
+        print(f"Archived {count} changelogs to {path}")
+    else:
+        print("No changelogs to archive")
+
+
+@changelog.command("partition")
+@click.option("--months-ahead", type=int, default=3, show_default=True,
+              help="Number of months to create partitions for")
+def changelog_partition(months_ahead):
+    """Partition the changelog by month, or add partitions for the coming months."""
+    schema = Schema(db.db)
+    if schema_utils.is_changelog_partitioned(schema):
+        print("Adding partitions for the coming months")
+        schema_utils.add_changelog_partitions(schema, months_ahead=months_ahead)
+    else:
+        print("Partitioning changelog by month")
+        schema_utils.partition_changelog(schema, months_ahead=months_ahead)
+    print("Done")
+
+
 if __name__ == "__main__":
     cli()
@@ -38,11 +38,40 @@ def get_style_by_category(category):
 
 
 class Layout(_Layout):
-    def __init__(self, *args, **kwargs):
+    """Layout that renders the page shell only once.
+
+    The shell (head, footer and scripts) is rendered with slots for the
+    navbar and the content, and kept until the title, stylesheets or scripts
+    change. The navbar is rendered once for every value of
+    `get_navbar_key()`, which must change whenever the navbar would render
+    differently, e.g. with the logged in state.
+    """
+    NAVBAR_SLOT = "<!--capstone:navbar-->"
+    CONTENT_SLOT = "<!--capstone:content-->"
+
+    def __init__(self, *args, get_navbar_key=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.footer = Footer()
+        self.get_navbar_key = get_navbar_key or (lambda: None)
+
+        self._shell = None
+        self._shell_key = None
+        self._navbars = {}
 
     def render(self, content=None):
+        head, middle, tail = self.get_shell()
+        return head + self.get_navbar_html() + middle + render_fragment(content) + tail
+
+    def get_shell(self):
+        key = (self.title, tuple(self.stylesheets), tuple(self.javascripts))
+        if self._shell_key != key:
+            head, rest = self.render_shell().split(self.NAVBAR_SLOT)
+            middle, tail = rest.split(self.CONTENT_SLOT)
+            self._shell = (head, middle, tail)
+            self._shell_key = key
+        return self._shell
+
+    def render_shell(self):
         doc = html.Document()
 
         doc.head.add(html.title(self.title))
@@ -50,8 +79,8 @@ class Layout(_Layout):
         for link in self.stylesheets:
             doc.head.add(html.link(rel="stylesheet", href=link))
 
-        doc.body.add(self.navbar)
-        doc.body.add(content)
+        doc.body.add(html.HTML(self.NAVBAR_SLOT))
+        doc.body.add(html.HTML(self.CONTENT_SLOT))
         doc.body.add(self.footer)
 
         for link in self.javascripts:
@@ -59,6 +88,22 @@ class Layout(_Layout):
 
         return doc.render()
 
+    def get_navbar_html(self):
+        key = self.get_navbar_key()
+        navbar_html = self._navbars.get(key)
+        if navbar_html is None:
+            navbar_html = self._navbars[key] = self.navbar.render()
+        return navbar_html
+
+
+def render_fragment(content):
+    if content is None:
+        return ""
+    elif isinstance(content, str):
+        return content
+    else:
+        return content.render()
+
 
 class Footer(BootstrapElement):
     TAG = "footer"
@@ -3,6 +3,15 @@ from pathlib import Path
 
 # TODO: rename to database_url or DATABASE_URL
 db_uri = os.getenv("DATABASE_URL", "postgres:///capstone")
+# connection pool of each process, see utils/dbpool.py
+db_pool_min_size = int(os.getenv("CAPSTONE_DB_POOL_MIN_SIZE", "1"))
+db_pool_max_size = int(os.getenv("CAPSTONE_DB_POOL_MAX_SIZE", "10"))
+db_pool_idle_timeout = float(os.getenv("CAPSTONE_DB_POOL_IDLE_TIMEOUT", "300"))
+db_pool_wait_timeout = float(os.getenv("CAPSTONE_DB_POOL_WAIT_TIMEOUT", "30"))
+db_pool_health_check_interval = float(
+    os.getenv("CAPSTONE_DB_POOL_HEALTH_CHECK_INTERVAL", "30")
+)
+
 redis_url = os.getenv("CAPSTONE_REDIS_URL", "redis://localhost:6379/0")
 
 capstone_api_token = os.getenv("CAPSTONE_API_TOKEN", "test123")
@@ -17,6 +26,18 @@ docker_registry = os.getenv("CAPSTONE_DOCKER_REGISTRY", "localhost:7979")
 # Set this to disable multi-tenancy and always use this site
 default_site = os.getenv("CAPSTONE_DEFAULT_SITE", "")
 
+# seconds to cache the site of a domain, see utils/site_cache.py
+site_cache_ttl = float(os.getenv("CAPSTONE_SITE_CACHE_TTL", "300"))
+site_cache_negative_ttl = float(os.getenv("CAPSTONE_SITE_CACHE_NEGATIVE_TTL", "60"))
+
+# seconds that a CDN or proxy may cache public pages, see utils/http_cache.py
+http_cache_max_age = int(os.getenv("CAPSTONE_HTTP_CACHE_MAX_AGE", "60"))
+
+# Set this to an internal location of nginx that serves the private files
+# directory, to hand downloads of private files over to nginx with
+# X-Accel-Redirect, e.g. "/_private"
+private_files_accel_prefix = os.getenv("CAPSTONE_PRIVATE_FILES_ACCEL_PREFIX", "")
+
 
 # Default Google OAuth Credentials, works only for internal users of Pipal Academy
 DEFAULT_GOOGLE_OAUTH_CLIENT_ID = "184068666662-6f05u07212f7s86vueaba15uihkprmui.apps.googleusercontent.com"
@@ -30,6 +51,18 @@ capstone_test = os.getenv("CAPSTONE_TEST", "0") == "1"
 
 runner_docker_image = os.getenv("CAPSTONE_RUNNER_DOCKER_IMAGE", "capstone-runner")
 runner_capstone_token = os.getenv("CAPSTONE_RUNNER_CAPSTONE_TOKEN", "test123")
+# max number of checks of a task that the runner runs at the same time
+runner_parallelism = int(os.getenv("CAPSTONE_RUNNER_PARALLELISM", "4"))
+runner_check_timeout = float(os.getenv("CAPSTONE_RUNNER_CHECK_TIMEOUT", "60"))
+
+# Set this to "docker" or "subprocess" to grade with long-lived runners, one
+# per project, instead of a new runner for every push. See utils/runner_pool.py
+runner_pool_mode = os.getenv("CAPSTONE_RUNNER_POOL_MODE", "")
+runner_pool_start_timeout = float(os.getenv("CAPSTONE_RUNNER_POOL_START_TIMEOUT", "600"))
+runner_pool_idle_timeout = float(os.getenv("CAPSTONE_RUNNER_POOL_IDLE_TIMEOUT", "3600"))
+runner_pool_job_timeout = float(os.getenv("CAPSTONE_RUNNER_POOL_JOB_TIMEOUT", "600"))
+# disk budget of installed requirements of projects, see utils/check_envs.py
+runner_env_cache_budget_mb = int(os.getenv("CAPSTONE_RUNNER_ENV_CACHE_BUDGET_MB", "5000"))
 runner_devmode_python_executable = os.getenv(
     "CAPSTONE_RUNNER_DEVMODE_PYTHON_EXECUTABLE",
     str(Path(__file__).parent.parent / "venv" / "bin" / "python3")
@@ -47,3 +80,7 @@ github_repository = os.getenv(
 
 custom_deployment_url = os.getenv("CAPSTONE_CUSTOM_DEPLOYMENT_URL", None)
 custom_deployment_token = os.getenv("CAPSTONE_CUSTOM_DEPLOYMENT_TOKEN", None)
+
+# the deployment watcher fails deployments that take longer than this
+deployment_timeout = float(os.getenv("CAPSTONE_DEPLOYMENT_TIMEOUT", "600"))
+deployment_poll_interval = float(os.getenv("CAPSTONE_DEPLOYMENT_POLL_INTERVAL", "5"))
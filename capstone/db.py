@@ -1,27 +1,156 @@
 from __future__ import annotations
 
+import copy
+import gzip
+import hashlib
+import io
+import json
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
 from dataclasses import asdict, dataclass, field, fields as get_fields
 from datetime import datetime
+from functools import wraps
 from pathlib import Path
-from typing import Any, ClassVar, IO, Type, TypeVar
+from typing import Any, Callable, ClassVar, IO, Iterator, Sequence, Type, TypeVar
 
-from web import database
-from web.db import SQLLiteral
+from web.db import SQLLiteral, SQLParam, SQLQuery, reparam, sqlwhere
 from psycopg2.extensions import register_adapter
-from psycopg2.extras import Json
+from psycopg2.extras import Json, RealDictCursor
 
 from . import config
-from .utils import files
+from .utils import files, get_random_string
+from .utils.dbpool import pooled_database
 from .utils import course as course_utils
 
 
-db = database(config.db_uri)
+db = pooled_database(
+    config.db_uri,
+    min_size=config.db_pool_min_size,
+    max_size=config.db_pool_max_size,
+    idle_timeout=config.db_pool_idle_timeout,
+    wait_timeout=config.db_pool_wait_timeout,
+    health_check_interval=config.db_pool_health_check_interval,
+)
 register_adapter(dict, Json)
 
 
 DocumentT = TypeVar("DocumentT", bound="Document")
 
 CURRENT_TIMESTAMP = SQLLiteral("CURRENT_TIMESTAMP at time zone 'utc'")
+DEFAULT = SQLLiteral("DEFAULT")
+
+# keyword arguments of db.where that are not column filters
+QUERY_OPTIONS = {"what", "order", "group", "limit", "offset", "_test"}
+
+# first key of advisory locks on the updates of a user project, to tell them
+# apart from other advisory locks
+UPDATE_USER_PROJECT_LOCK = 1
+
+
+class Session:
+    """Identity map of rows loaded within a single request or job.
+
+    Rows are keyed by `(table_name, id)`, so that a row is fetched from the
+    database at most once while the session is active. Writes made through
+    `Document.save`, `Document.delete` and `upsert` invalidate the affected
+    rows. Other writes, e.g. raw queries, must call `invalidate`.
+    """
+    def __init__(self):
+        self.identity_map: dict[tuple[str, Any], dict[str, Any]] = {}
+
+    def find_all(self, table_name: str, **filters: Any) -> list[dict]:
+        cached = self.lookup(table_name, **filters)
+        if cached is not None:
+            return copy.deepcopy(cached)
+
+        rows = find_all(table_name, **filters)
+        if "what" not in filters:
+            self.add(table_name, rows)
+        return copy.deepcopy(rows)
+
+    def lookup(self, table_name: str, **filters: Any) -> list[dict] | None:
+        """Returns matching rows from the identity map, or None if the
+        query can't be answered without going to the database.
+        """
+        if "id" not in filters or {"what", "group", "offset"} & filters.keys():
+            return None
+
+        row = self.identity_map.get((table_name, filters["id"]))
+        if row is None:
+            return None
+
+        columns = {k: v for k, v in filters.items() if k not in QUERY_OPTIONS}
+        if all(k in row and row[k] == v for k, v in columns.items()):
+            return [row] if filters.get("limit") != 0 else []
+        else:
+            # id is unique, so no other row can match these filters
+            return []
+
+    def add(self, table_name: str, rows: list[dict]) -> None:
+        for row in rows:
+            self.identity_map[(table_name, row["id"])] = row
+
+    def invalidate(self, table_name: str, id: Any) -> None:
+        self.identity_map.pop((table_name, id), None)
+
+    def invalidate_table(self, table_name: str) -> None:
+        for key in [k for k in self.identity_map if k[0] == table_name]:
+            del self.identity_map[key]
+
+
+_current_session: ContextVar[Session | None] = ContextVar(
+    "capstone_db_session", default=None
+)
+
+
+def get_session() -> Session | None:
+    return _current_session.get()
+
+
+def start_session() -> Token:
+    """Starts a new session. The returned token must be passed to
+    `end_session` when the request or job is over.
+    """
+    return _current_session.set(Session())
+
+
+def end_session(token: Token) -> None:
+    _current_session.reset(token)
+
+
+def invalidate(table_name: str, id: Any = None) -> None:
+    """Drops the row with `id`, or all rows of the table, from the identity
+    map of the current session, after writing them with a raw query.
+    """
+    session = get_session()
+    if session is None:
+        return
+    if id is None:
+        session.invalidate_table(table_name)
+    else:
+        session.invalidate(table_name, id)
+
+
+@contextmanager
+def session() -> Iterator[Session]:
+    s = Session()
+    token = _current_session.set(s)
+    try:
+        yield s
+    finally:
+        end_session(token)
+
+
+def with_session(f: Callable) -> Callable:
+    """Decorator to run a function (usually a background job) inside
+    a session.
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        with session():
+            return f(*args, **kwargs)
+    return wrapper
 
 
 @dataclass(kw_only=True)
@@ -31,17 +160,71 @@ class Document:
     _detail_fields: ClassVar[list[str]] = []
     _db_fields: ClassVar[list[str]] = []
 
+    # relation name -> (class name, foreign key in that class's table, order)
+    _relations: ClassVar[dict[str, tuple[str, str, str]]] = {}
+
     id: int | None = None
 
     @classmethod
-    def find_all(cls: Type[DocumentT], **filters: Any) -> list[DocumentT]:
-        rows = find_all(cls._tablename, **filters)
+    def find_all(
+        cls: Type[DocumentT], prefetch: list[str] | None = None, **filters: Any
+    ) -> list[DocumentT]:
+        """Finds all rows matching filters.
+
+        Relations named in `prefetch` (dotted for nested relations, like
+        `"tasks.checks"`) are loaded with one query per level and attached
+        to the returned objects.
+        """
+        session = get_session()
+        if session is not None:
+            rows = session.find_all(cls._tablename, **filters)
+        else:
+            rows = find_all(cls._tablename, **filters)
+        objs = [cls.from_db(row) for row in rows]
+        if prefetch:
+            prefetch_related(objs, prefetch)
+        return objs
+
+    @classmethod
+    def find(
+        cls: Type[DocumentT], prefetch: list[str] | None = None, **filters: Any
+    ) -> DocumentT | None:
+        objs = cls.find_all(prefetch=prefetch, **filters, limit=1)
+        return objs and objs[0] or None
+
+    @classmethod
+    def find_all_in(
+        cls: Type[DocumentT], column: str, values: list[Any], order: str | None = None
+    ) -> list[DocumentT]:
+        """Finds all rows where `column` is one of `values`, in a single query.
+        """
+        rows = find_all_in(cls._tablename, column, values, order=order)
+        session = get_session()
+        if session is not None:
+            session.add(cls._tablename, rows)
+            rows = copy.deepcopy(rows)
         return [cls.from_db(row) for row in rows]
 
     @classmethod
-    def find(cls: Type[DocumentT], **filters: Any) -> DocumentT | None:
-        row = find(cls._tablename, **filters)
-        return row and cls.from_db(row) or None
+    def find_page(
+        cls: Type[DocumentT], after: int | None = None, limit: int | None = None,
+        **filters: Any
+    ) -> list[DocumentT]:
+        """Finds rows matching filters, ordered by id and starting after the
+        id `after`. This is keyset pagination, so the cost of a page doesn't
+        depend on how far into the table it is.
+        """
+        rows = find_page(cls._tablename, after=after, limit=limit, **filters)
+        return [cls.from_db(row) for row in rows]
+
+    @classmethod
+    def iter_all(cls: Type[DocumentT], **filters: Any) -> Iterator[DocumentT]:
+        """Yields all rows matching filters, ordered by id, from a server-side
+        cursor. Rows are not added to the session.
+        """
+        query, vars = build_select(cls._tablename, **filters)
+        for row in iter_query(query + " ORDER BY id", vars=vars):
+            yield cls.from_db(row)
 
     @classmethod
     def find_or_fail(cls: Type[DocumentT], **filters: Any) -> DocumentT:
@@ -55,13 +238,23 @@ class Document:
         return self
 
     def save(self: DocumentT) -> DocumentT:
-        field_names = get_fields(self)
+        field_names = [f.name for f in get_fields(self)]
         fields = self.to_db()
         if "last_modified" in field_names:
             fields.update({"last_modified": CURRENT_TIMESTAMP})
-        id = int(save(self._tablename, **fields))
-        self.refresh(id=id)
-        return self
+        row = save(self._tablename, **fields)
+        self._invalidate(row["id"])
+        return self.update(**self.from_db(row).get_dict())
+
+    @classmethod
+    def save_many(cls: Type[DocumentT], objs: list[DocumentT]) -> list[DocumentT]:
+        """Inserts objs, which must not be saved yet, with a single query.
+        """
+        assert all(obj.id is None for obj in objs), "objects must be new"
+        rows = insert_many(cls._tablename, [obj.to_db() for obj in objs])
+        for obj, row in zip(objs, rows):
+            obj.update(**cls.from_db(row).get_dict())
+        return objs
 
     def refresh(self: DocumentT, id: int | None = None) -> DocumentT:
         id = id if id is not None else self.id
@@ -70,8 +263,28 @@ class Document:
         return self.update(**fresh.get_dict())
 
     def delete(self: DocumentT) -> int:
+        self._invalidate(self.id)
         return delete(self._tablename, id=self.id)
 
+    def _invalidate(self: DocumentT, id: int | None) -> None:
+        if id is not None:
+            invalidate(self._tablename, id)
+
+    # prefetched relations
+
+    def prefetch(self: DocumentT, *paths: str) -> DocumentT:
+        prefetch_related([self], list(paths))
+        return self
+
+    def get_prefetched(self: DocumentT, name: str) -> list[Any] | None:
+        return vars(self).get("_prefetched", {}).get(name)
+
+    def set_prefetched(self: DocumentT, name: str, objs: list[Any]) -> None:
+        vars(self).setdefault("_prefetched", {})[name] = objs
+
+    def clear_prefetched(self: DocumentT, name: str) -> None:
+        vars(self).get("_prefetched", {}).pop(name, None)
+
     # generic get_dict
 
     def get_dict(self: DocumentT) -> dict[str, Any]:
@@ -183,11 +396,121 @@ class Site(Document):
             raise Exception(f"User not found: id={id}")
         return user
 
-    def get_user_projects(self) -> list[UserProject]:
-        user_projects = []
-        for user in self.get_users():
-            user_projects.extend(user.get_user_projects())
-        return user_projects
+    def get_user_projects(
+        self, after: int | None = None, limit: int | None = None,
+    ) -> list[UserProject]:
+        """Returns user projects of all users of this site, ordered by id.
+
+        `after` and `limit` can be used to fetch one page at a time.
+        """
+        query, vars = self._user_projects_query(after=after, limit=limit)
+        return [UserProject.from_db(dict(row)) for row in db.query(query, vars=vars)]
+
+    def _user_projects_query(
+        self, after: int | None = None, limit: int | None = None,
+    ) -> tuple[str, dict[str, Any]]:
+        assert self.id is not None
+        conditions = ["u.site_id = $site_id"]
+        if after is not None:
+            conditions.append("up.id > $after")
+
+        query = f"""
+            SELECT up.*
+            FROM user_project up
+            JOIN user_account u ON u.id = up.user_id
+            WHERE {" AND ".join(conditions)}
+            ORDER BY up.id
+        """
+        if limit is not None:
+            query += " LIMIT $limit"
+        return query, {"site_id": self.id, "after": after, "limit": limit}
+
+    def get_progress_matrix(
+        self,
+        project_id: int | None = None,
+        is_published: bool | None = None,
+        after: int | None = None,
+        limit: int | None = None,
+    ) -> list[dict[str, Any]]:
+        """Returns progress of every user on every project they have started,
+        computed with a single grouped query over user_task_status.
+
+        Rows are ordered by user_project_id. `after` and `limit` can be used
+        to fetch one page at a time.
+
+        Each row is a dict with the following keys:
+        - user_project_id, git_url, app_url
+        - user_id, username, full_name
+        - project_id, project_name, project_title
+        - total_tasks, completed_tasks, failing_tasks, percentage, status
+        """
+        query, vars = self._progress_matrix_query(
+            project_id=project_id, is_published=is_published,
+            after=after, limit=limit,
+        )
+        return [get_progress(dict(row)) for row in db.query(query, vars=vars)]
+
+    def iter_progress_matrix(
+        self,
+        project_id: int | None = None,
+        is_published: bool | None = None,
+    ) -> Iterator[dict[str, Any]]:
+        """Like `get_progress_matrix`, but streams rows from a server-side
+        cursor instead of loading all of them in memory.
+        """
+        query, vars = self._progress_matrix_query(
+            project_id=project_id, is_published=is_published,
+        )
+        for row in iter_query(query, vars=vars):
+            yield get_progress(row)
+
+    def _progress_matrix_query(
+        self,
+        project_id: int | None = None,
+        is_published: bool | None = None,
+        after: int | None = None,
+        limit: int | None = None,
+    ) -> tuple[str, dict[str, Any]]:
+        assert self.id is not None
+        conditions = ["p.site_id = $site_id"]
+        if project_id is not None:
+            conditions.append("p.id = $project_id")
+        if is_published is not None:
+            conditions.append("p.is_published = $is_published")
+        if after is not None:
+            conditions.append("up.id > $after")
+
+        query = f"""
+            WITH task_count AS (
+                SELECT project_id, count(*) AS total_tasks
+                FROM task
+                GROUP BY project_id
+            )
+            SELECT
+                up.id AS user_project_id, up.git_url, up.app_settings,
+                u.id AS user_id, u.username, u.full_name,
+                p.id AS project_id, p.name AS project_name, p.title AS project_title,
+                coalesce(tc.total_tasks, 0) AS total_tasks,
+                count(uts.id) FILTER (WHERE uts.status = 'Completed') AS completed_tasks,
+                count(uts.id) FILTER (WHERE uts.status = 'Failing') AS failing_tasks
+            FROM user_project up
+            JOIN user_account u ON u.id = up.user_id
+            JOIN project p ON p.id = up.project_id
+            LEFT JOIN task_count tc ON tc.project_id = p.id
+            LEFT JOIN user_task_status uts ON uts.user_project_id = up.id
+            WHERE {" AND ".join(conditions)}
+            GROUP BY up.id, u.id, p.id, tc.total_tasks
+            ORDER BY up.id
+        """
+        if limit is not None:
+            query += " LIMIT $limit"
+        return query, {
+            "site_id": self.id,
+            "project_id": project_id,
+            "is_published": is_published,
+            "after": after,
+            "limit": limit,
+        }
 
     def get_user_project_by_id(self, id: int) -> UserProject | None:
         user_project = UserProject.find(id=id)
@@ -256,14 +579,18 @@ class Site(Document):
         else:
             return f"https://{self.domain}"
 
-    def save_private_file(self, key: str, stream: IO[bytes]) -> None:
+    def save_private_file(
+        self, key: str, stream: IO[bytes],
+        check: Callable[[Path], None] | None = None,
+    ) -> files.SavedFile:
         """
         Possible errors:
         - capstone.utils.files.InvalidKey
         - capstone.utils.files.FileNotFound
+        - any error raised by check
         """
         assert self.id is not None
-        files.save_private_file(key=f"{self.id}/{key}", stream=stream)
+        return files.save_private_file(key=f"{self.id}/{key}", stream=stream, check=check)
 
     def get_private_file(self, key: str) -> IO[bytes]:
         """
@@ -274,6 +601,15 @@ class Site(Document):
         assert self.id is not None
         return files.get_private_file(key=f"{self.id}/{key}")
 
+    def get_private_file_etag(self, key: str) -> str:
+        """
+        Possible errors:
+        - capstone.utils.files.InvalidKey
+        - capstone.utils.files.FileNotFound
+        """
+        assert self.id is not None
+        return files.get_private_file_etag(key=f"{self.id}/{key}")
+
     def get_private_file_path(self, key: str) -> Path:
         """
         This file should not be edited or deleted.
@@ -305,6 +641,7 @@ class Project(Document):
         # private:
         "repo_id", "git_url"
     ]
+    _relations = {"tasks": ("Task", "project_id", "position")}
 
     site_id: int
     name: str
@@ -341,6 +678,9 @@ class Project(Document):
             return super().delete()
 
     def get_detail(self) -> dict[str, Any]:
+        if self.get_prefetched("tasks") is None:
+            self.prefetch("tasks.checks")
+
         d = super().get_detail()
         d["tasks"] = [t.get_detail() for t in self.get_tasks()]
         return d
@@ -349,6 +689,9 @@ class Project(Document):
         return Site.find_or_fail(id=self.site_id)
 
     def get_tasks(self) -> list[Task]:
+        tasks = self.get_prefetched("tasks")
+        if tasks is not None:
+            return tasks
         return Task.find_all(project_id=self.id, order="position")
 
     def create_task(
@@ -373,6 +716,7 @@ class Project(Document):
             assert all(k in task for k in required_fields), \
                 f"task {task} is missing required fields"
 
+        self.clear_prefetched("tasks")
         with db.transaction():
             new_tasks = {t["name"]: t for t in task_inputs}
             old_tasks = {t.name: t for t in self.get_tasks()}
@@ -383,15 +727,16 @@ class Project(Document):
             for name in to_delete:
                 old_tasks[name].delete()
 
+            created = []
             for i, name in enumerate(new_tasks):
                 if name in to_create:
-                    self.create_task(
+                    created.append(Task(
                         position=i,
                         name=name,
                         title=new_tasks[name]["title"],
                         description=new_tasks[name]["description"],
-                        checks=new_tasks[name]["checks"],
-                    )
+                        project_id=self.id,
+                    ))
                 else:
                     old_tasks[name].update(
                         position=i,
@@ -399,6 +744,25 @@ class Project(Document):
                         description=new_tasks[name]["description"],
                     ).save().update_checks(new_tasks[name]["checks"])
 
+            # checks of all new tasks are inserted together
+            Task.save_many(created)
+            checks: list[TaskCheck] = []
+            for created_task in created:
+                assert created_task.id is not None
+                checks.extend(
+                    TaskCheck(
+                        name=check_dict["name"],
+                        title=check_dict["title"],
+                        args=check_dict["args"],
+                        task_id=created_task.id,
+                        position=j,
+                    )
+                    for j, check_dict in enumerate(
+                        unique_checks(new_tasks[created_task.name]["checks"])
+                    )
+                )
+            TaskCheck.save_many(checks)
+
         return self.get_tasks()
 
     def delete_tasks(self) -> int:
@@ -406,11 +770,26 @@ class Project(Document):
         for task in self.get_tasks():
             count += task.delete()
 
+        self.clear_prefetched("tasks")
         return count
 
     def get_user_projects(self) -> list[UserProject]:
         return UserProject.find_all(project_id=self.id)
 
+    def get_checks_hash(self) -> str:
+        """Hash of the definitions of all tasks and checks of the project.
+        """
+        if self.get_prefetched("tasks") is None:
+            self.prefetch("tasks.checks")
+
+        checks = [
+            [task.name, [[c.name, c.args] for c in task.get_checks()]]
+            for task in self.get_tasks()
+        ]
+        return hashlib.sha256(
+            json.dumps(checks, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
     def get_user_project(self, user_id: int) -> UserProject | None:
         return UserProject.find(user_id=user_id, project_id=self.id)
 
@@ -425,20 +804,15 @@ class Project(Document):
         """
         return f"projects/{self.name}/repo.zip"
 
-    def get_history(self) -> list[dict[str, Any]]:
-        """Return a list of updates for this project.
+    def get_history(
+        self, status: str | None = None, include_log: bool = True
+    ) -> list[dict[str, Any]]:
+        """Return a list of updates for this project, latest first.
         """
-        updates = self.get_site().get_changelogs(
-            project_id=self.id, action="update_project",
+        return find_history(
+            site_id=self.site_id, project_id=self.id, action="update_project",
+            status=status, include_log=include_log,
         )
-        return [
-            {
-                "timestamp": update.timestamp,
-                "status": update.details["status"],
-                "log": update.details.get("log", ""),
-            }
-            for update in updates
-        ]
 
     def publish(self):
         self.is_published = True
@@ -452,9 +826,11 @@ class Project(Document):
 class Task(Document):
     _tablename = "task"
     _db_fields = [
-            "id", "project_id", "position", "name", "title", "description"]
+            "id", "project_id", "position", "name", "title", "description",
+            "last_modified"]
     _teaser_fields = ["name", "title", "description"]
     _detail_fields = ["name", "title", "description"]
+    _relations = {"checks": ("TaskCheck", "task_id", "position")}
 
     project_id: int
     position: int
@@ -462,6 +838,9 @@ class Task(Document):
     title: str
     description: str
 
+    # also changed when checks of the task are changed, see Project.update_tasks
+    last_modified: datetime | None = None
+
     def get_project(self) -> Project:
         return Project.find_or_fail(id=self.project_id)
 
@@ -491,20 +870,22 @@ class Task(Document):
         for check in self.get_checks():
             count += check.delete()
 
+        self.clear_prefetched("checks")
         return count
 
     def get_checks(self) -> list[TaskCheck]:
-        return TaskCheck.find_all(task_id=self.id)
+        checks = self.get_prefetched("checks")
+        if checks is not None:
+            return checks
+        return TaskCheck.find_all(task_id=self.id, order="position")
 
     def update_checks(
             self, check_inputs: list[dict[str, Any]]) -> list[TaskCheck]:
         assert self.id is not None, "task must be saved before adding checks"
 
-        # each element of checks list has three keys: name, title, args
-        required_fields = ["name", "title", "args"]
-
+        self.clear_prefetched("checks")
         with db.transaction():
-            new_checks = {HashableCheck(name=t["name"], title=t["title"], args=t["args"]): t for t in check_inputs}
+            new_checks = {HashableCheck(name=t["name"], title=t["title"], args=t["args"]): t for t in unique_checks(check_inputs)}
             old_checks = {HashableCheck(name=t.name, title=t.title, args=t.args): t for t in self.get_checks()}
 
             to_delete = [t for t in old_checks if t not in new_checks]
@@ -513,18 +894,20 @@ class Task(Document):
             for check_hash in to_delete:
                 old_checks[check_hash].delete()
 
+            created = []
             for i, check_hash in enumerate(new_checks):
                 check_dict = new_checks[check_hash]
                 if check_hash in to_create:
-                    check = TaskCheck(
+                    created.append(TaskCheck(
                         name=check_dict["name"],
                         title=check_dict["title"],
                         args=check_dict["args"],
                         task_id=self.id,
-                        position=i).save()
+                        position=i))
                 else:
                     check = old_checks[check_hash]
                     check.update(title=check_dict["title"], position=i).save()
+            TaskCheck.save_many(created)
 
         return self.get_checks()
 
@@ -611,6 +994,8 @@ class UserProject(Document):
     def delete(self):
         for task_status in self.get_task_statuses():
             task_status.delete()
+        db.delete("grading_result", where="user_project_id=$id", vars={"id": self.id})
+        invalidate("grading_result")
         return super().delete()
 
     def get_detail(self) -> dict[str, Any]:
@@ -677,6 +1062,55 @@ class UserProject(Document):
             user_task_status.save()
         return user_task_status
 
+    def apply_check_results(self, task_results: list[dict[str, Any]]) -> None:
+        """Writes statuses of tasks and checks from results of the runner,
+        with a constant number of queries.
+
+        task_results are in the order of tasks, and may stop before the last
+        task, like `result["tasks"]` of `utils.user_project.run_checks`.
+        """
+        tasks = self.get_project().prefetch("tasks.checks").get_tasks()
+        graded = list(zip(tasks, task_results))
+        for task, task_result in graded:
+            assert len(task.get_checks()) == len(task_result["checks"]), \
+                "check results are missing"
+
+        with db.transaction():
+            task_status_rows = upsert(
+                "user_task_status",
+                [
+                    {
+                        "user_project_id": self.id,
+                        "task_id": task.id,
+                        "status": compute_task_status(
+                            [c["status"] for c in task_result["checks"]]
+                        ),
+                    }
+                    for task, task_result in graded
+                ],
+                conflict=["user_project_id", "task_id"],
+                update=["status"],
+            )
+            task_status_ids = {row["task_id"]: row["id"] for row in task_status_rows}
+
+            upsert(
+                "user_check_status",
+                [
+                    {
+                        "user_task_status_id": task_status_ids[task.id],
+                        "task_check_id": check.id,
+                        "status": check_result["status"],
+                        "message": check_result["message"],
+                    }
+                    for task, task_result in graded
+                    for check, check_result in zip(task.get_checks(), task_result["checks"])
+                ],
+                conflict=["user_task_status_id", "task_check_id"],
+                update=["status", "message"],
+            )
+
+            self.set_in_progress_task()
+
     def set_in_progress_task(self):
         task_statuses = self.get_task_statuses()
         if task_statuses:
@@ -707,22 +1141,155 @@ class UserProject(Document):
         site_url = site.get_url()
         return f"{site_url}/api/users/{user.username}/projects/{project.name}/hook/{self.repo_id}"
 
-    def get_history(self) -> list[dict[str, Any]]:
-        """Return a list of updates for this user project.
+    def get_history(
+        self, status: str | None = None, include_log: bool = True
+    ) -> list[dict[str, Any]]:
+        """Return a list of updates for this user project, latest first.
         """
-        updates = self.get_site().get_changelogs(
+        return find_history(
+            site_id=self.get_project().site_id,
             project_id=self.project_id,
             user_id=self.user_id,
             action="update_user_project",
+            status=status,
+            include_log=include_log,
         )
-        return [
-            {
-                "timestamp": update.timestamp,
-                "status": update.details["status"],
-                "log": update.details.get("log", ""),
+
+    # grading results, to not grade the same commit with the same checks twice
+
+    def get_grading_result(
+        self, user_commit: str, project_commit: str, checks_hash: str
+    ) -> GradingResult | None:
+        return GradingResult.find(
+            user_project_id=self.id,
+            user_commit=user_commit,
+            project_commit=project_commit,
+            checks_hash=checks_hash,
+        )
+
+    def save_grading_result(
+        self, user_commit: str, project_commit: str, checks_hash: str,
+        result: dict[str, Any],
+    ) -> None:
+        db.query(
+            """
+            INSERT INTO grading_result
+                (user_project_id, user_commit, project_commit, checks_hash, result)
+            VALUES ($id, $user_commit, $project_commit, $checks_hash, $result)
+            ON CONFLICT (user_project_id, user_commit, project_commit, checks_hash)
+            DO UPDATE SET result = excluded.result
+            """,
+            vars={
+                "id": self.id,
+                "user_commit": user_commit,
+                "project_commit": project_commit,
+                "checks_hash": checks_hash,
+                "result": result,
+            },
+        )
+        invalidate("grading_result")
+
+    # updates (see update_user_project in tasks.py)
+
+    def request_update(self, push: dict[str, Any]) -> tuple[Changelog, bool]:
+        """Records a push, and returns the changelog of the update that
+        will include it, and whether that update is new and needs a job.
+
+        Pushes are coalesced. While an update is pending, pushes are added
+        to it. While one is running, a single follow-up update is created,
+        and later pushes are added to that one until it starts.
+        """
+        with db.transaction():
+            self.lock_updates()
+
+            pending = self.get_updates(status="pending")
+            if pending:
+                changelog = pending[-1]
+                changelog.details.setdefault("pushes", []).append(push)
+                changelog.save()
+                return changelog, False
+
+            running = self.get_updates(status="running")
+            details = {
+                "status": "pending",
+                "user_project_id": self.id,
+                "pushes": [push],
             }
-            for update in updates
-        ]
+            if running:
+                details["follows"] = running[-1].id
+
+            changelog = Changelog(
+                site_id=self.get_project().site_id,
+                user_id=self.user_id,
+                project_id=self.project_id,
+                action="update_user_project",
+                details=details,
+            ).save()
+            return changelog, True
+
+    def start_update(self, changelog_id: int) -> Changelog | None:
+        """Marks a pending update as running. Pushes after this get
+        a follow-up update.
+
+        Returns None, without starting it, if the update isn't pending, or
+        if an earlier update that deployed the app is still running. The
+        update is started again when that one is finished.
+        """
+        with db.transaction():
+            self.lock_updates()
+
+            pending = self.get_updates(status="pending")
+            changelog = next((c for c in pending if c.id == changelog_id), None)
+            if changelog is None:
+                return None
+            # deployed updates finish in another job, see finish_deployment
+            if self.has_running_deployment():
+                return None
+
+            changelog.details["status"] = "running"
+            return changelog.save()
+
+    def get_updates(self, status: str | None = None) -> list[Changelog]:
+        """Returns changelogs of updates, oldest first. Always reads from
+        the database, as pending updates are changed by other processes.
+        """
+        where = (
+            "action = 'update_user_project'"
+            " AND (details->>'user_project_id')::int = $id"
+        )
+        if status is not None:
+            where += " AND details->>'status' = $status"
+        rows = db.select(
+            "changelog", where=where, vars={"id": self.id, "status": status},
+            order="id",
+        )
+        return [Changelog.from_db(dict(row)) for row in rows]
+
+    def has_running_deployment(self) -> bool:
+        """Whether a running update has submitted a deployment of the app.
+        """
+        row = db.select(
+            "changelog",
+            what="1",
+            where=(
+                "action = 'update_user_project'"
+                " AND (details->>'user_project_id')::int = $id"
+                " AND details->>'status' = 'running'"
+                " AND details->'deployment' IS NOT NULL"
+            ),
+            vars={"id": self.id},
+            limit=1,
+        ).first()
+        return row is not None
+
+    def lock_updates(self) -> None:
+        """Locks updates of this user project until the end of the
+        current transaction.
+        """
+        db.query(
+            "SELECT pg_advisory_xact_lock($key, $id)",
+            vars={"key": UPDATE_USER_PROJECT_LOCK, "id": self.id},
+        )
 
 
 @dataclass(kw_only=True)
@@ -784,12 +1351,7 @@ class UserTaskStatus(Document):
         check_statuses = self.get_check_statuses()
         assert len(task.get_checks()) == len(check_statuses), "check statuses are missing"
 
-        if all(cs.status == "pass" for cs in check_statuses):
-            return "Completed"
-        elif any(cs.status == "fail" or cs.status == "error" for cs in check_statuses):
-            return "Failing"
-        else:
-            return "Pending"
+        return compute_task_status([cs.status for cs in check_statuses])
 
 
 @dataclass(kw_only=True)
@@ -812,6 +1374,23 @@ class UserCheckStatus(Document):
         return UserTaskStatus.find_or_fail(id=self.user_task_status_id)
 
 
+@dataclass(kw_only=True)
+class GradingResult(Document):
+    _tablename = "grading_result"
+    _db_fields = [
+        "id", "user_project_id", "user_commit", "project_commit", "checks_hash",
+        "result", "created",
+    ]
+
+    user_project_id: int
+    user_commit: str
+    project_commit: str
+    checks_hash: str
+    result: dict[str, Any]
+
+    created: datetime | None = None
+
+
 @dataclass(kw_only=True)
 class Changelog(Document):
     _tablename = "changelog"
@@ -842,6 +1421,71 @@ class Changelog(Document):
         else:
             return None
 
+    def get_log_file_key(self) -> str:
+        """`utils.files` module should be used with this key.
+        """
+        return f"changelogs/{self.id}/log.gz"
+
+    def set_log(self, log: str) -> None:
+        """Saves the log, compressed, as a private file of the site. Only
+        the key of the file and the size of the log are kept in details.
+        The changelog must be saved after this.
+        """
+        assert self.id is not None
+        data = log.encode("utf-8")
+        key = self.get_log_file_key()
+        self.get_site().save_private_file(key, io.BytesIO(gzip.compress(data)))
+        self.details.pop("log", None)
+        self.details["log_file"] = key
+        self.details["log_size"] = len(data)
+
+    def open_log(self) -> tuple[gzip.GzipFile | io.BytesIO, int] | None:
+        """Returns the log, uncompressed, as a binary file, and its size
+        in bytes, or None if there is no log. The file is seekable.
+
+        Logs of old changelogs are still inline in details.
+        """
+        if "log_file" in self.details:
+            f = self.get_site().get_private_file(self.details["log_file"])
+            return gzip.GzipFile(fileobj=f, mode="rb"), int(self.details["log_size"])
+        elif self.details.get("log"):
+            data = self.details["log"].encode("utf-8")
+            return io.BytesIO(data), len(data)
+        else:
+            return None
+
+    def get_log(self) -> str:
+        opened = self.open_log()
+        if opened is None:
+            return ""
+        f, _ = opened
+        with f:
+            return f.read().decode("utf-8")
+
+    def is_deploying(self) -> bool:
+        """Whether this is an update whose deployment has been submitted
+        and is waiting for the deployment watcher.
+        """
+        return (
+            self.details.get("status") == "running" and
+            self.details.get("stage") == "deployment" and
+            "deployment" in self.details
+        )
+
+    @classmethod
+    def find_deploying(cls) -> list[Changelog]:
+        rows = db.select(
+            "changelog",
+            where=(
+                "action = 'update_user_project'"
+                " AND details->>'status' = 'running'"
+                " AND details->>'stage' = 'deployment'"
+                " AND details->'deployment' IS NOT NULL"
+            ),
+            order="id",
+        )
+        return [cls.from_db(dict(row)) for row in rows]
+
 
 @dataclass(kw_only=True)
 class Course(Document):
@@ -849,6 +1493,7 @@ class Course(Document):
     _teaser_fields = ["name", "title", "description"]
     _detail_fields = ["id", "name", "title", "description", "created", "last_modified"]  # + ["modules"]
     _db_fields = ["id", "site_id", "name", "title", "description", "created", "last_modified"]
+    _relations = {"modules": ("Module", "course_id", "position")}
 
     site_id: int
     name: str
@@ -862,9 +1507,13 @@ class Course(Document):
         with db.transaction():
             for module in self.get_modules():
                 module.delete()
+            course_utils.delete_manifest(self)
             return super().delete()
 
     def get_detail(self):
+        if self.get_prefetched("modules") is None:
+            self.prefetch("modules.lessons")
+
         d = super().get_detail()
         d["modules"] = [m.get_detail() for m in self.get_modules()]
         return d
@@ -888,7 +1537,10 @@ class Course(Document):
         return Module.find(course_id=self.id, position=position)
 
     def get_modules(self) -> list[Module]:
-        return Module.find_all(course_id=self.id)
+        modules = self.get_prefetched("modules")
+        if modules is not None:
+            return modules
+        return Module.find_all(course_id=self.id, order="position")
 
     def update_modules(self, module_inputs: list[dict[str, Any]]) -> list[Module]:
         assert self.id is not None
@@ -898,6 +1550,7 @@ class Course(Document):
             assert all(k in module for k in required_fields), \
                 f"module {module} is missing required fields"
 
+        self.clear_prefetched("modules")
         with db.transaction():
             new_modules = {t["name"]: t for t in module_inputs}
             old_modules = {t.name: t for t in self.get_modules()}
@@ -938,6 +1591,7 @@ class Course(Document):
 class Module(Document):
     _tablename = "module"
     _db_fields = ["id", "course_id", "name", "title", "position", "created", "last_modified"]
+    _relations = {"lessons": ("Lesson", "module_id", "position")}
 
     course_id: int
     name: str
@@ -976,6 +1630,10 @@ class Module(Document):
         return Lesson(module_id=self.id, position=position, name=name, title=title, path=path).save()
 
     def get_lessons(self, **kwargs) -> list[Lesson]:
+        lessons = self.get_prefetched("lessons")
+        if lessons is not None and not kwargs:
+            return lessons
+        kwargs.setdefault("order", "position")
         return Lesson.find_all(module_id=self.id, **kwargs)
 
     def update_lessons(self, lesson_inputs: list[dict[str, Any]]) -> list[Lesson]:
@@ -986,6 +1644,7 @@ class Module(Document):
             assert all(k in lesson for k in required_fields), \
                 f"lesson {lesson} is missing required fields"
 
+        self.clear_prefetched("lessons")
         with db.transaction():
             new_lessons = {t["name"]: t for t in lesson_inputs}
             old_lessons = {t.name: t for t in self.get_lessons()}
@@ -996,20 +1655,23 @@ class Module(Document):
             for name in to_delete:
                 old_lessons[name].delete()
 
+            created = []
             for i, name in enumerate(new_lessons):
                 if name in to_create:
-                    self.create_lesson(
+                    created.append(Lesson(
+                        module_id=self.id,
                         position=i,
                         name=name,
                         title=new_lessons[name]["title"],
                         path=new_lessons[name]["path"],
-                    )
+                    ))
                 else:
                     old_lessons[name].update(
                         position=i,
                         title=new_lessons[name]["title"],
                         path=new_lessons[name]["path"],
                     ).save()
+            Lesson.save_many(created)
 
         return self.get_lessons()
 
@@ -1093,15 +1755,229 @@ def find(table_name: str, **filters: Any) -> dict | None:
     return rows and rows[0] or None
 
 
-def save(table_name: str, _pk_field: str = "id", **fields: Any) -> Any:
+def find_all_in(
+    table_name: str, column: str, values: list[Any], order: str | None = None
+) -> list[dict]:
+    if not values:
+        return []
+    rows = db.select(
+        table_name,
+        where=f"{column} IN $values",
+        vars={"values": list(values)},
+        order=order,
+    )
+    return [dict(row) for row in rows]
+
+
+def build_select(table_name: str, **filters: Any) -> tuple[str, dict[str, Any]]:
+    conditions = [f"{column} = ${column}" for column in filters]
+    query = f"SELECT * FROM {table_name}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    return query, filters
+
+
+def find_page(
+    table_name: str, after: int | None = None, limit: int | None = None,
+    **filters: Any
+) -> list[dict]:
+    conditions = [f"{column} = ${column}" for column in filters]
+    if after is not None:
+        conditions.append("id > $_after")
+
+    rows = db.select(
+        table_name,
+        where=" AND ".join(conditions) or None,
+        vars=dict(filters, _after=after),
+        order="id",
+        limit=limit,
+    )
+    return [dict(row) for row in rows]
+
+
+def find_last_modified(table_name: str, **filters: Any) -> tuple[int, datetime | None]:
+    """Returns the number of matching rows and the last time any of them was
+    modified. Either changes when a row is added, deleted or saved.
+    """
+    row = db.where(
+        table_name, what="count(*) AS count, max(last_modified) AS last_modified",
+        **filters,
+    )[0]
+    return row.count, row.last_modified
+
+
+def find_history(
+    action: str, status: str | None = None, include_log: bool = True,
+    **filters: Any
+) -> list[dict]:
+    """Returns updates from the changelog, latest first, with only the
+    fields shown in histories. The status is filtered, and the fields are
+    extracted, by the database, so that the rest of details isn't fetched.
+
+    Without `include_log`, only `log_size` tells the size of each log in
+    bytes. Logs saved with `Changelog.set_log` are not in details, and are
+    never included.
+    """
+    what = (
+        "id, timestamp, details->>'status' AS status,"
+        " coalesce(details->'pushes', '[]'::jsonb) AS pushes,"
+        " coalesce((details->>'log_size')::int, octet_length(details->>'log'), 0) AS log_size"
+    )
+    if include_log:
+        what += ", coalesce(details->>'log', '') AS log"
+
+    conditions = [f"{column} = ${column}" for column in filters]
+    conditions.append("action = $action")
+    if status is not None:
+        conditions.append("details->>'status' = $status")
+
+    rows = db.select(
+        "changelog",
+        what=what,
+        where=" AND ".join(conditions),
+        vars=dict(filters, action=action, status=status),
+        order="timestamp desc, id desc",
+    )
+    return [dict(row) for row in rows]
+
+
+def iter_query(query: str, vars: dict[str, Any], itersize: int = 500) -> Iterator[dict]:
+    """Yields rows of a query from a server-side (named) cursor, fetching
+    `itersize` rows per round trip.
+
+    Named cursors only live inside a transaction, so the transaction is kept
+    open until the generator is exhausted or closed.
+    """
+    sql_query = reparam(query, vars)
+    with db.transaction():
+        connection = db._getctx().db
+        cursor_name = f"iter_{get_random_string(length=12).lower()}"
+        with connection.cursor(name=cursor_name, cursor_factory=RealDictCursor) as cursor:
+            cursor.itersize = itersize
+            cursor.execute(sql_query.query(), sql_query.values())
+            for row in cursor:
+                yield dict(row)
+
+
+def prefetch_related(objs: Sequence[Document], paths: list[str]) -> None:
+    """Loads relations for all objs and attaches them to each object.
+
+    Each path is a dotted list of relation names, like `"tasks.checks"`.
+    Each level of each path takes one query, irrespective of the number
+    of objects.
+    """
+    tree: dict[str, Any] = {}
+    for path in paths:
+        node = tree
+        for name in path.split("."):
+            node = node.setdefault(name, {})
+
+    _prefetch_tree(objs, tree)
+
+
+def _prefetch_tree(objs: Sequence[Document], tree: dict[str, Any]) -> None:
+    if not objs:
+        return
+
+    cls = type(objs[0])
+    for name, subtree in tree.items():
+        if name not in cls._relations:
+            raise ValueError(f"{cls.__name__} has no relation named '{name}'")
+
+        class_name, foreign_key, order = cls._relations[name]
+        related_cls: Type[Document] = globals()[class_name]
+        related = related_cls.find_all_in(
+            foreign_key, [obj.id for obj in objs], order=order
+        )
+
+        by_parent_id = defaultdict(list)
+        for related_obj in related:
+            by_parent_id[getattr(related_obj, foreign_key)].append(related_obj)
+        for obj in objs:
+            obj.set_prefetched(name, by_parent_id[obj.id])
+
+        _prefetch_tree(related, subtree)
+
+
+def save(table_name: str, _pk_field: str = "id", **fields: Any) -> dict:
+    """Inserts or updates a row, and returns the row as written, including
+    defaults set by the database.
+    """
     id = fields.pop(_pk_field, None)
     if id is not None:
-        db.update(
-            table_name, where=f"{_pk_field}=$id", vars={"id": id}, **fields)
+        query = (
+            SQLQuery(f"UPDATE {table_name} SET ")
+            + sqlwhere(fields.items(), ", ")
+            + reparam(f" WHERE {_pk_field} = $id RETURNING *", {"id": id})
+        )
+        return dict(db.query(query)[0])
     else:
-        id = db.insert(table_name, **fields)
+        return insert_many(table_name, [fields])[0]
+
+
+def insert_many(table_name: str, rows: list[dict[str, Any]]) -> list[dict]:
+    """Inserts rows with a single query, and returns them as written, in
+    the same order. Columns missing in a row get their default value.
+    """
+    if not rows:
+        return []
+
+    columns = list(dict.fromkeys(c for row in rows for c in row))
+    query = (
+        SQLQuery(f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ")
+        + build_values(rows, columns)
+        + SQLQuery(" RETURNING *")
+    )
+    return [dict(row) for row in db.query(query)]
+
+
+def build_values(rows: list[dict[str, Any]], columns: list[str]) -> SQLQuery:
+    """Builds `(...), (...)` for a multi-row VALUES clause.
+    """
+    return SQLQuery.join(
+        [
+            SQLQuery.join(
+                [SQLParam(row.get(c, DEFAULT)) for c in columns],
+                ", ", prefix="(", suffix=")",
+            )
+            for row in rows
+        ],
+        ", ",
+    )
+
+
+def upsert(
+    table_name: str, rows: list[dict[str, Any]], conflict: list[str],
+    update: list[str],
+) -> list[dict]:
+    """Inserts all rows with one query. Rows that conflict with an existing
+    row on the `conflict` columns update its `update` columns instead.
+
+    All rows must have the same keys. Returns the inserted or updated rows.
+    """
+    if not rows:
+        return []
+
+    columns = list(rows[0])
+    values = build_values(rows, columns)
+    updates = [f"{c} = excluded.{c}" for c in update]
+    updates.append(f"last_modified = {CURRENT_TIMESTAMP.v}")
+
+    query = (
+        SQLQuery(f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ")
+        + values
+        + SQLQuery(
+            f" ON CONFLICT ({', '.join(conflict)})"
+            f" DO UPDATE SET {', '.join(updates)} RETURNING *"
+        )
+    )
+    result = [dict(row) for row in db.query(query)]
 
-    return id
+    session = get_session()
+    if session is not None:
+        for row in result:
+            session.invalidate(table_name, row["id"])
+    return result
 
 
 def delete(table_name: str, *, _pk_field="id", id: Any) -> int:
@@ -1119,12 +1995,56 @@ def sanitize_value(value: Any) -> Any:
         return value
 
 
+def compute_task_status(check_statuses: list[str]) -> str:
+    """Returns one of 'Completed', 'Failing', 'Pending'
+    """
+    if all(status == "pass" for status in check_statuses):
+        return "Completed"
+    elif any(status == "fail" or status == "error" for status in check_statuses):
+        return "Failing"
+    else:
+        return "Pending"
+
+
+def get_progress(row: dict[str, Any]) -> dict[str, Any]:
+    """Adds percentage and status to a row of the progress matrix.
+    """
+    app_settings = row.pop("app_settings", None) or {}
+    total, completed = row["total_tasks"], row["completed_tasks"]
+
+    if total and completed == total:
+        status = "Completed"
+    elif row["failing_tasks"]:
+        status = "Failing"
+    elif completed:
+        status = "In Progress"
+    else:
+        status = "Pending"
+
+    return dict(
+        row,
+        app_url=app_settings.get("app_url"),
+        percentage=round(completed * 100 / total, 2) if total else 0,
+        status=status,
+    )
+
+
 def remove_none_values(d: dict) -> dict:
     return {
         k: v for k, v in d.items() if v is not None
     }
 
 
+def unique_checks(check_inputs: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """Drops checks that are the same as an earlier check.
+    """
+    unique = {
+        HashableCheck(name=c["name"], title=c["title"], args=c["args"]): c
+        for c in check_inputs
+    }
+    return list(unique.values())
+
+
 class HashableCheck:
     def __init__(self, name, title, args):
         self.name = name
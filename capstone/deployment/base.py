@@ -1,19 +1,67 @@
+import time
 from typing import Any
 
 from capstone.db import Site, UserProject
+from capstone.utils.live_log import LiveLog
 
 
 class Deployment:
+    """A deployment runs in two stages, so that a worker isn't blocked
+    while the app starts:
 
-    def run(self, site: Site, user_project: UserProject) -> dict[str, Any]:
+    - `submit` starts the deployment and returns a handle to it.
+    - `check` tells whether the deployment is done. It is called by the
+      deployment watcher (see watcher.py) until it returns a result.
+
+    `run` does both, waiting for the deployment to finish.
+    """
+
+    def run(
+        self, site: Site, user_project: UserProject, timeout: float = 600,
+        poll_interval: float = 5,
+    ) -> dict[str, Any]:
         """
         Must return a result dict:
         {
             "ok": bool,
-            "logs": str,
+            "log": str,
             "app_url": optional str  # only if ok is True
         }
 
         It is OK to have additional keys, but these^ must be there.
         """
+        submitted = self.submit(site=site, user_project=user_project)
+        if not submitted["ok"]:
+            return submitted
+
+        deadline = time.monotonic() + timeout
+        while True:
+            result = self.check(submitted["deployment"], wait=poll_interval)
+            if result is not None:
+                return result
+            if time.monotonic() >= deadline:
+                return {"ok": False, "log": f"Timeout after {timeout} seconds"}
+            time.sleep(poll_interval)
+
+    def submit(
+        self, site: Site, user_project: UserProject, live_log: LiveLog | None = None,
+    ) -> dict[str, Any]:
+        """Starts a deployment. Output of the build, if any, is written to
+        `live_log` as it happens. Returns a dict:
+        {
+            "ok": bool,
+            "log": str,
+            "deployment": dict  # only if ok is True
+        }
+
+        "deployment" identifies the deployment for `check`, and must be
+        JSON serializable, as it's saved in the changelog.
+        """
+        raise NotImplementedError
+
+    def check(self, deployment: dict[str, Any], wait: float) -> dict[str, Any] | None:
+        """Returns the result of the deployment, like `run`, or None if it
+        is still in progress. May block for up to `wait` seconds for the
+        deployment to change.
+        """
         raise NotImplementedError
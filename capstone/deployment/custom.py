@@ -1,6 +1,5 @@
 import subprocess
 import tempfile
-import time
 from datetime import datetime
 from pathlib import Path
 from typing import Any, IO
@@ -10,6 +9,8 @@ from pydantic import BaseModel, validator
 
 from capstone import config
 from capstone.db import Site, UserProject
+from capstone.utils import git
+from capstone.utils.live_log import LiveLog
 from .base import Deployment
 
 
@@ -131,23 +132,9 @@ class CustomDeployment(Deployment):
         r.raise_for_status()
         return r.text
 
-    def wait_for_status(self, app_id: str, deployment_id: int) -> DeploymentInfo:
-        for _ in range(100):  # 100 retries (~100 seconds)
-            deployment = self.get_deployment(app_id=app_id, deployment_id=deployment_id)
-            if deployment.status == "IN-PROGRESS":
-                time.sleep(1)
-
-        return deployment
-
-    def run(self, site: Site, user_project: UserProject) -> dict[str, Any]:
-        """
-        Returns a result dict:
-        {
-            "ok": bool,
-            "logs": str,
-            "app_url": optional str  # only if ok is True
-        }
-        """
+    def submit(
+        self, site: Site, user_project: UserProject, live_log: LiveLog | None = None,
+    ) -> dict[str, Any]:
         if "app_id" in user_project.app_settings:
             app_info = self.get_app(app_id=user_project.app_settings["app_id"])
         else:
@@ -157,15 +144,30 @@ class CustomDeployment(Deployment):
             )
             user_project.app_settings["app_id"] = app_info.id
             user_project.save()
-        payload_zipfile = _make_zipfile_for_user_project(user_project=user_project)
-        depl = self.create_deployment(
-            app_id=app_info.id,
-            payload_zipfile=payload_zipfile,
-        )
-        depl = self.wait_for_status(app_id=app_info.id, deployment_id=depl.id)
+        with _make_zipfile_for_user_project(user_project=user_project) as payload_zipfile:
+            depl = self.create_deployment(
+                app_id=app_info.id,
+                payload_zipfile=payload_zipfile,
+            )
+        # the app is built by the deployer, its log is in the result
+        if live_log is not None:
+            live_log.write(f"Created deployment {depl.id} of app {app_info.id}")
+        return {
+            "ok": True,
+            "log": None,
+            "deployment": {"app_id": app_info.id, "deployment_id": depl.id},
+        }
+
+    def check(self, deployment: dict[str, Any], wait: float) -> dict[str, Any] | None:
+        # the deployer has no blocking API, the watcher polls it
+        app_id, deployment_id = deployment["app_id"], deployment["deployment_id"]
+        depl = self.get_deployment(app_id=app_id, deployment_id=deployment_id)
+        if depl.status == "IN-PROGRESS":
+            return None
+
         return {
             "ok": depl.status == "SUCCESS",
-            "logs": self.get_deployment_logs(app_id=app_info.id, deployment_id=depl.id),
+            "log": self.get_deployment_logs(app_id=app_id, deployment_id=deployment_id),
             "app_url": depl.links["app"] if depl.status == "SUCCESS" else None,
         }
 
@@ -179,7 +181,7 @@ def _make_zipfile_for_user_project(user_project: UserProject) -> IO[bytes]:
         # move project assets to this directory:
         subprocess.check_call(["mkdir", "project"], cwd=tmp)
 
-        subprocess.check_call(["git", "clone", user_project.git_url, "app"], cwd=tmp)
+        git.clone_cached(user_project.git_url, Path(tmp) / "app")
 
         subprocess.check_call(["zip", "-r", "app.zip", "app", "project"], cwd=tmp)
 
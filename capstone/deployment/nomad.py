@@ -3,8 +3,8 @@ import os
 import subprocess
 import sys
 import tempfile
-import time
 import uuid
+from collections import deque
 from pathlib import Path
 from typing import Any
 
@@ -13,6 +13,8 @@ from jinja2 import Template
 
 from capstone import config
 from capstone.db import Site, UserProject
+from capstone.utils import git
+from capstone.utils.live_log import LiveLog
 from .base import Deployment
 
 
@@ -59,6 +61,10 @@ job "{{name}}" {
 }
 """
 
+# lines of the output of a command kept for the result log, the full output
+# is in the task log
+MAX_OUTPUT_LINES = 2000
+
 
 def get_nomad_job_hcl(name, host, docker_image):
     t = Template(NOMAD_JOB_TEMPLATE)
@@ -93,14 +99,18 @@ class Task:
 
 
 class DeployTask(Task):
-    def __init__(self, site: str, name, hostname, git_url):
+    def __init__(self, site: str, name, hostname, git_url, live_log: LiveLog | None = None):
         super().__init__(site)
         self.name = name
         self.hostname = hostname
         self.git_url = git_url
+        self.live_log = live_log
         self.cwd = None
 
-    def run(self):
+    def submit(self):
+        """Builds the image and registers the job, without waiting for
+        the app to start. Returns the job ID in the result on success.
+        """
         self.logger.info(f"Starting DeployTask {self.task_id} to deploy {self.hostname}")
 
         with tempfile.TemporaryDirectory() as root:
@@ -134,23 +144,32 @@ class DeployTask(Task):
                     "log": f"Failed to deploy to Nomad\n{logs}",
                 }
 
-            _, logs, ok = self.check_health(job_id)
-            if not ok:
-                self.logger.error("App health check failed")
-                return {
-                    "ok": False,
-                    "log": f"App health check failed\n{logs}",
-                }
-
-        return {"ok": True, "log": None}
+        return {"ok": True, "log": None, "job_id": job_id}
 
     def run_command(self, *args, **kwargs) -> tuple[str, bool]:
+        """Runs a command, and returns its output and whether it succeeded.
+
+        Output is read line by line as the command runs, and written to the
+        live log. Only the last MAX_OUTPUT_LINES lines are returned.
+        """
         self.logger.info("")
         self.logger.info("$ %s", ' '.join(args))
-        p = subprocess.Popen(list(args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, cwd=self.cwd, **kwargs)
-        status = p.wait()
-        logs = p.stdout.read()  # type: ignore
-        self.logger.info(logs)
+        self.write_live_log(f"$ {' '.join(args)}")
+
+        lines: deque[str] = deque(maxlen=MAX_OUTPUT_LINES)
+        count = 0
+        with subprocess.Popen(list(args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, cwd=self.cwd, **kwargs) as p:
+            for line in p.stdout:  # type: ignore
+                line = line.rstrip("\n")
+                self.logger.info(line)
+                self.write_live_log(line)
+                lines.append(line)
+                count += 1
+            status = p.wait()
+
+        if count > len(lines):
+            lines.appendleft(f"... {count - len(lines)} lines omitted")
+        logs = "".join(line + "\n" for line in lines)
         if status != 0:
             self.logger.error("Command failed with exit status: %s", status)
             return logs, False
@@ -158,6 +177,10 @@ class DeployTask(Task):
             self.logger.info("Command finished successfully.")
             return logs, True
 
+    def write_live_log(self, line: str) -> None:
+        if self.live_log is not None:
+            self.live_log.write(line)
+
     def chdir(self, directory):
         self.logger.info("")
         self.logger.info("$ cd %s", directory)
@@ -165,8 +188,15 @@ class DeployTask(Task):
 
     def clone_repo(self, to: Path) -> tuple[str|None, str|None, bool]:
         self.logger.info("Cloning the git repository")
-        logs_1, ok = self.run_command("git", "clone", self.git_url, str(to))
-        cumulative_logs = "\n\n$ git clone {self.git_url} {to}\n" + logs_1
+        try:
+            # only fetches new commits, and then clones locally from the mirror
+            mirror = git.update_mirror(self.git_url)
+        except subprocess.CalledProcessError as e:
+            self.logger.exception(f"Failed to update mirror of {self.git_url}")
+            return None, str(e), False
+
+        logs_1, ok = self.run_command("git", "clone", str(mirror), str(to))
+        cumulative_logs = f"\n\n$ git clone {mirror} {to}\n" + logs_1
         if not ok:
             return None, logs_1, False
 
@@ -211,32 +241,6 @@ class DeployTask(Task):
 
         return job_id, None, True
 
-    def check_health(
-        self, job_id: str, timeout: int = 60, sleep_interval: int = 5,
-    ) -> tuple[None, str|None, bool]:
-        self.logger.info(f"Checking health of job {job_id}")
-        start = time.perf_counter()
-        while True:
-            try:
-                depl = nomad.Nomad().job.get_deployment(job_id)
-            except nomad.api.exceptions.BaseNomadException as e:
-                self.logger.exception(f"Failed to get deployment from Nomad: {e}")
-                return None, str(e), False
-
-            status = depl["Status"]
-            if status == "successful":
-                return None, None, True
-
-            # TODO: use this logs API to stream app logs
-            # https://developer.hashicorp.com/nomad/api-docs/client#stream-logs
-            now = time.perf_counter()
-            if now - start >= timeout:
-                return None, f"Timeout after {timeout} seconds. Job status: {status}", False
-
-            self.logger.info(f"Waiting for job to start. Current status: {status}. "
-                             f"Will check again in {sleep_interval} seconds.")
-            time.sleep(sleep_interval)
-
 
 class NomadDeployer:
     """Creates a deployer based on Nomad.
@@ -264,15 +268,9 @@ class NomadDeployer:
 class NomadDeployment(Deployment):
     TYPE = "nomad"
 
-    def run(self, site: Site, user_project: UserProject) -> dict[str, Any]:
-        """
-        Returns a result dict:
-        {
-            "ok": bool,
-            "logs": str,
-            "app_url": optional str  # only if ok is True
-        }
-        """
+    def submit(
+        self, site: Site, user_project: UserProject, live_log: LiveLog | None = None,
+    ) -> dict[str, Any]:
         if site.id != user_project.get_site().id:
             raise ValueError("Site and user_project must be from the same site")
 
@@ -289,7 +287,35 @@ class NomadDeployment(Deployment):
             # running locally
             app_url += ":8080"
 
-        task = DeployTask(site.name, name=name, hostname=hostname, git_url=user_project.git_url)
-        result = task.run()
-        result["app_url"] = app_url
+        task = DeployTask(
+            site.name, name=name, hostname=hostname, git_url=user_project.git_url,
+            live_log=live_log,
+        )
+        result = task.submit()
+        if result["ok"]:
+            result["deployment"] = {"job_id": result.pop("job_id"), "app_url": app_url}
         return result
+
+    def check(self, deployment: dict[str, Any], wait: float) -> dict[str, Any] | None:
+        """Waits for the Nomad deployment of the job to change, with
+        a blocking query, and returns the result once it's finished.
+        """
+        # the index of the last response, to wait for the next change
+        index = deployment.get("index", 0)
+        response = nomad.Nomad(timeout=wait + 10).job.request(
+            deployment["job_id"], "deployment",
+            method="get", params={"index": index, "wait": f"{int(wait)}s"},
+        )
+        deployment["index"] = int(response.headers.get("X-Nomad-Index", index))
+
+        depl = response.json()
+        status = depl and depl["Status"]
+        if status == "successful":
+            return {"ok": True, "log": None, "app_url": deployment["app_url"]}
+        elif status in ("failed", "cancelled"):
+            return {
+                "ok": False,
+                "log": f"Nomad deployment {status}: {depl.get('StatusDescription')}",
+            }
+        else:
+            return None
@@ -0,0 +1,136 @@
+"""Watches deployments in progress and finishes their updates.
+
+`update_user_project` only submits the deployment of an app, and saves a
+handle to it in the changelog, so that the rq worker is free while the app
+is built and started. The watcher finds those changelogs, waits for their
+deployments with `Deployment.check`, and enqueues `finish_deployment` with
+the result, which runs the checks. If that job is lost, or fails before
+finishing the update, the deployment is watched again.
+
+Each deployment is watched by its own thread, which is blocked in a Nomad
+blocking query, or sleeps between polls, most of the time. So the number of
+deployments in progress isn't limited by the number of workers.
+
+Run it with:
+
+```
+capstone-server deploys watch
+```
+"""
+import logging
+import threading
+import time
+from datetime import datetime
+
+from capstone import config, db
+from capstone.tasks import (
+    finish_deployment, get_finish_deployment_job_id, is_finish_deployment_job_lost,
+    queue,
+)
+from . import get_deployer
+
+logger = logging.getLogger(__name__)
+
+# max seconds that a check may block
+CHECK_WAIT = 60
+
+
+class DeploymentWatcher:
+    def __init__(
+        self,
+        poll_interval: float = config.deployment_poll_interval,
+        timeout: float = config.deployment_timeout,
+    ):
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+        # ids of changelogs being watched, or whose finish_deployment is
+        # enqueued but hasn't run yet
+        self._watching: set[int] = set()
+        # ids of changelogs whose finish_deployment is enqueued
+        self._enqueued: set[int] = set()
+        self._lock = threading.Lock()
+
+    def run(self) -> None:
+        logger.info("Watching deployments")
+        while True:
+            try:
+                self.watch_new_deployments()
+            except Exception:
+                logger.exception("Failed to find deployments in progress")
+            time.sleep(self.poll_interval)
+
+    def watch_new_deployments(self) -> None:
+        deploying = db.Changelog.find_deploying()
+        deploying_ids = {c.id for c in deploying if c.id is not None}
+        with self._lock:
+            # updates that are finished aren't deploying anymore
+            self._watching &= deploying_ids
+            self._enqueued &= deploying_ids
+            enqueued = list(self._enqueued)
+
+        # the update stays deploying if its finish_deployment job is lost
+        for changelog_id in enqueued:
+            if is_finish_deployment_job_lost(changelog_id):
+                logger.warning(f"finish_deployment of changelog {changelog_id} is lost, watching it again")
+                with self._lock:
+                    self._watching.discard(changelog_id)
+                    self._enqueued.discard(changelog_id)
+
+        for changelog in deploying:
+            assert changelog.id is not None
+            with self._lock:
+                if changelog.id in self._watching:
+                    continue
+                self._watching.add(changelog.id)
+
+            thread = threading.Thread(
+                target=self.watch, args=(changelog,),
+                name=f"deployment-{changelog.id}", daemon=True,
+            )
+            thread.start()
+
+    def watch(self, changelog: db.Changelog) -> None:
+        assert changelog.id is not None
+        changelog_id = changelog.id
+        try:
+            result = self.wait_for_result(changelog.details["deployment"])
+            logger.info(f"Deployment of changelog {changelog_id} is finished")
+            queue.enqueue(
+                finish_deployment,
+                site_id=changelog.site_id,
+                user_project_id=changelog.details["user_project_id"],
+                changelog_id=changelog_id,
+                result=result,
+                job_id=get_finish_deployment_job_id(changelog_id),
+            )
+            with self._lock:
+                self._enqueued.add(changelog_id)
+        except Exception:
+            logger.exception(f"Failed to watch deployment of changelog {changelog_id}")
+            # watched again on the next scan
+            with self._lock:
+                self._watching.discard(changelog_id)
+
+    def wait_for_result(self, deployment: dict) -> dict:
+        deployer = get_deployer(deployment["type"])
+
+        # the deadline survives restarts of the watcher
+        submitted = datetime.fromisoformat(deployment["submitted"])
+        elapsed = (datetime.utcnow() - submitted).total_seconds()
+        deadline = time.monotonic() + self.timeout - elapsed
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return {"ok": False, "log": f"Timeout after {self.timeout} seconds"}
+
+            try:
+                result = deployer.check(deployment, wait=min(CHECK_WAIT, remaining))
+            except Exception:
+                logger.exception(f"Failed to check deployment {deployment}, will retry")
+                result = None
+
+            if result is not None:
+                return result
+            time.sleep(self.poll_interval)
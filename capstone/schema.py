@@ -2,13 +2,13 @@
 """
 from toolkit.db import Schema
 import web
+from datetime import date
 from pathlib import Path
-from . import config
+from .db import db
 
 def migrate():
     """Migrate the database
     """
-    db = web.database(config.db_uri)
     schema = Schema(db)
 
     with db.transaction():
@@ -28,6 +28,11 @@ def migrate():
         add_project_type_column(schema)
         add_deployment_type_column(schema)
         remove_deployment_options_column(schema)
+        add_grading_result_table(schema)
+        convert_json_columns_to_jsonb(schema)
+        add_changelog_indexes(schema)
+        drop_user_project_app_id_index(schema)
+        add_last_modified_column_to_task(schema)
 
 def initial_schema(schema):
     # schema is already initialized
@@ -218,3 +223,189 @@ def remove_deployment_options_column(schema):
 
     if schema.get_table("project").has_column("deployment_options"):
         db.query("alter table project drop column deployment_options")
+
+
+def add_grading_result_table(schema):
+    db = schema.db
+
+    if not schema.has_table("grading_result"):
+        db.query("""
+        create table grading_result (
+            id serial primary key,
+            user_project_id integer not null references user_project,
+            user_commit text not null,
+            project_commit text not null,
+            checks_hash text not null,
+            result JSON not null,
+            created timestamp not null default (CURRENT_TIMESTAMP at time zone 'utc'),
+
+            unique(user_project_id, user_commit, project_commit, checks_hash)
+        )""")
+
+
+def get_column_type(schema, table_name, column_name):
+    row = schema.db.query("""
+        select data_type from information_schema.columns
+        where table_name = $table_name and column_name = $column_name
+    """, vars={"table_name": table_name, "column_name": column_name}).first()
+    return row and row.data_type
+
+
+def convert_json_columns_to_jsonb(schema):
+    """JSON columns can't be indexed or compared, JSONB columns can.
+    """
+    db = schema.db
+
+    if get_column_type(schema, "changelog", "details") == "json":
+        # the check uses json_typeof, which doesn't take jsonb
+        db.query("alter table changelog drop constraint if exists changelog_details_check")
+        if schema.has_table("changelog_old"):
+            db.query("alter table changelog_old drop constraint if exists changelog_details_check")
+        db.query("alter table changelog alter column details drop default")
+        db.query("alter table changelog alter column details type jsonb using details::jsonb")
+        db.query("alter table changelog alter column details set default '{}'::jsonb")
+        db.query("""
+            alter table changelog add constraint changelog_details_check
+            check (jsonb_typeof(details) = 'object')
+        """)
+
+    if get_column_type(schema, "task_check", "args") == "json":
+        db.query("alter table task_check alter column args type jsonb using args::jsonb")
+
+    if get_column_type(schema, "user_project", "app_settings") == "json":
+        db.query("alter table user_project alter column app_settings drop default")
+        db.query("alter table user_project alter column app_settings type jsonb using app_settings::jsonb")
+        db.query("alter table user_project alter column app_settings set default '{}'::jsonb")
+
+
+def drop_user_project_app_id_index(schema):
+    db = schema.db
+
+    # added by an earlier migration, but user projects aren't looked up by app id
+    db.query("drop index if exists user_project_app_id_idx")
+
+
+def add_last_modified_column_to_task(schema):
+    db = schema.db
+
+    # for conditional GET of projects, see utils/http_cache.py
+    if not schema.get_table("task").has_column("last_modified"):
+        db.query("alter table task add column last_modified timestamp not null default (CURRENT_TIMESTAMP at time zone 'utc')")
+
+
+CHANGELOG_INDEXES = {
+    # Site.get_changelogs with a project, e.g. Project.get_history
+    "changelog_project_action_timestamp_idx":
+        "(project_id, action, timestamp desc)",
+    # Site.get_changelogs with a user and a project, e.g. UserProject.get_history
+    "changelog_user_project_action_timestamp_idx":
+        "(user_id, project_id, action, timestamp desc)",
+    # deployment.get_deployments
+    "changelog_site_action_timestamp_idx":
+        "(site_id, action, timestamp desc)",
+    # UserProject.get_updates
+    "changelog_user_project_updates_idx":
+        "(((details->>'user_project_id')::int), id) where action = 'update_user_project'",
+    # Changelog.find_deploying
+    "changelog_running_updates_idx":
+        "(id) where action = 'update_user_project' and details->>'status' = 'running'",
+    # updates by status, e.g. Project.get_history(status=...)
+    "changelog_action_status_idx":
+        "(action, (details->>'status'))",
+}
+
+
+def add_changelog_indexes(schema):
+    db = schema.db
+
+    for name, definition in CHANGELOG_INDEXES.items():
+        db.query(f"create index if not exists {name} on changelog {definition}")
+
+
+# Partitioning of changelog by month. It's optional, and done with
+# `capstone-server changelog partition`, as it rewrites the table.
+
+def is_changelog_partitioned(schema):
+    row = schema.db.query(
+        "select relkind from pg_class where relname = 'changelog'"
+    ).first()
+    return row is not None and row.relkind == "p"
+
+
+def partition_changelog(schema, months_ahead=3):
+    """Makes changelog a table partitioned by month of timestamp.
+
+    The existing table becomes the partition of everything before next
+    month, so no rows are copied. Partitions for the coming months are
+    created, and a default partition takes rows that have no partition.
+    """
+    db = schema.db
+
+    if is_changelog_partitioned(schema):
+        return
+
+    first_month = add_months(date.today().replace(day=1), 1)
+
+    with db.transaction():
+        db.query("alter table changelog rename to changelog_old")
+        # free index names for the partitioned table
+        for row in db.query("select indexname from pg_indexes where tablename = 'changelog_old'"):
+            if row.indexname.startswith("changelog_"):
+                db.query(f"alter index {row.indexname} rename to {row.indexname}_old")
+
+        db.query("""
+        create table changelog (
+            like changelog_old including defaults including constraints,
+            primary key (id, timestamp),
+            foreign key (site_id) references site,
+            foreign key (project_id) references project,
+            foreign key (user_id) references user_account
+        ) partition by range (timestamp)""")
+        db.query("alter sequence changelog_id_seq owned by changelog.id")
+
+        # partition bounds must be literals
+        db.query(
+            "alter table changelog attach partition changelog_old"
+            f" for values from (minvalue) to ('{first_month.isoformat()}')"
+        )
+        db.query("create table changelog_default partition of changelog default")
+        add_changelog_indexes(schema)
+        add_changelog_partitions(schema, months_ahead=months_ahead)
+
+
+def add_changelog_partitions(schema, months_ahead=3):
+    """Creates partitions of changelog for this month and the next
+    `months_ahead` months, if they don't exist. Should run at least once
+    a month, so that rows don't go to the default partition.
+    """
+    db = schema.db
+
+    if not is_changelog_partitioned(schema):
+        return
+
+    this_month = date.today().replace(day=1)
+    for i in range(months_ahead + 1):
+        start = add_months(this_month, i)
+        name = f"changelog_{start:%Y_%m}"
+        if schema.has_table(name) or start < get_changelog_old_upper_bound(schema):
+            continue
+        db.query(
+            f"create table {name} partition of changelog"
+            f" for values from ('{start.isoformat()}') to ('{add_months(start, 1).isoformat()}')"
+        )
+
+
+def get_changelog_old_upper_bound(schema):
+    row = schema.db.query("""
+        select pg_get_expr(c.relpartbound, c.oid) as bound
+        from pg_class c where c.relname = 'changelog_old'
+    """).first()
+    if row is None:
+        return date.min
+    # FOR VALUES FROM (MINVALUE) TO ('2024-05-01 00:00:00')
+    return date.fromisoformat(row.bound.split("TO ('")[1][:10])
+
+
+def add_months(d, months):
+    month = d.month - 1 + months
+    return d.replace(year=d.year + month // 12, month=month % 12 + 1)
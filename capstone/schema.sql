@@ -70,6 +70,7 @@ create table task (
     name text not null,
     title text not null,
     description text not null,
+    last_modified timestamp not null default (CURRENT_TIMESTAMP at time zone 'utc'),
 
     CONSTRAINT ck_name CHECK (name ~ '^[a-z0-9-]+$'),
     unique(project_id, name)
@@ -81,7 +82,7 @@ create table task_check (
     position integer not null,
     name text not null,
     title text not null,
-    args JSON not null
+    args JSONB not null
 );
 
 create table user_project (
@@ -90,7 +91,7 @@ create table user_project (
     user_id integer not null references user_account,
     git_url text not null,
     repo_id text not null unique,
-    app_settings json not null default '{}'::json,
+    app_settings jsonb not null default '{}'::jsonb,
     created timestamp not null default (CURRENT_TIMESTAMP at time zone 'utc'),
     last_modified timestamp not null default (CURRENT_TIMESTAMP at time zone 'utc'),
 
@@ -122,18 +123,40 @@ create table user_check_status (
     CHECK (status ~ '^(pending|pass|fail|error)$')
 );
 
+create table grading_result (
+    id serial primary key,
+    user_project_id integer not null references user_project,
+    user_commit text not null,
+    project_commit text not null,
+    checks_hash text not null,
+    result JSON not null,
+    created timestamp not null default (CURRENT_TIMESTAMP at time zone 'utc'),
+
+    unique(user_project_id, user_commit, project_commit, checks_hash)
+);
+
 create table changelog (
     id serial primary key,
     site_id integer not null references site,
     project_id integer references project,
     user_id integer references user_account,
     action text not null,
-    details JSON not null default '{}'::json,
+    details JSONB not null default '{}'::jsonb,
     timestamp timestamp not null default (CURRENT_TIMESTAMP at time zone 'utc'),
 
-    CHECK (json_typeof(details) = 'object')
+    CHECK (jsonb_typeof(details) = 'object')
 );
 
+-- access paths of Site.get_changelogs, get_deployments and UserProject.get_updates
+create index changelog_project_action_timestamp_idx on changelog (project_id, action, timestamp desc);
+create index changelog_user_project_action_timestamp_idx on changelog (user_id, project_id, action, timestamp desc);
+create index changelog_site_action_timestamp_idx on changelog (site_id, action, timestamp desc);
+create index changelog_user_project_updates_idx on changelog (((details->>'user_project_id')::int), id)
+    where action = 'update_user_project';
+create index changelog_running_updates_idx on changelog (id)
+    where action = 'update_user_project' and details->>'status' = 'running';
+create index changelog_action_status_idx on changelog (action, (details->>'status'));
+
 create table course (
     id serial primary key,
     site_id integer not null references site,
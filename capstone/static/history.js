@@ -0,0 +1,71 @@
+// Loads the log of an update when its card in the history is opened.
+// Only the tail of long logs is loaded, with a link to the full log.
+// Logs of running updates are followed until the update is finished.
+
+const LOG_TAIL_BYTES = 64 * 1024;
+
+document.addEventListener("click", function (event) {
+  const link = event.target.closest("[data-toggle=collapse]");
+  if (!link) {
+    return;
+  }
+  const target = document.querySelector(link.getAttribute("href"));
+  const pre = target && target.querySelector("pre[data-log-url]");
+  if (!pre || pre.dataset.loaded) {
+    return;
+  }
+  pre.dataset.loaded = "true";
+  if (pre.dataset.liveLogUrl) {
+    followLog(pre);
+  } else {
+    loadLog(pre, pre.dataset.logUrl);
+  }
+});
+
+function followLog(pre) {
+  pre.textContent = "";
+  const source = new EventSource(pre.dataset.liveLogUrl);
+  source.onmessage = function (event) {
+    pre.append(event.data + "\n");
+  };
+  source.addEventListener("end", function () {
+    source.close();
+    // the saved log is complete, the live log may be trimmed
+    loadLog(pre, pre.dataset.logUrl);
+  });
+}
+
+function loadLog(pre, url) {
+  fetch(url, { headers: { Range: `bytes=-${LOG_TAIL_BYTES}` } })
+    .then(function (response) {
+      if (response.status === 404) {
+        return response.text().then(function () {
+          // keep the lines of the live log, if any
+          if (!pre.dataset.liveLogUrl || !pre.textContent) {
+            pre.textContent = "No logs";
+          }
+        });
+      }
+      if (!response.ok) {
+        throw new Error(`Failed to load the log: ${response.status}`);
+      }
+      return response.text().then(function (text) {
+        pre.textContent = text;
+        if (response.status === 206) {
+          const note = document.createElement("p");
+          note.className = "text-muted";
+          note.append(`Showing the last ${LOG_TAIL_BYTES / 1024} KB of the log. `);
+          const full = document.createElement("a");
+          full.href = url;
+          full.target = "_blank";
+          full.textContent = "Full log";
+          note.append(full);
+          pre.before(note);
+        }
+      });
+    })
+    .catch(function (error) {
+      pre.textContent = error.message;
+      delete pre.dataset.loaded;
+    });
+}
@@ -3,6 +3,7 @@ import subprocess
 import tempfile
 import traceback
 import yaml
+from datetime import datetime
 from pathlib import Path
 from typing import Any
 
@@ -10,10 +11,13 @@ from pydantic import BaseModel, Field, root_validator
 from toolkit import setup_logger
 from redis import Redis
 from rq import Queue
+from rq.exceptions import NoSuchJobError
+from rq.job import Dependency, Job
 
 from . import config, db
 from .deployment import get_deployer
-from .utils import git
+from .utils import check_envs, git, runner_pool
+from .utils.live_log import LiveLog
 from .utils.user_project import run_checks
 
 setup_logger()
@@ -49,6 +53,7 @@ class ProjectUpsertModel(BaseModel):
     tasks: list[TaskInputModel]
 
 
+@db.with_session
 def update_project(site_id: int, project_id: int, changelog_id: int) -> None:
     logger.info(f"Task started: update_project(site_id={site_id}, "
                 f"project_id={project_id}, changelog_id={changelog_id})")
@@ -61,9 +66,11 @@ def update_project(site_id: int, project_id: int, changelog_id: int) -> None:
 
     try:
         project = site.get_project_by_id_or_fail(project_id)
+        if not project.git_url:
+            raise Exception(f"Project {project.name} has no git_url to update it from")
 
         with tempfile.TemporaryDirectory() as tmp:
-            git.clone(project.git_url, tmp)
+            git.clone_cached(project.git_url, tmp)
 
             if not Path(f"{tmp}/capstone.yml").is_file():
                 raise Exception("capstone.yml not found in the root of the repository")
@@ -80,6 +87,9 @@ def update_project(site_id: int, project_id: int, changelog_id: int) -> None:
             project_info = ProjectUpsertModel.parse_obj(project_info).dict()
             tasks = project_info.pop("tasks")
 
+            # install requirements now, so that grading doesn't have to
+            check_envs.build_env(Path(tmp) / "requirements.txt")
+
             with db.db.transaction():
                 project.update(**project_info)
                 project.save()
@@ -96,7 +106,7 @@ def update_project(site_id: int, project_id: int, changelog_id: int) -> None:
     except Exception:
         logger.error("Caught an exception.")
         changelog.details["status"] = "failed"
-        changelog.details["log"] = traceback.format_exc()
+        changelog.set_log(traceback.format_exc())
         changelog.save()
         raise
     else:
@@ -104,7 +114,12 @@ def update_project(site_id: int, project_id: int, changelog_id: int) -> None:
         changelog.details["status"] = "success"
         changelog.save()
 
+        if config.runner_pool_mode:
+            # runner has old checks loaded, next job will start a new one
+            runner_pool.stop_runner(site_name=site.name, project_name=project.name)
+
 
+@db.with_session
 def update_user_project(
     site_id: int, user_project_id: int, changelog_id: int
 ) -> None:
@@ -115,55 +130,223 @@ def update_user_project(
     site = db.Site.find_or_fail(id=site_id)
 
     changelog = site.get_changelog_or_fail(id=changelog_id)
-    changelog.details["status"] = "running"
-    changelog.save()
+    live_log = None
 
     try:
         user_project = site.get_user_project_by_id_or_fail(id=user_project_id)
+        # from now on, pushes go to a follow-up update
+        started = user_project.start_update(changelog_id=changelog_id)
+        if started is None:
+            logger.info("Not starting the update, it's not pending or waits "
+                        "for the deployment of an earlier update")
+            return
+        changelog = started
+        live_log = LiveLog(changelog_id)
 
-        # run deployment
+        # submit deployment, the deployment watcher calls finish_deployment
+        # when it's done
         if user_project.get_project().project_type == "web":
             changelog.details["stage"] = "deployment"
-            result = run_deployer(site=site, user_project=user_project)
-            logger.info(f"Deployment result:\n{result}")
+            live_log.write("Deploying the app")
+            result = submit_deployment(
+                site=site, user_project=user_project, live_log=live_log,
+            )
             if not result["ok"]:
                 logger.error("Deployment failed with result not ok")
                 changelog.details["status"] = "failed"
-                changelog.details["log"] = result["log"]
+                changelog.set_log(result["log"])
                 changelog.save()
                 return
+
+            logger.info(f"Deployment submitted: {result['deployment']}")
+            changelog.details["deployment"] = result["deployment"]
+            changelog.save()
+            return
         else:
             logger.info("Skipping deployment because project_type is not 'web'")
 
-        # run checks
-        changelog.details["stage"] = "checks"
-        result = run_checker(site=site, user_project=user_project)
-        logger.info(f"Checker result:\n{result}")
+        check_user_project(site=site, user_project=user_project, changelog=changelog)
+
+    except Exception:
+        logger.error("Caught an exception")
+        changelog.details["status"] = "failed"
+        changelog.set_log(traceback.format_exc())
+        changelog.save()
+        raise
+
+    finally:
+        # a submitted deployment is followed by finish_deployment
+        if live_log is not None and not changelog.is_deploying():
+            live_log.close(changelog.details["status"])
+
+
+@db.with_session
+def finish_deployment(
+    site_id: int, user_project_id: int, changelog_id: int, result: dict[str, Any],
+) -> None:
+    """Second stage of update_user_project, enqueued by the deployment
+    watcher with the result of the deployment.
+    """
+    logger.info(f"Task started: finish_deployment(site_id={site_id}, "
+                f"user_project_id={user_project_id}, "
+                f"changelog_id={changelog_id})")
+
+    site = db.Site.find_or_fail(id=site_id)
+
+    changelog = site.get_changelog_or_fail(id=changelog_id)
+    if not changelog.is_deploying():
+        logger.info("Deployment is already finished")
+        return
+
+    live_log = LiveLog(changelog_id)
+    try:
+        user_project = site.get_user_project_by_id_or_fail(id=user_project_id)
+
+        logger.info(f"Deployment result:\n{result}")
         if not result["ok"]:
-            logger.error("Checker failed with result not ok")
+            logger.error("Deployment failed with result not ok")
             changelog.details["status"] = "failed"
-            changelog.details["log"] = result["log"]
+            changelog.set_log(result["log"])
             changelog.save()
             return
 
+        user_project.set_app_url(result["app_url"])
+        check_user_project(site=site, user_project=user_project, changelog=changelog)
+
     except Exception:
         logger.error("Caught an exception")
         changelog.details["status"] = "failed"
-        changelog.details["log"] = traceback.format_exc()
+        changelog.set_log(traceback.format_exc())
         changelog.save()
         raise
-    else:
-        logger.info("UserProject updated without errors")
-        changelog.details["status"] = "success"
+
+    finally:
+        live_log.close(changelog.details["status"])
+        # follow-up update that was waiting for this deployment
+        enqueue_pending_update(site_id=site_id, user_project_id=user_project_id)
+
+
+def check_user_project(site, user_project, changelog):
+    changelog.details["stage"] = "checks"
+    changelog.save()
+    LiveLog(changelog.id).write("Running checks")
+    result = run_checker(site=site, user_project=user_project)
+    logger.info(f"Checker result:\n{result}")
+    if not result["ok"]:
+        logger.error("Checker failed with result not ok")
+        changelog.details["status"] = "failed"
+        changelog.set_log(result["log"])
         changelog.save()
+        return
+
+    logger.info("UserProject updated without errors")
+    changelog.details["status"] = "success"
+    changelog.save()
+
+
+def enqueue_pending_update(site_id: int, user_project_id: int) -> None:
+    user_project = db.UserProject.find_or_fail(id=user_project_id)
+    pending = user_project.get_updates(status="pending")
+    if pending:
+        changelog_id = pending[0].id
+        assert changelog_id is not None
+        queue.enqueue(
+            update_user_project,
+            site_id=site_id,
+            user_project_id=user_project_id,
+            changelog_id=changelog_id,
+            job_id=get_update_user_project_job_id(changelog_id),
+        )
+
+
+def has_errors(result: dict[str, Any]) -> bool:
+    """Whether a check errored, e.g. timed out, which may pass next time.
+    """
+    return any(
+        check["status"] == "error"
+        for task in result["tasks"]
+        for check in task["checks"]
+    )
+
+
+def get_update_user_project_job_id(changelog_id: int) -> str:
+    """Job id of the update_user_project job of a changelog, so that
+    a follow-up update can depend on it.
+    """
+    return f"update_user_project-{changelog_id}"
+
+
+def get_update_user_project_job(changelog_id: int) -> Job | None:
+    try:
+        return Job.fetch(
+            get_update_user_project_job_id(changelog_id), connection=queue.connection,
+        )
+    except NoSuchJobError:
+        return None
+
+
+def enqueue_update_user_project(
+    site_id: int, user_project_id: int, changelog: db.Changelog,
+) -> None:
+    assert changelog.id is not None
+
+    # an update that follows a running one must wait for it to finish
+    depends_on = None
+    follows = changelog.details.get("follows")
+    if follows is not None and get_update_user_project_job(follows) is not None:
+        depends_on = Dependency(
+            jobs=[get_update_user_project_job_id(follows)],
+            allow_failure=True,
+        )
+
+    queue.enqueue(
+        update_user_project,
+        site_id=site_id,
+        user_project_id=user_project_id,
+        changelog_id=changelog.id,
+        job_id=get_update_user_project_job_id(changelog.id),
+        depends_on=depends_on,
+    )
+
+
+def is_update_job_lost(changelog_id: int) -> bool:
+    """Whether the job of a pending update is gone, or failed before
+    starting it, so that the update would never run.
+
+    A job that has finished without starting the update, because it waits
+    for a deployment, is not lost, as finish_deployment enqueues it again.
+    Enqueueing it once more does no harm either.
+    """
+    job = get_update_user_project_job(changelog_id)
+    return job is None or job.is_failed or job.is_stopped or job.is_canceled
 
 
-def run_deployer(site, user_project):
+def get_finish_deployment_job_id(changelog_id: int) -> str:
+    return f"finish_deployment-{changelog_id}"
+
+
+def is_finish_deployment_job_lost(changelog_id: int) -> bool:
+    """Whether the finish_deployment job of a changelog is gone, or failed
+    before finishing the update, so that the update would stay deploying.
+    """
+    try:
+        job = Job.fetch(
+            get_finish_deployment_job_id(changelog_id), connection=queue.connection,
+        )
+    except NoSuchJobError:
+        return True
+    return job.is_failed or job.is_stopped or job.is_canceled
+
+
+def submit_deployment(site, user_project, live_log=None):
     project = user_project.get_project()
     deployer = get_deployer(project.deployment_type)
-    result = deployer.run(site=site, user_project=user_project)
+    result = deployer.submit(site=site, user_project=user_project, live_log=live_log)
     if result["ok"]:
-        user_project.set_app_url(result["app_url"])
+        result["deployment"].update(
+            type=project.deployment_type,
+            submitted=datetime.utcnow().isoformat(),
+        )
     return result
 
 
@@ -171,33 +354,41 @@ def run_checker(site, user_project):
     project = user_project.get_project()
     user = user_project.get_user()
 
-    result = run_checks(
-        capstone_url=project.get_site().get_url(),
-        capstone_token=config.runner_capstone_token,
-        project_name=project.name,
-        username=user.username,
-    )
+    # runner clones the user's repo with objects from the mirror
+    git.update_mirror(user_project.git_url)
+
+    # same commits with same checks give the same result, don't grade again.
+    # the runner grades user_commit, even if there are newer pushes
+    cache_key = {
+        "user_commit": git.get_mirror_head(user_project.git_url),
+        # mirror is updated by update_project
+        "project_commit": project.git_url and git.get_mirror_head(project.git_url),
+        "checks_hash": project.get_checks_hash(),
+    }
+    is_cacheable = all(cache_key.values())
+
+    grading_result = is_cacheable and user_project.get_grading_result(**cache_key)
+    if grading_result:
+        logger.info(f"Using grading result {grading_result.id} for {cache_key}")
+        result = grading_result.result
+    else:
+        result = run_checks(
+            capstone_url=project.get_site().get_url(),
+            capstone_token=config.runner_capstone_token,
+            site_name=site.name,
+            project_name=project.name,
+            username=user.username,
+            commit=cache_key["user_commit"],
+        )
 
     if not result["ok"]:
-        raise Exception(f"result is not OK: {result['log']}")
-
-    task_results = result["tasks"]
-
-    with db.db.transaction():
-        for task, task_result in zip(project.get_tasks(), task_results):
-            task_status = user_project.get_task_status(task=task)
-            if task_status is None:
-                task_status = user_project.update_task_status(task=task, status="Pending")
-            for check, check_result in zip(task.get_checks(), task_result["checks"]):
-                task_status.update_check_status(
-                    check=check,
-                    status=check_result["status"],
-                    message=check_result["message"]
-                )
-            user_project.update_task_status(
-                task=task,
-                status=task_status.compute_status()
-            )
-        user_project.set_in_progress_task()
+        # nothing to apply, the caller saves the log of the failure
+        return result
+
+    if is_cacheable and not grading_result and not has_errors(result):
+        # saved before statuses, so that they can be written again from it
+        user_project.save_grading_result(**cache_key, result=result)
+
+    user_project.apply_check_results(result["tasks"])
 
     return result
@@ -0,0 +1,127 @@
+"""Archival of old changelog rows.
+
+Rows older than a cutoff are written to a gzipped JSON lines file in
+`<data_dir>/changelog-archive/`, and deleted. Updates that are still
+pending or running are kept. When changelog is partitioned by month (see
+`schema.partition_changelog`), partitions left empty are dropped.
+
+Logs saved as private files (see `Changelog.set_log`) are written inline in
+the details of archived rows, like logs of old changelogs, and their files
+are deleted.
+"""
+import gzip
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+
+from capstone import config
+from capstone.db import db, invalidate, iter_query
+from capstone.utils import files
+
+ARCHIVE_DIR = Path(config.data_dir) / "changelog-archive"
+
+ARCHIVE_CONDITION = (
+    "timestamp < $before"
+    " AND coalesce(details->>'status', '') NOT IN ('pending', 'running')"
+)
+
+
+def archive_changelogs(before: datetime, archive_dir: Path = ARCHIVE_DIR) -> tuple[Path | None, int]:
+    """Archives and deletes changelog rows older than `before`.
+
+    Returns the archive file and the number of archived rows.
+    """
+    archive_dir.mkdir(parents=True, exist_ok=True)
+    now = datetime.utcnow()
+    path = archive_dir / f"changelog-before-{before:%Y%m%d}-{now:%Y%m%dT%H%M%S}.jsonl.gz"
+    tmp_path = path.with_name("." + path.name)
+
+    vars = {"before": before}
+    log_keys = []
+    with db.transaction():
+        # the rows that are deleted are exactly the rows that were written
+        db.query("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+
+        count = 0
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            rows = iter_query(
+                f"SELECT * FROM changelog WHERE {ARCHIVE_CONDITION} ORDER BY id", vars,
+            )
+            for row in rows:
+                if "log_file" in row["details"]:
+                    log_keys.append(get_log_key(row))
+                f.write(json.dumps(with_inline_log(row), default=str) + "\n")
+                count += 1
+
+        if count == 0:
+            tmp_path.unlink()
+            return None, 0
+
+        os.rename(tmp_path, path)
+        db.query(f"DELETE FROM changelog WHERE {ARCHIVE_CONDITION}", vars=vars)
+        invalidate("changelog")
+        drop_empty_partitions(before)
+
+    # only after the rows are gone, the logs are in the archive now
+    for key in log_keys:
+        delete_log(key)
+
+    return path, count
+
+
+def get_log_key(row: dict[str, Any]) -> str:
+    """Key of the private file with the log of a changelog row, as used by
+    `Site.get_private_file`.
+    """
+    return f"{row['site_id']}/{row['details']['log_file']}"
+
+
+def with_inline_log(row: dict[str, Any]) -> dict[str, Any]:
+    if "log_file" not in row["details"]:
+        return row
+    try:
+        with files.get_private_file(get_log_key(row)) as f:
+            log = gzip.decompress(f.read()).decode("utf-8")
+    except files.FileNotFound:
+        return row
+
+    details = {k: v for k, v in row["details"].items() if k != "log_file"}
+    details["log"] = log
+    return dict(row, details=details)
+
+
+def delete_log(key: str) -> None:
+    path = files.get_private_file_path(key)
+    path.unlink(missing_ok=True)
+    try:
+        # changelogs/<id>/ only has the log
+        path.parent.rmdir()
+    except OSError:
+        pass
+
+
+def drop_empty_partitions(before: datetime) -> list[str]:
+    """Drops monthly partitions of changelog that end before `before` and
+    have no rows left.
+    """
+    rows = list(db.query("""
+        SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = 'changelog' AND c.relname ~ '^changelog_[0-9]{4}_[0-9]{2}$'
+    """))
+
+    dropped = []
+    for row in rows:
+        # FOR VALUES FROM ('2024-05-01 00:00:00') TO ('2024-06-01 00:00:00')
+        end = datetime.fromisoformat(row.bound.split("TO ('")[1][:10])
+        if end > before:
+            continue
+        if db.query(f"SELECT 1 FROM {row.name} LIMIT 1").first() is not None:
+            continue
+        db.query(f"DROP TABLE {row.name}")
+        dropped.append(row.name)
+    return dropped
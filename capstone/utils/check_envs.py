@@ -0,0 +1,113 @@
+"""Cache of check environments, i.e. installed requirements of projects.
+
+Environments are built with `runner/runner/envs.py`, using the same python
+as the runner, when a project is updated. They live in `<data_dir>/envs/`,
+one directory per hash of requirements.txt, which is passed to the runner
+with `--env-cache-dir`. So grading a push doesn't need pip or network.
+
+The cache is kept under `config.runner_env_cache_budget_mb` by evicting
+environments that were least recently used. Runners of the pool touch their
+environment on every request, so environments used within
+`config.runner_pool_idle_timeout` may still be in use and are never evicted.
+"""
+import logging
+import shutil
+import subprocess
+import time
+from pathlib import Path
+
+from capstone import config
+
+logger = logging.getLogger(__name__)
+
+ENVS_DIR = Path(config.data_dir) / "envs"
+RUNNER_DIR = Path(__file__).parent.parent.parent / "runner"
+
+# path of ENVS_DIR inside runner containers
+CONTAINER_ENVS_DIR = "/envs"
+
+COMPLETE_MARKER = ".complete"
+
+
+def runner_uses_docker() -> bool:
+    if config.runner_pool_mode:
+        return config.runner_pool_mode == "docker"
+    return not config.capstone_dev
+
+
+def build_env(requirements_path: Path) -> str:
+    """Builds the environment for requirements.txt, if it isn't already
+    in the cache, and evicts old environments. Returns the key of the
+    environment.
+    """
+    ENVS_DIR.mkdir(parents=True, exist_ok=True)
+    requirements_path = requirements_path.resolve()
+
+    if runner_uses_docker():
+        cmd = [
+            "docker", "run", "--rm",
+            "--network", "host",
+            "--volume", f"{ENVS_DIR.resolve()}:{CONTAINER_ENVS_DIR}",
+            "--volume", f"{requirements_path}:/tmp/requirements.txt:ro",
+            "--workdir", "/code",
+            "--entrypoint", "python3",
+            config.runner_docker_image,
+            "-m", "runner.envs", "/tmp/requirements.txt", CONTAINER_ENVS_DIR,
+        ]
+    else:
+        cmd = [
+            config.runner_devmode_python_executable,
+            "-m", "runner.envs", str(requirements_path), str(ENVS_DIR.resolve()),
+        ]
+
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, check=True, cwd=RUNNER_DIR)
+    key = proc.stdout.decode("utf-8").strip().splitlines()[-1]
+    logger.info(f"Check environment is ready: {key}")
+
+    evict_envs(max_bytes=config.runner_env_cache_budget_mb * 1024 * 1024)
+    return key
+
+
+def evict_envs(max_bytes: int) -> list[str]:
+    """Deletes least recently used environments until the cache fits in
+    max_bytes. The most recently used one, and the ones that a running
+    runner may use, are always kept.
+
+    Returns keys of the deleted environments.
+    """
+    envs = sorted(
+        (
+            env_dir for env_dir in ENVS_DIR.iterdir()
+            if (env_dir / COMPLETE_MARKER).is_file()
+        ),
+        key=lambda env_dir: (env_dir / COMPLETE_MARKER).stat().st_mtime,
+    )
+    sizes = {env_dir: get_size(env_dir) for env_dir in envs}
+    total = sum(sizes.values())
+
+    in_use_since = time.time() - config.runner_pool_idle_timeout
+
+    evicted = []
+    for env_dir in envs[:-1]:
+        if total <= max_bytes:
+            break
+        if (env_dir / COMPLETE_MARKER).stat().st_mtime > in_use_since:
+            # sorted by last use, all the remaining ones may be in use
+            break
+        logger.info(f"Evicting check environment {env_dir.name}")
+        shutil.rmtree(env_dir)
+        total -= sizes[env_dir]
+        evicted.append(env_dir.name)
+
+    return evicted
+
+
+def get_size(path: Path) -> int:
+    return sum(p.lstat().st_size for p in path.rglob("*"))
+
+
+def get_runner_options(in_container: bool) -> list[str]:
+    """Options for run-checks.py to use the cache.
+    """
+    envs_dir = CONTAINER_ENVS_DIR if in_container else str(ENVS_DIR.resolve())
+    return ["--env-cache-dir", envs_dir]
@@ -1,10 +1,13 @@
 from __future__ import annotations
 
+import hashlib
 import json
 import os
 import shutil
 import tempfile
+import threading
 from pathlib import Path
+from typing import Any
 
 from pydantic import BaseModel, validator
 
@@ -83,6 +86,7 @@ def load_from_package(site: db.Site, path: os.PathLike, overwrite: bool = True)
 
         course_dir = get_course_dir(course)
         update_course_dir(course_dir=course_dir, contents_dir=contents_path)
+        write_manifest(course)
 
     return course
 
@@ -124,3 +128,113 @@ def get_course_dir(course: db.Course) -> Path:
 
 def get_site_courses_dir(site: db.Site) -> Path:
     return Path(config.data_dir) / "courses" / site.name
+
+
+# course manifest
+#
+# The outline of a course and the prev/next links of every lesson are
+# computed when the course is loaded, and saved as manifest.json in the
+# course directory. Lesson pages are rendered from the manifest and the
+# lesson files, without querying the database.
+
+MANIFEST_FILENAME = "manifest.json"
+
+# manifest path -> (mtime_ns of the file, manifest)
+_manifests: dict[Path, tuple[int, dict[str, Any]]] = {}
+_manifests_lock = threading.Lock()
+
+
+def get_manifest_path(site: db.Site, course_name: str) -> Path:
+    return get_site_courses_dir(site) / course_name / MANIFEST_FILENAME
+
+
+def build_manifest(course: db.Course) -> dict[str, Any]:
+    course.prefetch("modules.lessons")
+    lessons_dir = get_lessons_dir(course)
+
+    modules = []
+    entries: list[dict[str, Any]] = []
+    for module in course.get_modules():
+        module_entries = []
+        for lesson in module.get_lessons():
+            module_entries.append({
+                "name": lesson.name,
+                "title": lesson.title,
+                "path": lesson.path,
+                "url": f"{course.get_url()}/lessons/{module.name}/{lesson.name}",
+            })
+        modules.append({"name": module.name, "title": module.title, "lessons": module_entries})
+        entries.extend(module_entries)
+
+    prev_entries: list[dict[str, Any] | None] = [None, *entries]
+    next_entries: list[dict[str, Any] | None] = [*entries[1:], None]
+    for prev_entry, entry, next_entry in zip(prev_entries, entries, next_entries):
+        entry["prev"] = prev_entry and {"title": prev_entry["title"], "url": prev_entry["url"]}
+        entry["next"] = next_entry and {"title": next_entry["title"], "url": next_entry["url"]}
+
+    manifest = {
+        "name": course.name,
+        "title": course.title,
+        "url": course.get_url(),
+        "modules": modules,
+    }
+
+    # changes when the outline or any lesson changes, used for ETags
+    h = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode("utf-8"))
+    for entry in entries:
+        lesson_path = lessons_dir / entry["path"]
+        if lesson_path.is_file():
+            h.update(lesson_path.read_bytes())
+    manifest["version"] = h.hexdigest()[:16]
+
+    return manifest
+
+
+def write_manifest(course: db.Course) -> dict[str, Any]:
+    manifest = build_manifest(course)
+    path = get_course_dir(course) / MANIFEST_FILENAME
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=".manifest-", dir=path.parent)
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+    return manifest
+
+
+def delete_manifest(course: db.Course) -> None:
+    (get_course_dir(course) / MANIFEST_FILENAME).unlink(missing_ok=True)
+
+
+def get_manifest(site: db.Site, course_name: str) -> dict[str, Any] | None:
+    """Returns the manifest of the course, or None if the course has none.
+
+    Manifests are kept in memory until the file changes.
+    """
+    path = get_manifest_path(site, course_name)
+    try:
+        mtime = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    with _manifests_lock:
+        cached = _manifests.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    manifest = json.loads(path.read_text())
+    with _manifests_lock:
+        _manifests[path] = (mtime, manifest)
+    return manifest
+
+
+def find_lesson(
+    manifest: dict[str, Any], module_name: str, lesson_name: str,
+) -> tuple[dict[str, Any], dict[str, Any]] | None:
+    """Returns the module and the lesson from the manifest.
+    """
+    for module in manifest["modules"]:
+        if module["name"] == module_name:
+            for lesson in module["lessons"]:
+                if lesson["name"] == lesson_name:
+                    return module, lesson
+    return None
@@ -0,0 +1,250 @@
+"""Connection pool for the web.py database.
+
+Each process (gunicorn worker, rq worker, cli) has one pool. web.py takes
+a connection from the pool for a query or a transaction, and gives it back
+when it commits or rolls back, so connections are shared by all threads of
+the process and the number of connections is bounded by `max_size`.
+
+Connections that are idle for longer than `idle_timeout` are closed, down to
+`min_size`. A connection that has been idle for `health_check_interval` is
+checked with `SELECT 1` before it is handed out, and replaced if it's broken.
+
+The pool is reset in a forked child (rq forks a work horse for every job),
+as connections of the parent must not be used by the child.
+"""
+from __future__ import annotations
+
+import os
+import threading
+import time
+from typing import Any, Callable
+
+from psycopg2.extensions import (
+    TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN, connection,
+)
+from web.db import PostgresDB, dburl2dict
+
+# Connections inherited from the parent process over a fork. They are kept
+# referenced, because closing them, even by garbage collection, would also
+# close them for the parent, which shares the same sockets.
+_inherited_connections: list[connection] = []
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        connect: Callable[[], connection],
+        min_size: int = 1,
+        max_size: int = 10,
+        idle_timeout: float = 300,
+        wait_timeout: float = 30,
+        health_check_interval: float = 30,
+    ):
+        assert 0 <= min_size <= max_size, "min_size must be between 0 and max_size"
+
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self.health_check_interval = health_check_interval
+
+        self._reset()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset(self) -> None:
+        self._lock = threading.Condition()
+        # (connection, time when it was given back), most recent last
+        self._idle: list[tuple[connection, float]] = []
+        self._in_use: set[connection] = set()
+        # open connections, and connections being opened
+        self._size = 0
+
+        self._waiting = 0
+        self._created = 0
+        self._closed = 0
+
+    def _after_fork(self) -> None:
+        _inherited_connections.extend(conn for conn, _ in self._idle)
+        _inherited_connections.extend(self._in_use)
+        self._reset()
+
+    def getconn(self) -> connection:
+        """Returns a connection from the pool, opening a new one if all are
+        in use and the pool isn't full, or else waiting for one to be given
+        back. Raises PoolTimeout after waiting for `wait_timeout` seconds.
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            with self._lock:
+                conn, last_used = self._checkout(deadline)
+
+            if conn is None:
+                return self._open()
+            if self._is_healthy(conn, last_used):
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn: connection) -> None:
+        """Gives a connection back to the pool, rolling back a transaction
+        that was left open.
+        """
+        with self._lock:
+            if conn not in self._in_use:
+                # not from this pool, or from before a fork
+                return
+
+        if conn.closed or conn.info.transaction_status == TRANSACTION_STATUS_UNKNOWN:
+            self._discard(conn)
+            return
+
+        if conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                self._discard(conn)
+                return
+
+        with self._lock:
+            self._in_use.discard(conn)
+            self._idle.append((conn, time.monotonic()))
+            self._lock.notify()
+
+    def get_stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size,
+                "in_use": len(self._in_use),
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "created": self._created,
+                "closed": self._closed,
+            }
+
+    def _checkout(self, deadline: float) -> tuple[connection | None, float]:
+        """Takes an idle connection, or reserves room for a new connection,
+        in which case the connection is None. Must hold the lock.
+        """
+        while True:
+            self._close_expired()
+
+            if self._idle:
+                conn, last_used = self._idle.pop()
+                self._in_use.add(conn)
+                return conn, last_used
+
+            if self._size < self.max_size:
+                self._size += 1
+                return None, 0
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise PoolTimeout(
+                    f"No connection available in {self.wait_timeout} seconds "
+                    f"(max_size={self.max_size})"
+                )
+            self._waiting += 1
+            try:
+                self._lock.wait(remaining)
+            finally:
+                self._waiting -= 1
+
+    def _open(self) -> connection:
+        try:
+            conn = self.connect()
+        except Exception:
+            with self._lock:
+                self._size -= 1
+                self._lock.notify()
+            raise
+
+        with self._lock:
+            self._created += 1
+            self._in_use.add(conn)
+        return conn
+
+    def _is_healthy(self, conn: connection, last_used: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except Exception:
+            return False
+        else:
+            return True
+
+    def _discard(self, conn: connection) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+        with self._lock:
+            self._in_use.discard(conn)
+            self._size -= 1
+            self._closed += 1
+            self._lock.notify()
+
+    def _close_expired(self) -> None:
+        """Closes connections idle for longer than idle_timeout, oldest
+        first, keeping min_size connections. Must hold the lock.
+        """
+        now = time.monotonic()
+        while (
+            self._idle and
+            self._size > self.min_size and
+            now - self._idle[0][1] > self.idle_timeout
+        ):
+            conn, _ = self._idle.pop(0)
+            try:
+                conn.close()
+            except Exception:
+                pass
+            self._size -= 1
+            self._closed += 1
+
+
+class PooledPostgresDB(PostgresDB):
+    """web.py postgres database with connections from a ConnectionPool.
+    """
+    def __init__(self, pool_options: dict[str, Any], **keywords: Any):
+        super().__init__(**keywords)
+
+        # makes web.py give the connection back after commit and rollback
+        self.has_pooling = True
+        self.pool = ConnectionPool(
+            connect=lambda: PostgresDB._connect(self, self.keywords),
+            **pool_options,
+        )
+
+        # the forking thread keeps its thread local context in the child
+        os.register_at_fork(after_in_child=self._ctx.clear)
+
+    def _connect_with_pooling(self, keywords: dict[str, Any]) -> connection:
+        return self.pool.getconn()
+
+    def _unload_context(self, ctx: Any) -> None:
+        conn = ctx.db
+        del ctx.db
+        self.pool.putconn(conn)
+
+
+def pooled_database(dburl: str, **pool_options: Any) -> PooledPostgresDB:
+    """Like `web.database`, for postgres URLs, with a connection pool.
+    """
+    params = dburl2dict(dburl)
+    dbn = params.pop("dbn")
+    if dbn not in ("postgres", "postgresql"):
+        raise ValueError(f"Only postgres databases can be pooled, not {dbn}")
+    return PooledPostgresDB(pool_options, **params)
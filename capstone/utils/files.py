@@ -6,15 +6,21 @@ Primary function of this module is to provide basic security such as
 not allowing relative paths in keys and making sure files are only
 written within the designated private directory.
 """
+import hashlib
+import os
 import re
+import tempfile
 from pathlib import Path
-from typing import IO
+from typing import IO, Callable, NamedTuple
 
 from capstone import config
 
 
 PRIVATE_FILES_DIR = Path(config.data_dir) / "private"
 
+# bytes read from a stream at a time
+CHUNK_SIZE = 1024 * 1024
+
 # only allow ascii letters, numbers, spaces, and these chars: -_./
 key_pattern = re.compile(r"^[a-zA-Z0-9\-\_\.\/ ]+$")
 
@@ -31,22 +37,56 @@ class InvalidKey(FilesException):
     pass
 
 
+class InvalidFile(FilesException):
+    pass
+
+
+class SavedFile(NamedTuple):
+    path: Path
+    size: int
+    sha256: str
+
+
 def ensure_private_files_dir():
     PRIVATE_FILES_DIR.mkdir(parents=True, exist_ok=True)
 
 
-def save_private_file(key: str, stream: IO[bytes]) -> Path:
+def save_private_file(
+    key: str, stream: IO[bytes], check: Callable[[Path], None] | None = None,
+) -> SavedFile:
+    """Saves a private file from a binary stream, read in chunks.
+
+    The data is written to a temporary file next to the file, which then
+    replaces it, so the file is never seen partially written. `check` is
+    called with the path of the temporary file before that, and the file
+    is discarded if it raises. The SHA-256 checksum is computed while
+    writing.
+    """
     ensure_private_files_dir()
     validate_key(key)
 
     path = get_private_file_path(key)
     path.parent.mkdir(parents=True, exist_ok=True)
 
-    with open(path, "wb") as f:
-        for data in stream:
-            f.write(data)
-
-    return path
+    checksum = hashlib.sha256()
+    size = 0
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    tmp_path = Path(tmp_name)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while data := stream.read(CHUNK_SIZE):
+                checksum.update(data)
+                f.write(data)
+                size += len(data)
+        if check is not None:
+            check(tmp_path)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+
+    return SavedFile(path=path, size=size, sha256=checksum.hexdigest())
 
 
 def get_private_file(key: str) -> IO[bytes]:
@@ -58,6 +98,18 @@ def get_private_file(key: str) -> IO[bytes]:
     return open(path, "rb")
 
 
+def get_private_file_etag(key: str) -> str:
+    """Returns an ETag for a private file. It changes whenever the file is
+    saved, as every save replaces the file with a new one.
+    """
+    path = get_private_file_path(key)
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        raise FileNotFound(f"Private file not found: {key}")
+    return f"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
 def get_private_file_path(key: str) -> Path:
     validate_key(key)
     return PRIVATE_FILES_DIR / key
@@ -1,7 +1,18 @@
+import fcntl
+import hashlib
 import os
+import shutil
 import subprocess
 import sys
+from contextlib import contextmanager
 from pathlib import Path
+from typing import Iterator
+
+from capstone import config as capstone_config
+
+# Bare mirrors of remote repositories, one per git URL. Clones are made
+# from the mirror after fetching only what's new.
+MIRRORS_DIR = Path(capstone_config.data_dir) / "git-mirrors"
 
 
 class Repo:
@@ -80,6 +91,14 @@ def clone(*args, workdir=None, **kwargs):
     return True
 
 
+def checkout(*args, workdir=None, **kwargs):
+    cmd = build_cmd("checkout", options=kwargs, args=args)
+
+    # TODO: handle gracefully when proc fails
+    proc = subprocess.run(cmd, stdout=sys.stdout, stderr=sys.stderr, check=True, cwd=workdir)
+    return True
+
+
 def rev_parse(*args, workdir=None, **kwargs):
     cmd = build_cmd("rev-parse", options=kwargs, args=args)
 
@@ -88,6 +107,76 @@ def rev_parse(*args, workdir=None, **kwargs):
     return proc.stdout.decode("utf-8").strip()
 
 
+def clone_cached(url: str, path: str | os.PathLike, ref: str | None = None) -> str:
+    """Clones url into path, like `clone`, but through the local mirror of
+    url, so that only new commits are fetched from the remote.
+
+    Checks out ref if given, otherwise the default branch. The clone doesn't
+    depend on the mirror, and its origin is url. Returns the commit hash
+    that is checked out.
+    """
+    path = os.fspath(path)
+    with mirror_lock(url):
+        mirror = _update_mirror(url)
+        clone(str(mirror), path)
+
+    config("remote.origin.url", url, workdir=path)
+    if ref is not None:
+        checkout(ref, detach=True, workdir=path)
+    return rev_parse("HEAD", workdir=path)
+
+
+def update_mirror(url: str) -> Path:
+    """Fetches url into its local mirror, creating the mirror on first
+    use. Returns the path of the mirror.
+    """
+    with mirror_lock(url):
+        return _update_mirror(url)
+
+
+def _update_mirror(url: str) -> Path:
+    mirror = get_mirror_path(url)
+    if mirror.is_dir():
+        cmd = ["git", "--git-dir", str(mirror), "fetch", "--prune", "origin"]
+        subprocess.run(cmd, stdout=sys.stdout, stderr=sys.stderr, check=True)
+        return mirror
+
+    # clone next to the mirror, so that a failed clone is never used
+    tmp = mirror.with_suffix(".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    cmd = ["git", "clone", "--mirror", url, str(tmp)]
+    subprocess.run(cmd, stdout=sys.stdout, stderr=sys.stderr, check=True)
+    os.rename(tmp, mirror)
+    return mirror
+
+
+def get_mirror_head(url: str) -> str | None:
+    """Returns the commit hash of HEAD in the local mirror of url, without
+    fetching. None if there is no mirror yet.
+    """
+    mirror = get_mirror_path(url)
+    if not mirror.is_dir():
+        return None
+    return rev_parse("HEAD", workdir=mirror)
+
+
+def get_mirror_path(url: str) -> Path:
+    # runner/runner/__init__.py:get_mirror_path must match this
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return MIRRORS_DIR / f"{key}.git"
+
+
+@contextmanager
+def mirror_lock(url: str) -> Iterator[None]:
+    MIRRORS_DIR.mkdir(parents=True, exist_ok=True)
+    with open(get_mirror_path(url).with_suffix(".lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def build_cmd(
     subcommand: str,
     *,
@@ -0,0 +1,130 @@
+"""Conditional GET and caching headers for pages and API responses.
+
+Views decorated with `conditional` get an ETag, and a Last-Modified header,
+derived from the `last_modified` columns of what they show. A request with
+a matching If-None-Match or If-Modified-Since gets a 304 without running
+the view.
+
+Public responses can be cached by a CDN or a reverse proxy for
+`config.http_cache_max_age` seconds. Pages depend on the session (navbar,
+progress, flashed messages), so they are public only for visitors without
+a session, and are never cached for logged in users.
+"""
+from __future__ import annotations
+
+import hashlib
+from datetime import datetime, timezone
+from functools import wraps
+from typing import Any, Callable
+
+from flask import make_response, request, session
+from flask.typing import ResponseReturnValue
+
+from capstone import config, db
+
+# (parts of the ETag, time of the last change), or None to not cache
+Validators = tuple[list[Any], datetime | None]
+
+
+def conditional(
+    get_validators: Callable[..., Validators | None], public: bool = True,
+    vary: tuple[str, ...] = (),
+) -> Callable:
+    """Decorator for views that handles conditional GET requests.
+
+    `get_validators` is called with the arguments of the view. It should be
+    much cheaper than the view, and return None when the view would fail
+    (not found, unauthorized), so that the view handles it.
+
+    Private responses, e.g. for authenticated API calls, may only be cached
+    by the client, which must revalidate them. `vary` lists request headers,
+    other than Cookie, that change the response.
+    """
+    def decorator(view: Callable[..., ResponseReturnValue]) -> Callable:
+        @wraps(view)
+        def wrapper(*args: Any, **kwargs: Any) -> ResponseReturnValue:
+            if request.method not in ("GET", "HEAD"):
+                return view(*args, **kwargs)
+
+            if public and session:
+                response = make_response(view(*args, **kwargs))
+                response.cache_control.private = True
+                response.cache_control.no_cache = True
+                return response
+
+            validators = get_validators(*args, **kwargs)
+            if validators is None:
+                return view(*args, **kwargs)
+
+            parts, last_modified = validators
+            etag = make_etag(*parts)
+            if last_modified is not None:
+                # last_modified columns are in UTC, HTTP dates have no microseconds
+                last_modified = last_modified.replace(tzinfo=timezone.utc, microsecond=0)
+
+            if is_not_modified(etag, last_modified):
+                response = make_response("", 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            if public:
+                response.cache_control.public = True
+                response.cache_control.max_age = config.http_cache_max_age
+            else:
+                response.cache_control.private = True
+                response.cache_control.no_cache = True
+            response.vary.add("Cookie")
+            for header in vary:
+                response.vary.add(header)
+            return response
+        return wrapper
+    return decorator
+
+
+def make_etag(*parts: Any) -> str:
+    h = hashlib.sha256(repr(parts).encode("utf-8"))
+    return h.hexdigest()[:32]
+
+
+def is_not_modified(etag: str, last_modified: datetime | None) -> bool:
+    # If-Modified-Since is ignored when If-None-Match is given (RFC 9110)
+    if request.if_none_match:
+        return etag in request.if_none_match
+    if last_modified is not None and request.if_modified_since is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def latest(*times: datetime | None) -> datetime | None:
+    return max((t for t in times if t is not None), default=None)
+
+
+# validators of common resources
+
+def get_projects_validators(site: db.Site, **filters: Any) -> Validators:
+    count, last_modified = db.find_last_modified("project", site_id=site.id, **filters)
+    return (
+        ["projects", site.id, site.last_modified, count, last_modified],
+        latest(site.last_modified, last_modified),
+    )
+
+
+def get_project_validators(site: db.Site, name: str) -> Validators | None:
+    project = site.get_project(name=name)
+    if project is None:
+        return None
+
+    # tasks are saved, or deleted, whenever they or their checks change
+    count, tasks_last_modified = db.find_last_modified("task", project_id=project.id)
+    return (
+        [
+            "project", project.id, site.last_modified, project.last_modified,
+            count, tasks_last_modified,
+        ],
+        latest(site.last_modified, project.last_modified, tasks_last_modified),
+    )
@@ -0,0 +1,74 @@
+"""Live logs of running updates.
+
+While an update of a user project runs, its output is appended line by line
+to a Redis stream of the changelog, and clients follow it with the
+Server-Sent Events endpoint `/api/users/<username>/projects/<name>/changelog/<id>/log`.
+
+When the update is finished, an end entry is added, and the stream expires
+after `EXPIRE_SECONDS`. The full log is saved in the changelog (see
+`Changelog.set_log`), so losing a live log only loses the live view. That's
+why failures to write are logged and ignored.
+"""
+import logging
+from functools import lru_cache
+
+from redis import Redis
+
+from capstone import config
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "capstone:changelog-log:"
+
+# older lines are trimmed, the stream is only for following the update
+MAX_LINES = 10000
+EXPIRE_SECONDS = 3600
+
+
+@lru_cache()
+def get_redis() -> Redis:
+    if config.capstone_test:
+        from fakeredis import FakeRedis
+        return FakeRedis(decode_responses=True)
+    return Redis.from_url(config.redis_url, decode_responses=True)
+
+
+def get_key(changelog_id: int) -> str:
+    return f"{KEY_PREFIX}{changelog_id}"
+
+
+class LiveLog:
+    def __init__(self, changelog_id: int):
+        self.key = get_key(changelog_id)
+
+    def write(self, line: str) -> None:
+        self._add({"line": line})
+
+    def close(self, status: str) -> None:
+        """Marks the end of the log, with the final status of the update.
+        """
+        self._add({"end": status})
+        try:
+            get_redis().expire(self.key, EXPIRE_SECONDS)
+        except Exception:
+            logger.exception(f"Failed to set expiry of live log {self.key}")
+
+    def _add(self, fields: dict[str, str]) -> None:
+        try:
+            get_redis().xadd(self.key, fields, maxlen=MAX_LINES, approximate=True)
+        except Exception:
+            logger.exception(f"Failed to write to live log {self.key}")
+
+
+def read(changelog_id: int, last_id: str = "0", block: int | None = None) -> list[tuple[str, dict[str, str]]]:
+    """Returns the entries of the live log after `last_id`, waiting up to
+    `block` milliseconds for new entries if there are none.
+
+    Each entry is (entry id, fields). Fields are either {"line": ...} or,
+    for the last entry, {"end": status}.
+    """
+    response = get_redis().xread({get_key(changelog_id): last_id}, block=block)
+    if not response:
+        return []
+    [(_, entries)] = response
+    return entries
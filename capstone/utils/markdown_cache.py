@@ -0,0 +1,57 @@
+"""Cached, thread-safe markdown rendering.
+
+`markdown.Markdown` keeps state between calls of `convert`, so an instance
+can't be shared by the threads of a worker. Every thread gets its own
+instance for each set of extensions.
+
+Rendered HTML is kept in an LRU cache keyed by the hash of the text and the
+extensions. As the key is the text itself, an updated project or task
+description simply gets a new entry, and old entries are evicted.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+import markdown
+
+MAX_ENTRIES = 2048
+
+# fenced code and tables, with code highlighted for codehilite-styles.css
+DEFAULT_EXTENSIONS = ("extra", "codehilite")
+
+_local = threading.local()
+
+# (hash of text, extensions) -> html
+_cache: OrderedDict[tuple[str, tuple[str, ...]], str] = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def render_markdown(text: str, extensions: tuple[str, ...] = DEFAULT_EXTENSIONS) -> str:
+    key = (hashlib.sha256(text.encode("utf-8")).hexdigest(), extensions)
+    with _cache_lock:
+        html = _cache.get(key)
+        if html is not None:
+            _cache.move_to_end(key)
+            return html
+
+    html = get_renderer(extensions).reset().convert(text)
+
+    with _cache_lock:
+        _cache[key] = html
+        while len(_cache) > MAX_ENTRIES:
+            _cache.popitem(last=False)
+    return html
+
+
+def get_renderer(extensions: tuple[str, ...]) -> markdown.Markdown:
+    """Returns the markdown instance of this thread for the extensions.
+    """
+    renderers = vars(_local).setdefault("renderers", {})
+    if extensions not in renderers:
+        renderers[extensions] = markdown.Markdown(extensions=list(extensions))
+    return renderers[extensions]
+
+
+def clear() -> None:
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,205 @@
+"""Pool of long-lived check runners, one per project.
+
+Each runner is `runner/run-checks.py --serve`, which clones the project,
+installs its requirements and imports its checks once, and then grades
+users sent to it over a unix socket. So a push only needs to clone the
+learner's repository and run the checks.
+
+Runners are started on demand by whichever rq job needs them first, and
+they outlive that job. They are found again through their socket, which
+lives under `<data_dir>/runners/`. A runner exits when it's idle for
+`config.runner_pool_idle_timeout` seconds, or when it's stopped with
+`stop_runner` because the project has changed.
+
+Two modes are supported, set with `config.runner_pool_mode`:
+- "docker": runner is started in a `capstone-runner` container
+- "subprocess": runner is started as a local process, for development and
+  testing without docker
+"""
+import fcntl
+import json
+import logging
+import socket
+import subprocess
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator
+
+from capstone import config
+
+from . import check_envs, git
+
+logger = logging.getLogger(__name__)
+
+RUNNERS_DIR = Path(config.data_dir) / "runners"
+RUNNER_PATH = Path(__file__).parent.parent.parent / "runner" / "run-checks.py"
+
+
+class RunnerNotAvailable(Exception):
+    pass
+
+
+def run_checks(
+    capstone_url: str, capstone_token: str, site_name: str, project_name: str,
+    username: str, commit: str | None = None,
+) -> dict[str, Any]:
+    """Grades the user with the project's runner, starting it if needed.
+
+    Returns the same result as `capstone.utils.user_project.run_checks`.
+    """
+    name = get_runner_name(site_name=site_name, project_name=project_name)
+    ensure_runner(
+        name,
+        capstone_url=capstone_url,
+        capstone_token=capstone_token,
+        project_name=project_name,
+    )
+    return send_request(
+        get_socket_path(name),
+        {"username": username, "commit": commit},
+        timeout=config.runner_pool_job_timeout,
+    )
+
+
+def stop_runner(site_name: str, project_name: str) -> bool:
+    """Stops the project's runner, if it is running. Next grading job
+    starts a new one with the latest checks of the project.
+
+    Returns whether a runner was stopped.
+    """
+    name = get_runner_name(site_name=site_name, project_name=project_name)
+    with runner_lock(name):
+        if not is_running(name):
+            return False
+        send_request(get_socket_path(name), {"command": "shutdown"}, timeout=10)
+        return True
+
+
+def ensure_runner(
+    name: str, capstone_url: str, capstone_token: str, project_name: str,
+) -> None:
+    # lock, so that concurrent jobs for the same project don't both start one
+    with runner_lock(name):
+        if is_running(name):
+            return
+
+        logger.info(f"Starting runner {name} ({config.runner_pool_mode})")
+        process = start_runner(
+            name,
+            capstone_url=capstone_url,
+            capstone_token=capstone_token,
+            project_name=project_name,
+        )
+        wait_for_runner(name, process=process)
+
+
+def start_runner(
+    name: str, capstone_url: str, capstone_token: str, project_name: str,
+) -> subprocess.Popen:
+    options = [
+        "--capstone-url", capstone_url,
+        "--capstone-token", capstone_token,
+        "--project-name", project_name,
+        "--parallelism", str(config.runner_parallelism),
+        "--check-timeout", str(config.runner_check_timeout),
+        "--idle-timeout", str(config.runner_pool_idle_timeout),
+    ]
+
+    if config.runner_pool_mode == "subprocess":
+        cmd = [
+            config.runner_devmode_python_executable, str(RUNNER_PATH),
+            "--serve", str(get_socket_path(name)),
+            *options,
+            *check_envs.get_runner_options(in_container=False),
+            "--git-mirror-dir", str(git.MIRRORS_DIR.resolve()),
+        ]
+    elif config.runner_pool_mode == "docker":
+        cmd = [
+            "docker", "run", "--rm",
+            "--name", f"capstone-runner-{name}",
+            "--network", "host",
+            "--volume", f"{RUNNERS_DIR.resolve()}:/runners",
+            "--volume",
+            f"{check_envs.ENVS_DIR.resolve()}:{check_envs.CONTAINER_ENVS_DIR}",
+            "--volume", f"{git.MIRRORS_DIR.resolve()}:/git-mirrors:ro",
+            config.runner_docker_image,
+            "--serve", f"/runners/{name}.sock",
+            *options,
+            *check_envs.get_runner_options(in_container=True),
+            "--git-mirror-dir", "/git-mirrors",
+        ]
+    else:
+        raise ValueError(f"Unknown runner pool mode: {config.runner_pool_mode}")
+
+    # new session, so that the runner outlives the rq job that started it
+    with open(get_log_path(name), "ab") as log_file:
+        return subprocess.Popen(
+            cmd, stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True,
+        )
+
+
+def wait_for_runner(name: str, process: subprocess.Popen) -> None:
+    deadline = time.monotonic() + config.runner_pool_start_timeout
+    while not is_running(name):
+        if process.poll() is not None:
+            raise RunnerNotAvailable(
+                f"Runner {name} exited with status {process.returncode}\n"
+                f"{get_log_path(name).read_text()}"
+            )
+        if time.monotonic() > deadline:
+            process.kill()
+            raise RunnerNotAvailable(
+                f"Runner {name} did not start in "
+                f"{config.runner_pool_start_timeout} seconds\n"
+                f"{get_log_path(name).read_text()}"
+            )
+        time.sleep(1)
+
+
+def is_running(name: str) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(get_socket_path(name)))
+        except (FileNotFoundError, ConnectionRefusedError):
+            return False
+        else:
+            return True
+
+
+def send_request(
+    socket_path: Path, request: dict[str, Any], timeout: float | None = None,
+) -> dict[str, Any]:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(socket_path))
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with sock.makefile("rb") as f:
+            response = f.readline()
+
+    if not response:
+        raise RunnerNotAvailable(f"Runner closed the connection: {socket_path}")
+    return json.loads(response)
+
+
+@contextmanager
+def runner_lock(name: str) -> Iterator[None]:
+    RUNNERS_DIR.mkdir(parents=True, exist_ok=True)
+    with open(RUNNERS_DIR / f"{name}.lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def get_runner_name(site_name: str, project_name: str) -> str:
+    return f"{site_name}-{project_name}"
+
+
+def get_socket_path(name: str) -> Path:
+    return RUNNERS_DIR / f"{name}.sock"
+
+
+def get_log_path(name: str) -> Path:
+    return RUNNERS_DIR / f"{name}.log"
@@ -0,0 +1,123 @@
+"""In-process cache of sites by domain.
+
+Every request, including static files and course media, looks up the site
+of its domain. Sites rarely change, so lookups are cached for
+`config.site_cache_ttl` seconds. Unknown domains are cached too, for
+`config.site_cache_negative_ttl` seconds, so that requests for random hosts
+don't reach the database.
+
+When a site is created or changed, `notify_site_changed` publishes its domain
+on a Redis channel, and every process drops the entry of that domain. If
+Redis is not reachable, entries still expire after the TTL.
+"""
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from redis import Redis
+
+from capstone import config
+from capstone.db import Site
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "capstone:site-changed"
+
+# max number of cached domains, most of them would be unknown domains
+MAX_ENTRIES = 10000
+
+# domain -> (row of the site or None if not found, expiry time)
+_entries: OrderedDict[str, tuple[dict | None, float]] = OrderedDict()
+_lock = threading.Lock()
+
+# pid of the process that runs the subscriber thread, it's not inherited
+# over fork
+_subscriber_pid: int | None = None
+
+
+def get_site(domain: str) -> Site | None:
+    """Returns the site of the domain, or None if there is no such site.
+    """
+    _ensure_subscriber()
+
+    now = time.monotonic()
+    with _lock:
+        entry = _entries.get(domain)
+    row: dict | None
+    if entry is not None and entry[1] > now:
+        row = entry[0]
+    else:
+        found = Site.find(domain=domain)
+        row = found.get_dict() if found is not None else None
+        ttl = config.site_cache_ttl if found is not None else config.site_cache_negative_ttl
+        with _lock:
+            _entries[domain] = (row, now + ttl)
+            _entries.move_to_end(domain)
+            while len(_entries) > MAX_ENTRIES:
+                _entries.popitem(last=False)
+
+    # a new object for every request, as documents are not shared by threads
+    if row is None:
+        return None
+    return Site.from_db(row)
+
+
+def invalidate(domain: str | None = None) -> None:
+    """Drops the cached site of the domain, or all cached sites if domain
+    is None. Only for this process, see notify_site_changed.
+    """
+    with _lock:
+        if domain is None:
+            _entries.clear()
+        else:
+            _entries.pop(domain, None)
+
+
+def notify_site_changed(*domains: str) -> None:
+    """Invalidates the cached sites of the domains in all processes.
+
+    Pass both the old and the new domain when the domain of a site changes.
+    """
+    for domain in domains:
+        invalidate(domain)
+
+    if config.capstone_test:
+        return
+    try:
+        redis = Redis.from_url(config.redis_url)
+        for domain in domains:
+            redis.publish(CHANNEL, domain)
+    except Exception:
+        logger.exception("Failed to publish change of sites %s", domains)
+
+
+def _ensure_subscriber() -> None:
+    global _subscriber_pid
+    if config.capstone_test or _subscriber_pid == os.getpid():
+        return
+
+    with _lock:
+        if _subscriber_pid == os.getpid():
+            return
+        _subscriber_pid = os.getpid()
+        # entries inherited from the parent may have missed invalidations
+        _entries.clear()
+
+    thread = threading.Thread(target=_subscribe, name="site-cache", daemon=True)
+    thread.start()
+
+
+def _subscribe() -> None:
+    while True:
+        try:
+            pubsub = Redis.from_url(config.redis_url).pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CHANNEL)
+            # invalidations may have been missed while not subscribed
+            invalidate()
+            for message in pubsub.listen():
+                invalidate(message["data"].decode("utf-8"))
+        except Exception:
+            logger.exception("Lost subscription to site changes, retrying")
+            time.sleep(5)
@@ -10,7 +10,7 @@ from typing import Any
 import docker
 from toolkit import setup_logger
 
-from . import git, gitto
+from . import check_envs, git, gitto, runner_pool
 from capstone import config, db
 
 setup_logger()
@@ -82,9 +82,11 @@ def extract_zipfile(src: str, dst: str) -> None:
 
 
 def run_checks(
-    capstone_url: str, capstone_token: str, project_name: str, username: str
+    capstone_url: str, capstone_token: str, site_name: str, project_name: str,
+    username: str, commit: str | None = None,
 ) -> dict[str, Any]:
-    """
+    """Grades `commit` of the user's repository, or its latest commit.
+
     Returns result:
     {
         "ok": True|False,
@@ -94,13 +96,27 @@ def run_checks(
                 "checks": [
                     {
                         "status": "pass"|"fail"|"error",
-                        "message": str|None
+                        "message": str|None,
+                        "duration": float  # seconds
                     }
-                ]
+                ],
+                "duration": float  # seconds
             }
         ]
     }
     """
+    if config.runner_pool_mode:
+        logger.info(f"Running checks in runner pool ({config.runner_pool_mode})")
+        return runner_pool.run_checks(
+            capstone_url=capstone_url,
+            capstone_token=capstone_token,
+            site_name=site_name,
+            project_name=project_name,
+            username=username,
+            commit=commit,
+        )
+
+    commit_options = ["--commit", commit] if commit else []
     runner_path = Path(__file__).parent.parent.parent / "runner" / "run-checks.py"
 
     with tempfile.TemporaryDirectory() as tmp:
@@ -116,7 +132,12 @@ def run_checks(
                     "--capstone-token", capstone_token,
                     "--project-name", project_name,
                     "--username", username,
+                    *commit_options,
                     "--output", result_file,
+                    "--parallelism", str(config.runner_parallelism),
+                    "--check-timeout", str(config.runner_check_timeout),
+                    *check_envs.get_runner_options(in_container=False),
+                    "--git-mirror-dir", str(git.MIRRORS_DIR.resolve()),
                 ],
                 cwd=tmp,
             )
@@ -130,7 +151,12 @@ def run_checks(
                     "--capstone-token", capstone_token,
                     "--project-name", project_name,
                     "--username", username,
+                    *commit_options,
                     "--output", "/output/result.json",
+                    "--parallelism", str(config.runner_parallelism),
+                    "--check-timeout", str(config.runner_check_timeout),
+                    *check_envs.get_runner_options(in_container=True),
+                    "--git-mirror-dir", "/git-mirrors",
                 ],
                 auto_remove=True,
                 network_mode="host",
@@ -138,6 +164,12 @@ def run_checks(
                 stderr=True,
                 volumes={
                     tmp: {"bind": "/output", "mode": "rw"},
+                    str(check_envs.ENVS_DIR.resolve()): {
+                        "bind": check_envs.CONTAINER_ENVS_DIR, "mode": "rw",
+                    },
+                    str(git.MIRRORS_DIR.resolve()): {
+                        "bind": "/git-mirrors", "mode": "ro",
+                    },
                 },
             )
             logger.info(f"Container exited. Logs: {logs}")
@@ -1,26 +1,69 @@
 import argparse
+import asyncio
+import hashlib
 import importlib
 import json
+import os
+import socketserver
 import subprocess
 import sys
 import tempfile
+import threading
+import time
 import traceback
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterator
 
 import requests
 from capstone_checker import run_check
 
+from .envs import activate_env, get_env_dir, touch_env
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--capstone-url', required=True)
     parser.add_argument('-t', '--capstone-token', required=True)
     parser.add_argument('-p', '--project-name', required=True)
-    parser.add_argument('-u', '--username', required=True)
+    parser.add_argument('-u', '--username', required=False)
+    parser.add_argument(
+        '--commit', required=False,
+        help='commit of the user repository to grade, instead of its latest commit',
+    )
     parser.add_argument('-o', '--output', required=False)
+    parser.add_argument(
+        '--serve', metavar='SOCKET_PATH', required=False,
+        help='keep checks of the project loaded, and grade users sent over '
+             'this unix socket instead of grading a single --username',
+    )
+    parser.add_argument(
+        '--idle-timeout', type=float, default=3600,
+        help='seconds after which an idle server exits (only with --serve)',
+    )
+    parser.add_argument(
+        '--parallelism', type=int, default=4,
+        help='maximum number of checks of a task to run at the same time',
+    )
+    parser.add_argument(
+        '--check-timeout', type=float, default=60,
+        help='seconds after which a check is reported as an error',
+    )
+    parser.add_argument(
+        '--git-mirror-dir', required=False,
+        help='directory with bare mirrors of git repositories, maintained by '
+             'capstone, to clone with objects from',
+    )
+    parser.add_argument(
+        '--env-cache-dir', required=False,
+        help='directory with prebuilt requirements of projects, '
+             'pip is used only when requirements are not found there',
+    )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if not args.serve and not args.username:
+        parser.error("one of --username or --serve is required")
+    return args
 
 
 def get_user_project(capstone_url, capstone_token, project_name, username):
@@ -93,11 +136,29 @@ def get_project(
     )
 
 
-def clone_repository(git_url: str, dest_dir: str) -> None:
-    subprocess.check_call(["git", "clone", git_url, dest_dir])
+def clone_repository(
+    git_url: str, dest_dir: str, git_mirror_dir: str | None = None,
+    commit: str | None = None,
+) -> None:
+    cmd = ["git", "clone"]
+    if git_mirror_dir:
+        # objects that are in the mirror aren't fetched again
+        cmd += ["--reference-if-able", str(get_mirror_path(git_url, git_mirror_dir))]
+    subprocess.check_call([*cmd, git_url, dest_dir])
+    if commit:
+        subprocess.check_call(["git", "checkout", "--quiet", commit], cwd=dest_dir)
 
 
-def install_requirements(filepath: str) -> None:
+def get_mirror_path(git_url: str, git_mirror_dir: str) -> Path:
+    # same as capstone.utils.git.get_mirror_path
+    key = hashlib.sha256(git_url.encode("utf-8")).hexdigest()
+    return Path(git_mirror_dir) / f"{key}.git"
+
+
+def install_requirements(filepath: str, env_cache_dir: str | None = None) -> None:
+    if env_cache_dir and activate_env(Path(filepath), Path(env_cache_dir)):
+        print("Using cached requirements", file=sys.stderr)
+        return
     subprocess.check_call(["pip", "install", "-r", filepath])
 
 
@@ -110,11 +171,142 @@ def load_custom_checks(parent_dir: Path) -> None:
             sys.path.remove(str(parent_dir))
 
 
-def run_checks_until_task_fails(
-    capstone_url: str, capstone_token: str, project_name: str, username: str
+def run_check_with_timing(
+    check: dict[str, Any], context: dict[str, Any]
+) -> dict[str, Any]:
+    start = time.perf_counter()
+    try:
+        check_status = run_check(check["name"], context=context, args=check["args"])
+        status, message = check_status.status, check_status.message
+    except Exception:
+        status, message = "error", traceback.format_exc()
+
+    return {
+        "status": status,
+        "message": message,
+        "duration": round(time.perf_counter() - start, 3),
+    }
+
+
+def run_in_daemon_thread(f, *args) -> asyncio.Future:
+    """Calls f in a new daemon thread, and returns a future of its result.
+
+    Unlike executor threads, a daemon thread that never returns can be
+    abandoned, as it doesn't keep the process alive at exit.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def set_result(result):
+        # the future is cancelled when the check timed out
+        if not future.done():
+            future.set_result(result)
+
+    def target():
+        result = f(*args)
+        try:
+            loop.call_soon_threadsafe(set_result, result)
+        except RuntimeError:
+            # the event loop is closed, nobody waits for this result
+            pass
+
+    threading.Thread(target=target, daemon=True).start()
+    return future
+
+
+async def run_task_checks(
+    checks: list[dict[str, Any]],
+    context: dict[str, Any],
+    semaphore: asyncio.Semaphore,
+    check_timeout: float,
 ) -> list[dict[str, Any]]:
+    """Runs all checks of a task concurrently, as many at a time as the
+    semaphore allows.
+
+    Results are in the same order as checks. A check that doesn't finish
+    within check_timeout of starting is reported as an error. Its thread
+    can't be interrupted, so it is abandoned and keeps running in the
+    background until it returns.
+    """
+    async def run_one(check):
+        # the timeout starts when the check starts, not while it waits
+        async with semaphore:
+            future = run_in_daemon_thread(run_check_with_timing, check, context)
+            try:
+                return await asyncio.wait_for(future, timeout=check_timeout)
+            except asyncio.TimeoutError:
+                return {
+                    "status": "error",
+                    "message": f"check timed out after {check_timeout} seconds",
+                    "duration": check_timeout,
+                }
+
+    return await asyncio.gather(*[run_one(check) for check in checks])
+
+
+async def run_tasks_until_one_fails(
+    tasks: list[dict[str, Any]],
+    context: dict[str, Any],
+    parallelism: int,
+    check_timeout: float,
+) -> list[dict[str, Any]]:
+    """Runs tasks in order, stopping after the first task that has
+    a check that doesn't pass. Checks within a task run in parallel.
+    """
+    semaphore = asyncio.Semaphore(parallelism)
+    task_results = []
+    for task in tasks:
+        start = time.perf_counter()
+        check_results = await run_task_checks(
+            task["checks"], context=context,
+            semaphore=semaphore, check_timeout=check_timeout,
+        )
+        task_results.append(
+            {
+                "name": task["name"],
+                "checks": check_results,
+                "duration": round(time.perf_counter() - start, 3),
+            },
+        )
+        if any(c["status"] != "pass" for c in check_results):
+            # TODO: logger?
+            break
+
+    return task_results
+
+
+def setup_project(
+    capstone_url: str, capstone_token: str, project_name: str, project_dir: Path,
+    env_cache_dir: str | None = None, git_mirror_dir: str | None = None,
+) -> None:
+    """Clones the project repository, installs its requirements, and loads
+    its custom checks into this process.
+    """
+    project = get_project(
+        capstone_url=capstone_url,
+        capstone_token=capstone_token,
+        project_name=project_name
+    )
+    clone_repository(
+        git_url=project["git_url"],
+        dest_dir=str(project_dir),
+        git_mirror_dir=git_mirror_dir,
+    )
+    install_requirements(
+        str(project_dir / "requirements.txt"), env_cache_dir=env_cache_dir,
+    )
+    load_custom_checks(parent_dir=project_dir)
+
+
+def grade_user_project(
+    capstone_url: str, capstone_token: str, project_name: str, username: str,
+    parallelism: int = 4, check_timeout: float = 60,
+    git_mirror_dir: str | None = None, commit: str | None = None,
+) -> list[dict[str, Any]]:
+    """Runs checks on the user's repository, at `commit` if given. Checks
+    of the project must already be loaded with `setup_project`.
+    """
     with tempfile.TemporaryDirectory() as tmp_dir:
-        project_dir = Path(tmp_dir) / "project"
         user_project_dir = Path(tmp_dir) / "user_project"
 
         project = get_project(
@@ -122,8 +314,6 @@ def run_checks_until_task_fails(
             capstone_token=capstone_token,
             project_name=project_name
         )
-        clone_repository(git_url=project["git_url"], dest_dir=str(project_dir))
-
         user_project = get_user_project(
             capstone_url=capstone_url,
             capstone_token=capstone_token,
@@ -134,59 +324,222 @@ def run_checks_until_task_fails(
 
         clone_repository(
             git_url=user_project["git_url"],
-            dest_dir=str(user_project_dir)
+            dest_dir=str(user_project_dir),
+            git_mirror_dir=git_mirror_dir,
+            commit=commit,
         )
 
-        install_requirements(str(project_dir / "requirements.txt"))
-        load_custom_checks(parent_dir=project_dir)
-
-        task_results = []
         context = {"app_url": app_url, "app_dir": user_project_dir}
-        for task in project["tasks"]:
-            check_results = []
-            for check in task["checks"]:
-                check_status = run_check(
-                    check["name"], context=context, args=check["args"]
-                )
-                check_results.append(
-                    {
-                        "status": check_status.status,
-                        "message": check_status.message
-                    }
-                )
-
-            task_results.append(
-                {
-                    "name": task["name"],
-                    "checks": check_results
-                },
+        return asyncio.run(
+            run_tasks_until_one_fails(
+                project["tasks"],
+                context=context,
+                parallelism=parallelism,
+                check_timeout=check_timeout,
             )
-            if any(c["status"] != "pass" for c in check_results):
-                # TODO: logger?
-                break
-
-        return task_results
-
-
-def main():
-    args = parse_args()
+        )
 
-    capstone_url = args.capstone_url
-    capstone_token = args.capstone_token
-    project_name = args.project_name
-    username = args.username
-    output_stream = open(args.output, "w") if args.output else sys.stdout
 
-    try:
-        task_results = run_checks_until_task_fails(
+def run_checks_until_task_fails(
+    capstone_url: str, capstone_token: str, project_name: str, username: str,
+    parallelism: int = 4, check_timeout: float = 60,
+    env_cache_dir: str | None = None, git_mirror_dir: str | None = None,
+    commit: str | None = None,
+) -> list[dict[str, Any]]:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        setup_project(
+            capstone_url=capstone_url,
+            capstone_token=capstone_token,
+            project_name=project_name,
+            project_dir=Path(tmp_dir) / "project",
+            env_cache_dir=env_cache_dir,
+            git_mirror_dir=git_mirror_dir,
+        )
+        return grade_user_project(
             capstone_url=capstone_url,
             capstone_token=capstone_token,
             project_name=project_name,
             username=username,
+            parallelism=parallelism,
+            check_timeout=check_timeout,
+            git_mirror_dir=git_mirror_dir,
+            commit=commit,
         )
+
+
+def get_result(f, **kwargs) -> dict[str, Any]:
+    """Calls f, which must return task results, and returns the result
+    in the format documented in README.md.
+    """
+    try:
+        task_results = f(**kwargs)
     except Exception:
-        result = {"ok": False, "log": traceback.format_exc(), "tasks": None}
-        json.dump(result, output_stream)
+        return {"ok": False, "log": traceback.format_exc(), "tasks": None}
     else:
-        result = {"ok": True, "log": None, "tasks": task_results}
-        json.dump(result, output_stream)
+        return {"ok": True, "log": None, "tasks": task_results}
+
+
+class GradingRequestHandler(socketserver.StreamRequestHandler):
+    """Handles one request per connection.
+
+    Each request is a line of JSON, either `{"username": "...", "commit": ...}`
+    to grade a user, or `{"command": "shutdown"}` to stop the server. The response
+    is a line of JSON with the result.
+    """
+    server: "GradingServer"
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # connection was only made to check if the server is up
+            return
+        request = json.loads(line)
+
+        if request.get("command") == "shutdown":
+            # new requests must go to the next runner from now on
+            self.server.remove_socket()
+            self.server.is_shutting_down = True
+            response = {"ok": True}
+        else:
+            with self.server.track_request():
+                response = get_result(
+                    grade_user_project,
+                    username=request["username"],
+                    commit=request.get("commit"),
+                    **self.server.grading_options,
+                )
+
+        self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+
+class GradingServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    # requests being graded are finished before the server exits
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(
+        self, socket_path: str, grading_options: dict[str, Any], idle_timeout: float,
+        env_dir: Path | None = None,
+    ):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, GradingRequestHandler)
+        # socket may be used from outside the container, by another user
+        os.chmod(socket_path, 0o777)
+        self.socket_path = socket_path
+        # to not remove the socket of the next runner at the same path
+        self.socket_inode = os.stat(socket_path).st_ino
+
+        self.grading_options = grading_options
+        self.idle_timeout = idle_timeout
+        # kept recently used while the server runs, see evict_envs in capstone
+        self.env_dir = env_dir
+        self.last_active = time.monotonic()
+        self.active_requests = 0
+        self.lock = threading.Lock()
+        self.is_shutting_down = False
+
+        # handle_request returns after this many seconds without a request,
+        # so that the main loop can notice shutdown and idle timeout
+        self.timeout = 1
+
+    def process_request(self, request, client_address):
+        self.mark_active()
+        super().process_request(request, client_address)
+
+    @contextmanager
+    def track_request(self) -> Iterator[None]:
+        with self.lock:
+            self.active_requests += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active_requests -= 1
+            self.mark_active()
+
+    def mark_active(self) -> None:
+        self.last_active = time.monotonic()
+        if self.env_dir:
+            touch_env(self.env_dir)
+
+    def is_idle(self) -> bool:
+        with self.lock:
+            return (
+                self.active_requests == 0 and
+                time.monotonic() - self.last_active > self.idle_timeout
+            )
+
+    def remove_socket(self) -> None:
+        """Removes the socket file, so that no new connections are made to
+        this server, unless it's already the socket of another server.
+        """
+        try:
+            if os.stat(self.socket_path).st_ino == self.socket_inode:
+                os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+
+
+def serve(args) -> None:
+    """Loads the project's checks once, and then grades users sent over
+    a unix socket until shutdown or idle timeout.
+    """
+    grading_options = {
+        "capstone_url": args.capstone_url,
+        "capstone_token": args.capstone_token,
+        "project_name": args.project_name,
+        "parallelism": args.parallelism,
+        "check_timeout": args.check_timeout,
+        "git_mirror_dir": args.git_mirror_dir,
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        setup_project(
+            capstone_url=args.capstone_url,
+            capstone_token=args.capstone_token,
+            project_name=args.project_name,
+            project_dir=Path(tmp_dir) / "project",
+            env_cache_dir=args.env_cache_dir,
+            git_mirror_dir=args.git_mirror_dir,
+        )
+
+        requirements_path = Path(tmp_dir) / "project" / "requirements.txt"
+        env_dir = (
+            get_env_dir(requirements_path, Path(args.env_cache_dir))
+            if args.env_cache_dir else None
+        )
+
+        with GradingServer(args.serve, grading_options, args.idle_timeout, env_dir) as server:
+            print(f"Listening on {args.serve}", file=sys.stderr)
+            while not server.is_shutting_down:
+                if server.is_idle():
+                    print("Idle timeout reached, shutting down", file=sys.stderr)
+                    server.remove_socket()
+                    break
+                server.handle_request()
+            # stop accepting now, requests being graded are finished on close
+            server.socket.close()
+
+
+def main():
+    args = parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    output_stream = open(args.output, "w") if args.output else sys.stdout
+    result = get_result(
+        run_checks_until_task_fails,
+        capstone_url=args.capstone_url,
+        capstone_token=args.capstone_token,
+        project_name=args.project_name,
+        username=args.username,
+        parallelism=args.parallelism,
+        check_timeout=args.check_timeout,
+        env_cache_dir=args.env_cache_dir,
+        git_mirror_dir=args.git_mirror_dir,
+        commit=args.commit,
+    )
+    json.dump(result, output_stream)
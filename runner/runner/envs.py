@@ -0,0 +1,108 @@
+"""Cache of installed requirements of projects.
+
+Requirements of a project are installed once with `pip install --target`
+into a directory of the cache, named after the hash of requirements.txt
+and the python version. Runners add that directory to `sys.path` instead of
+running pip for every grading run.
+
+Environments are built by capstone when a project is updated:
+
+```
+python3 -m runner.envs path/to/requirements.txt path/to/cache
+```
+
+A `.complete` file marks an environment as ready. Its modification time is
+the last time the environment was used, so that capstone can evict
+the least recently used environments.
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+COMPLETE_MARKER = ".complete"
+
+
+def get_env_key(requirements_path: Path) -> str:
+    python_version = f"{sys.version_info.major}.{sys.version_info.minor}"
+    h = hashlib.sha256(python_version.encode("utf-8"))
+    h.update(b"\0")
+    h.update(requirements_path.read_bytes())
+    return h.hexdigest()
+
+
+def get_env_dir(requirements_path: Path, cache_dir: Path) -> Path:
+    return cache_dir / get_env_key(requirements_path)
+
+
+def is_env_ready(env_dir: Path) -> bool:
+    return (env_dir / COMPLETE_MARKER).is_file()
+
+
+def touch_env(env_dir: Path) -> None:
+    try:
+        (env_dir / COMPLETE_MARKER).touch()
+    except OSError:
+        # cache may be mounted read-only, LRU order is only a hint
+        pass
+
+
+def build_env(requirements_path: Path, cache_dir: Path) -> Path:
+    """Installs the requirements into the cache, unless they are already
+    there, and returns the directory of the environment.
+    """
+    env_dir = get_env_dir(requirements_path, cache_dir)
+    if is_env_ready(env_dir):
+        touch_env(env_dir)
+        return env_dir
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # build next to the final directory, so that rename is atomic
+    build_dir = Path(tempfile.mkdtemp(prefix=f".build-{env_dir.name}-", dir=cache_dir))
+    try:
+        subprocess.check_call(
+            [
+                sys.executable, "-m", "pip", "install",
+                "--no-input", "--disable-pip-version-check",
+                "--target", str(build_dir),
+                "-r", str(requirements_path),
+            ]
+        )
+        (build_dir / COMPLETE_MARKER).touch()
+        try:
+            os.rename(build_dir, env_dir)
+        except OSError:
+            # built at the same time by someone else
+            if not is_env_ready(env_dir):
+                raise
+    finally:
+        shutil.rmtree(build_dir, ignore_errors=True)
+
+    return env_dir
+
+
+def activate_env(requirements_path: Path, cache_dir: Path) -> bool:
+    """Adds the cached environment of the requirements to `sys.path`.
+
+    Returns False, without changing anything, if it hasn't been built.
+    """
+    env_dir = get_env_dir(requirements_path, cache_dir)
+    if not is_env_ready(env_dir):
+        return False
+
+    sys.path.insert(0, str(env_dir))
+    touch_env(env_dir)
+    return True
+
+
+def main():
+    requirements_path, cache_dir = sys.argv[1:]
+    env_dir = build_env(Path(requirements_path), Path(cache_dir))
+    print(env_dir.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,7 @@ import pytest
 
 from capstone.app import app as _app
 from capstone import db
+from capstone.utils import site_cache
 
 
 @pytest.fixture(autouse=True)
@@ -16,6 +17,7 @@ def setup_db():
     """Fixture to start every test with a clean database.
     """
     db.db.query("TRUNCATE site CASCADE")
+    site_cache.invalidate()
 
 @contextmanager
 def safe_popen(*args, **kwargs):
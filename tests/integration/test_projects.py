@@ -2,6 +2,7 @@
 
 Viewing, creating, updating projects should be tested here.
 """
+import hashlib
 import re
 import subprocess
 import yaml
@@ -240,3 +241,34 @@ def test_project_tasks_can_be_reordered_by_author(capstone_app, tmp_path):
     assert expected_foo_task.name == "foo"
     assert expected_foo_task.title == "Foo!"
     assert len(expected_foo_task.get_checks()) == 1
+
+
+def test_repo_zip_can_be_uploaded_and_downloaded(api_client, tmp_path):
+    site = api_client.create_site(name="test", domain="test")
+    (tmp_path / "test.txt").write_text("hello")
+    subprocess.check_call(["zip", "repo.zip", "test.txt"], cwd=tmp_path)
+    data = (tmp_path / "repo.zip").read_bytes()
+
+    response = site.put("/api/projects/test-project/repo.zip", data=b"not a zip", check_status=False)
+    assert response.status_code == 400
+
+    response = site.put("/api/projects/test-project/repo.zip", data=data, check_status=False)
+    assert response.status_code == 201
+    assert response.json == {"size": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+
+    response = site.get("/api/projects/test-project/repo.zip")
+    assert response.data == data
+    etag = response.headers["ETag"]
+
+    response = site.get(
+        "/api/projects/test-project/repo.zip",
+        headers={**site.headers, "If-None-Match": etag}, check_status=False,
+    )
+    assert response.status_code == 304
+
+    response = site.get(
+        "/api/projects/test-project/repo.zip",
+        headers={**site.headers, "Range": "bytes=0-3"}, check_status=False,
+    )
+    assert response.status_code == 206
+    assert response.data == data[:4]
@@ -1,12 +1,16 @@
 import re
 import subprocess
 import tempfile
+import time
 import yaml
 from pathlib import Path
 from textwrap import dedent
 
 import requests
 
+from capstone import db
+from capstone.deployment.watcher import DeploymentWatcher
+from capstone.tasks import finish_deployment
 from capstone.utils import git
 from .conftest import capstone_app, create_site, create_project, create_user, create_user_project
 
@@ -70,6 +74,26 @@ def setup_project_for_deployment_and_checks(project):
         repo.push()
 
 
+def finish_deployments(timeout=120):
+    """Waits for the submitted deployments and finishes their updates, like
+    the deployment watcher, which doesn't run in tests.
+    """
+    deadline = time.monotonic() + timeout
+    while not (deploying := db.Changelog.find_deploying()):
+        assert time.monotonic() < deadline, "No deployment was submitted"
+        time.sleep(1)
+
+    watcher = DeploymentWatcher()
+    for changelog in deploying:
+        result = watcher.wait_for_result(changelog.details["deployment"])
+        finish_deployment(
+            site_id=changelog.site_id,
+            user_project_id=changelog.details["user_project_id"],
+            changelog_id=changelog.id,
+            result=result,
+        )
+
+
 def test_project_can_be_started_by_learner(capstone_app):
     site = create_site(name="localhost", domain="localhost")
     user = create_user(site, email="learner@example.com")
@@ -119,6 +143,7 @@ def test_user_project_gets_deployed_and_checked(capstone_app, tmp_path):
     repo = git.Repo.clone_from(user_project.git_url, tmp_path / "user-project")
     repo.commit(message="deploy and check", allow_empty=True)
     repo.push()
+    finish_deployments()
 
     # Test deployment:
     # TODO: find some more robust way to test deployment? 
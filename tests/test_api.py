@@ -0,0 +1,71 @@
+"""Tests of the API that don't need Nomad or deployments.
+"""
+
+
+def test_list_projects_conditional_get(api_client):
+    site = api_client.create_site(name="test", domain="test")
+    response = site.get("/api/projects")
+    etag = response.headers["ETag"]
+
+    response = site.get(
+        "/api/projects", headers={"If-None-Match": etag}, check_status=False,
+    )
+    assert response.status_code == 304
+
+    site.put("/api/projects/test-project", json={
+        "title": "Test Project",
+        "short_description": "",
+        "description": "",
+        "tags": [],
+        "tasks": [],
+    })
+    response = site.get("/api/projects", headers={"If-None-Match": etag})
+    assert response.headers["ETag"] != etag
+
+
+def put_project(site, tasks):
+    site.put("/api/projects/test-project", json={
+        "title": "Test Project",
+        "short_description": "",
+        "description": "",
+        "tags": [],
+        "tasks": tasks,
+    })
+
+
+def test_get_project_conditional_get(api_client):
+    site = api_client.create_site(name="test", domain="test")
+    task = {"name": "foo", "title": "Foo", "description": "", "checks": []}
+    put_project(site, [task])
+
+    response = site.get("/api/projects/test-project")
+    assert response.json["name"] == "test-project"
+    etag = response.headers["ETag"]
+
+    response = site.get(
+        "/api/projects/test-project",
+        headers={**site.headers, "If-None-Match": etag}, check_status=False,
+    )
+    assert response.status_code == 304
+
+    # only a check of a task changes
+    check = {"name": "check_not_implemented", "title": "Bar", "args": {}}
+    put_project(site, [{**task, "checks": [check]}])
+    response = site.get(
+        "/api/projects/test-project", headers={**site.headers, "If-None-Match": etag},
+    )
+    assert response.headers["ETag"] != etag
+
+
+def test_project_page_conditional_get(api_client):
+    site = api_client.create_site(name="test", domain="test")
+    put_project(site, [{"name": "foo", "title": "Foo", "description": "", "checks": []}])
+
+    response = site.get("/projects/test-project")
+    assert "Test Project" in response.text
+    etag = response.headers["ETag"]
+
+    response = site.get(
+        "/projects/test-project", headers={"If-None-Match": etag}, check_status=False,
+    )
+    assert response.status_code == 304
@@ -1,8 +1,15 @@
+import gzip
 import pytest
 import json
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 
 from capstone import db
+from capstone.api import generate_log_events
+from capstone.deployment import watcher
+from capstone.tasks import is_update_job_lost, run_checker
+from capstone.utils.changelog_archive import archive_changelogs
+from capstone.utils.live_log import LiveLog
 
 
 def test_query():
@@ -485,3 +492,472 @@ class TestUserTaskStatus:
 
         user_task_status.update_check_status(task_check, "fail")
         assert user_task_status.get_check_status(task_check).status == "fail"
+
+
+class TestSession:
+    def test_find_is_served_from_identity_map(self, project_id, monkeypatch):
+        with db.session():
+            project = db.Project.find(id=project_id)
+
+            def find_all(*args, **kwargs):
+                raise AssertionError("row should be in the identity map")
+
+            monkeypatch.setattr(db, "find_all", find_all)
+            assert db.Project.find(id=project_id).title == project.title
+
+    def test_invalidate_after_raw_write(self, project_id):
+        with db.session():
+            db.Project.find(id=project_id)
+            db.db.update("project", where="id=$id", vars={"id": project_id}, title="Changed")
+            db.invalidate("project")
+            assert db.Project.find(id=project_id).title == "Changed"
+
+            db.db.update("project", where="id=$id", vars={"id": project_id}, title="Again")
+            db.invalidate("project", project_id)
+            assert db.Project.find(id=project_id).title == "Again"
+
+    def test_find_checks_other_filters_against_identity_map(self, project_id, site_id):
+        with db.session():
+            db.Project.find(id=project_id)
+            assert db.Project.find(id=project_id, site_id=site_id) is not None
+            assert db.Project.find(id=project_id, site_id=site_id+1) is None
+
+    def test_save_invalidates_identity_map(self, project_id):
+        with db.session():
+            project = db.Project.find(id=project_id)
+            project.update(title="New Title").save()
+            assert db.Project.find(id=project_id).title == "New Title"
+
+    def test_delete_invalidates_identity_map(self, project_id):
+        with db.session():
+            project = db.Project.find(id=project_id)
+            project.delete()
+            assert db.Project.find(id=project_id) is None
+
+    def test_returned_objects_do_not_share_state(self, project_id):
+        with db.session():
+            project = db.Project.find(id=project_id)
+            project.tags.append("changed")
+            assert db.Project.find(id=project_id).tags == mock_projects[0]["tags"]
+
+
+class TestPrefetch:
+    def test_find_all_with_prefetch(self, project_id, task_id):
+        db.Task.find(id=task_id).update_checks(mock_checks)
+
+        projects = db.Project.find_all(id=project_id, prefetch=["tasks.checks"])
+        tasks = projects[0].get_prefetched("tasks")
+        assert [t.id for t in tasks] == [task_id]
+        checks = tasks[0].get_prefetched("checks")
+        assert [c.name for c in checks] == [c["name"] for c in mock_checks]
+
+    def test_prefetched_relations_are_used_by_getters(self, project_id, task_id):
+        project = db.Project.find(id=project_id).prefetch("tasks")
+        db.db.delete("task", where="id=$id", vars={"id": task_id})
+        assert [t.id for t in project.get_tasks()] == [task_id]
+
+    def test_getters_order_like_prefetch(self, task_id):
+        # inserted in reverse order of position
+        db.TaskCheck.save_many([
+            db.TaskCheck(task_id=task_id, position=len(mock_checks) - i, **check)
+            for i, check in enumerate(mock_checks)
+        ])
+        prefetched = db.Task.find(id=task_id).prefetch("checks").get_checks()
+        checks = db.Task.find(id=task_id).get_checks()
+        assert [c.id for c in checks] == [c.id for c in prefetched]
+        assert [c.name for c in checks] == [c["name"] for c in reversed(mock_checks)]
+
+    def test_update_tasks_clears_prefetched_tasks(self, project_id):
+        project = db.Project.find(id=project_id).prefetch("tasks")
+        project.update_tasks(mock_tasks)
+        assert [t.name for t in project.get_tasks()] == [t["name"] for t in mock_tasks]
+
+    def test_prefetch_with_unknown_relation(self, project_id):
+        with pytest.raises(ValueError):
+            db.Project.find(id=project_id).prefetch("lessons")
+
+
+class TestSite:
+    def test_get_progress_matrix(self, site_id, user_project_id, task_id):
+        site = db.Site.find(id=site_id)
+        user_project = db.UserProject.find(id=user_project_id)
+        user_project.update_task_status(db.Task.find(id=task_id), "Completed")
+
+        [progress] = site.get_progress_matrix()
+        assert progress["user_project_id"] == user_project_id
+        assert progress["username"] == mock_user["username"]
+        assert progress["project_name"] == mock_projects[0]["name"]
+        assert progress["total_tasks"] == 1
+        assert progress["completed_tasks"] == 1
+        assert progress["percentage"] == 100
+        assert progress["status"] == "Completed"
+
+    def test_get_progress_matrix_when_no_tasks_are_completed(self, site_id, user_project_id, task_id):
+        site = db.Site.find(id=site_id)
+
+        [progress] = site.get_progress_matrix()
+        assert progress["completed_tasks"] == 0
+        assert progress["percentage"] == 0
+        assert progress["status"] == "Pending"
+
+    def test_get_progress_matrix_filters_unpublished_projects(self, site_id, user_project_id):
+        site = db.Site.find(id=site_id)
+        assert site.get_progress_matrix(is_published=True) == []
+
+    def test_get_user_projects(self, site_id, user_project_id):
+        site = db.Site.find(id=site_id)
+        assert [up.id for up in site.get_user_projects()] == [user_project_id]
+        assert site.get_user_projects(after=user_project_id) == []
+
+    def test_site_cache(self):
+        from capstone.utils import site_cache
+
+        domain = mock_site["domain"]
+        assert site_cache.get_site(domain) is None
+
+        db.Site(**mock_site).save()
+        # unknown domains are cached too
+        assert site_cache.get_site(domain) is None
+
+        site_cache.notify_site_changed(domain)
+        site = site_cache.get_site(domain)
+        assert site is not None and site.name == mock_site["name"]
+        assert site_cache.get_site(domain) is not site
+
+
+def test_find_page(site_id, project_id, project_id_2):
+    first_page = db.Project.find_page(site_id=site_id, limit=1)
+    assert [p.id for p in first_page] == [project_id]
+
+    second_page = db.Project.find_page(site_id=site_id, after=first_page[-1].id, limit=1)
+    assert [p.id for p in second_page] == [project_id_2]
+
+    assert db.Project.find_page(site_id=site_id, after=project_id_2, limit=1) == []
+
+
+def test_find_last_modified(site_id, project_id):
+    count, last_modified = db.find_last_modified("project", site_id=site_id)
+    assert count == 1
+    assert last_modified is not None
+    assert db.find_last_modified("project", site_id=site_id, name="x") == (0, None)
+
+
+def test_iter_all(site_id, project_id, project_id_2):
+    assert [p.id for p in db.Project.iter_all(site_id=site_id)] == [project_id, project_id_2]
+
+
+class TestUserProjectUpdates:
+    def test_request_update_coalesces_pending_pushes(self, user_project_id):
+        user_project = db.UserProject.find(id=user_project_id)
+
+        changelog, is_new = user_project.request_update(push={"commit": "a"})
+        assert is_new
+        changelog_2, is_new = user_project.request_update(push={"commit": "b"})
+        assert not is_new
+        assert changelog_2.id == changelog.id
+        assert changelog_2.details["pushes"] == [{"commit": "a"}, {"commit": "b"}]
+
+    def test_request_update_while_running_creates_one_follow_up(self, user_project_id):
+        user_project = db.UserProject.find(id=user_project_id)
+
+        running, _ = user_project.request_update(push={"commit": "a"})
+        user_project.start_update(changelog_id=running.id)
+
+        follow_up, is_new = user_project.request_update(push={"commit": "b"})
+        assert is_new
+        assert follow_up.details["follows"] == running.id
+
+        _, is_new = user_project.request_update(push={"commit": "c"})
+        assert not is_new
+        assert [c.details["status"] for c in user_project.get_updates()] == ["running", "pending"]
+
+    def test_start_update_waits_for_deployment(self, user_project_id):
+        user_project = db.UserProject.find(id=user_project_id)
+
+        deploying, _ = user_project.request_update(push={"commit": "a"})
+        deploying = user_project.start_update(changelog_id=deploying.id)
+        deploying.details.update(stage="deployment", deployment={"type": "custom"})
+        deploying.save()
+        assert [c.id for c in db.Changelog.find_deploying()] == [deploying.id]
+
+        follow_up, _ = user_project.request_update(push={"commit": "b"})
+        assert user_project.start_update(changelog_id=follow_up.id) is None
+
+        deploying.details["status"] = "success"
+        deploying.save()
+        assert db.Changelog.find_deploying() == []
+        assert user_project.start_update(changelog_id=follow_up.id).details["status"] == "running"
+        # not pending anymore
+        assert user_project.start_update(changelog_id=follow_up.id) is None
+
+    def test_pending_update_without_job_is_lost(self, user_project_id):
+        user_project = db.UserProject.find(id=user_project_id)
+        changelog, _ = user_project.request_update(push={"commit": "a"})
+        # never enqueued, like a job lost with its queue
+        assert is_update_job_lost(changelog.id)
+
+    def test_get_history(self, user_project_id):
+        user_project = db.UserProject.find(id=user_project_id)
+
+        failed, _ = user_project.request_update(push={"commit": "a"})
+        failed = user_project.start_update(changelog_id=failed.id)
+        failed.details.update(status="failed", log="error")
+        failed.save()
+        user_project.request_update(push={"commit": "b"})
+
+        history = user_project.get_history()
+        assert [u["status"] for u in history] == ["pending", "failed"]
+        assert history[1]["log"] == "error"
+        assert history[1]["pushes"] == [{"commit": "a"}]
+
+        [update] = user_project.get_history(status="failed", include_log=False)
+        assert update["id"] == failed.id
+        assert update["log_size"] == len("error")
+        assert "log" not in update
+
+
+    def test_follow_live_log(self, user_project_id):
+        user_project = db.UserProject.find(id=user_project_id)
+        changelog, _ = user_project.request_update(push={"commit": "a"})
+        changelog = user_project.start_update(changelog_id=changelog.id)
+
+        log = LiveLog(changelog.id)
+        log.write("$ docker build .")
+        log.write("Step 1/4")
+        log.close("success")
+
+        events = list(generate_log_events(changelog, last_id="0"))
+        assert [e.split("data: ")[1] for e in events] == [
+            "$ docker build .\n\n", "Step 1/4\n\n", "success\n\n",
+        ]
+        assert events[-1].startswith("event: end\n")
+
+        # resumed after the first line
+        last_id = events[0].split("\n")[0][len("id: "):]
+        assert len(list(generate_log_events(changelog, last_id=last_id))) == 2
+
+
+class FakeDeployer:
+    def __init__(self, results):
+        self.results = list(results)
+
+    def check(self, deployment, wait):
+        return self.results.pop(0)
+
+
+class TestDeploymentWatcher:
+    @pytest.fixture
+    def deploying(self, user_project_id):
+        user_project = db.UserProject.find(id=user_project_id)
+        changelog, _ = user_project.request_update(push={"commit": "a"})
+        changelog = user_project.start_update(changelog_id=changelog.id)
+        changelog.details.update(
+            stage="deployment",
+            deployment={"type": "fake", "submitted": datetime.utcnow().isoformat()},
+        )
+        return changelog.save()
+
+    def watch(self, deployment_watcher, changelog_id):
+        deployment_watcher.watch_new_deployments()
+        for thread in threading.enumerate():
+            if thread.name == f"deployment-{changelog_id}":
+                thread.join()
+
+    def test_wait_for_result_polls_until_finished(self, monkeypatch):
+        deployer = FakeDeployer([None, None, {"ok": True, "app_url": "http://a"}])
+        monkeypatch.setattr(watcher, "get_deployer", lambda type: deployer)
+
+        deployment_watcher = watcher.DeploymentWatcher(poll_interval=0, timeout=60)
+        deployment = {"type": "fake", "submitted": datetime.utcnow().isoformat()}
+        assert deployment_watcher.wait_for_result(deployment) == {"ok": True, "app_url": "http://a"}
+
+    def test_wait_for_result_times_out_from_submission(self, monkeypatch):
+        monkeypatch.setattr(watcher, "get_deployer", lambda type: FakeDeployer([]))
+
+        deployment_watcher = watcher.DeploymentWatcher(poll_interval=0, timeout=60)
+        submitted = datetime.utcnow() - timedelta(seconds=61)
+        deployment = {"type": "fake", "submitted": submitted.isoformat()}
+        assert not deployment_watcher.wait_for_result(deployment)["ok"]
+
+    def test_watch_new_deployments_finishes_update(self, monkeypatch, deploying):
+        deployer = FakeDeployer([{"ok": False, "log": "build failed"}])
+        monkeypatch.setattr(watcher, "get_deployer", lambda type: deployer)
+
+        deployment_watcher = watcher.DeploymentWatcher(poll_interval=0)
+        self.watch(deployment_watcher, deploying.id)
+
+        changelog = db.Changelog.find(id=deploying.id)
+        assert changelog.details["status"] == "failed"
+        assert db.Changelog.find_deploying() == []
+
+        deployment_watcher.watch_new_deployments()
+        assert deployment_watcher._watching == set()
+
+    def test_lost_finish_deployment_is_watched_again(self, monkeypatch, deploying):
+        deployer = FakeDeployer([{"ok": False, "log": "build failed"}])
+        monkeypatch.setattr(watcher, "get_deployer", lambda type: deployer)
+
+        deployment_watcher = watcher.DeploymentWatcher(poll_interval=0)
+        # enqueued before, but the job is gone
+        deployment_watcher._watching.add(deploying.id)
+        deployment_watcher._enqueued.add(deploying.id)
+        self.watch(deployment_watcher, deploying.id)
+
+        changelog = db.Changelog.find(id=deploying.id)
+        assert changelog.details["status"] == "failed"
+
+
+class TestChangelog:
+    def test_set_log(self, site_id):
+        changelog = db.Changelog(site_id=site_id, action="update_project").save()
+        log = "building...\n" * 1000
+        changelog.set_log(log)
+        changelog.save()
+
+        changelog = db.Changelog.find(id=changelog.id)
+        assert "log" not in changelog.details
+        assert changelog.details["log_size"] == len(log)
+        assert changelog.get_log() == log
+
+        f, size = changelog.open_log()
+        with f:
+            f.seek(size - 12)
+            assert f.read() == b"building...\n"
+
+    def test_open_log_when_log_is_inline(self, site_id):
+        changelog = db.Changelog(
+            site_id=site_id, action="update_project", details={"log": "error"},
+        ).save()
+        assert changelog.get_log() == "error"
+
+        changelog = db.Changelog(site_id=site_id, action="update_project").save()
+        assert changelog.open_log() is None
+        assert changelog.get_log() == ""
+
+
+class TestChangelogArchive:
+    def test_archive_changelogs(self, site_id, tmp_path):
+        old = datetime(2020, 1, 1)
+        done = db.Changelog(
+            site_id=site_id, action="update_project", timestamp=old,
+            details={"status": "success"},
+        ).save()
+        done.set_log("built\n")
+        done.save()
+        log_path = done.get_site().get_private_file_path(done.get_log_file_key())
+        assert log_path.exists()
+
+        kept = [
+            db.Changelog(
+                site_id=site_id, action="update_user_project", timestamp=old,
+                details={"status": status},
+            ).save()
+            for status in ["pending", "running"]
+        ]
+        kept.append(db.Changelog(site_id=site_id, action="update_project").save())
+
+        before = datetime(2021, 1, 1)
+        path, count = archive_changelogs(before=before, archive_dir=tmp_path)
+        assert count == 1
+        with gzip.open(path, "rt") as f:
+            [row] = [json.loads(line) for line in f]
+        assert row["id"] == done.id
+        assert row["details"]["log"] == "built\n"
+        assert not log_path.exists()
+
+        remaining = [row.id for row in db.db.select("changelog", what="id", order="id")]
+        assert remaining == [c.id for c in kept]
+        assert archive_changelogs(before=before, archive_dir=tmp_path) == (None, 0)
+
+
+class TestGradingResult:
+    def test_save_and_get_grading_result(self, user_project_id):
+        user_project = db.UserProject.find(id=user_project_id)
+        key = {"user_commit": "abc", "project_commit": "def", "checks_hash": "123"}
+        assert user_project.get_grading_result(**key) is None
+
+        user_project.save_grading_result(**key, result={"ok": True, "tasks": []})
+        user_project.save_grading_result(**key, result={"ok": True, "tasks": [{"checks": []}]})
+        assert user_project.get_grading_result(**key).result == {"ok": True, "tasks": [{"checks": []}]}
+
+    def test_run_checker_grades_each_commit_once(self, monkeypatch, user_project_id, task_id):
+        db.Task.find(id=task_id).update_checks(mock_checks)
+        user_project = db.UserProject.find(id=user_project_id)
+        project = user_project.get_project()
+        project.update(git_url="http://example.com/project/git").save()
+        site = project.get_site()
+
+        heads = {user_project.git_url: "user-1", project.git_url: "project-1"}
+        monkeypatch.setattr("capstone.utils.git.update_mirror", lambda url: None)
+        monkeypatch.setattr("capstone.utils.git.get_mirror_head", lambda url: heads[url])
+
+        graded = []
+
+        def run_checks(commit, **kwargs):
+            graded.append(commit)
+            checks = [{"status": "pass", "message": None} for _ in mock_checks]
+            return {"ok": True, "log": None, "tasks": [{"checks": checks}]}
+
+        monkeypatch.setattr("capstone.tasks.run_checks", run_checks)
+
+        run_checker(site=site, user_project=user_project)
+        # same commits, result is taken from the cache
+        assert run_checker(site=site, user_project=user_project)["ok"]
+        assert graded == ["user-1"]
+
+        heads[user_project.git_url] = "user-2"
+        run_checker(site=site, user_project=user_project)
+        assert graded == ["user-1", "user-2"]
+
+    def test_checks_hash_changes_with_checks(self, project_id, task_id):
+        project = db.Project.find(id=project_id)
+        checks_hash = project.get_checks_hash()
+
+        db.Task.find(id=task_id).update_checks(mock_checks)
+        assert db.Project.find(id=project_id).get_checks_hash() != checks_hash
+
+
+def test_apply_check_results(user_project_id, task_id):
+    task = db.Task.find(id=task_id)
+    task.update_checks(mock_checks)
+    user_project = db.UserProject.find(id=user_project_id)
+
+    results = [{"checks": [
+        {"status": "pass", "message": None},
+        {"status": "fail", "message": "failed"},
+    ]}]
+    user_project.apply_check_results(results)
+
+    task_status = user_project.get_task_status(task)
+    assert task_status.status == "In Progress"  # Failing, and first task
+    assert [(cs.status, cs.message) for cs in task_status.get_check_statuses()] == [
+        ("pass", None), ("fail", "failed"),
+    ]
+
+    results[0]["checks"][1] = {"status": "pass", "message": None}
+    user_project.apply_check_results(results)
+    assert user_project.get_task_status(task).status == "Completed"
+    assert [cs.status for cs in task_status.get_check_statuses()] == ["pass", "pass"]
+
+
+def test_save_many(task_id):
+    checks = db.TaskCheck.save_many([
+        db.TaskCheck(task_id=task_id, position=i, **check)
+        for i, check in enumerate(mock_checks)
+    ])
+    assert all(c.id is not None for c in checks)
+    assert [c.name for c in db.Task.find(id=task_id).get_checks()] == [c["name"] for c in mock_checks]
+
+
+def test_db_pool_reuses_connections():
+    db.db.query("SELECT 1")
+    created = db.db.pool.get_stats()["created"]
+
+    for _ in range(3):
+        db.db.query("SELECT 1")
+        with db.db.transaction():
+            db.db.query("SELECT 1")
+
+    stats = db.db.pool.get_stats()
+    assert stats["created"] == created
+    assert stats["in_use"] == 0
@@ -0,0 +1,22 @@
+from capstone.utils.markdown_cache import render_markdown
+
+
+def test_render_markdown_fenced_code_and_tables():
+    html = render_markdown(
+        "```python\n"
+        "print('hello')\n"
+        "```\n"
+        "\n"
+        "| a | b |\n"
+        "|---|---|\n"
+        "| 1 | 2 |\n"
+    )
+    assert "codehilite" in html
+    assert "<pre" in html
+    assert "<table>" in html
+    assert "<td>1</td>" in html
+
+
+def test_render_markdown_is_cached():
+    text = "# Hello"
+    assert render_markdown(text) is render_markdown(text)